@@ -1,5 +1,5 @@
 """Kitchen Helper API"""
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 
 import fastapi.staticfiles
 
@@ -8,25 +8,26 @@ import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
 import configuration
 import appLogging
+import appMedia
+import appMetrics
+import db.connection
+import operations.images
+import operations.llm
+import operations.messages
+import operations.passwords
+import operations.roles
+import operations.seeders
+import asyncio
 import threading
+import appTracing
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 
-from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.resources import Resource, SERVICE_NAME
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-
-from routers import users
-
-resource = Resource(attributes={SERVICE_NAME: "MPwebApi"})
-trace_provider = TracerProvider(resource=resource)
-processor = BatchSpanProcessor(OTLPSpanExporter(endpoint="http://jaeger:4318/v1/traces"))
-trace_provider.add_span_processor(processor)
-trace.set_tracer_provider(trace_provider)
+from routers import generation, images, roles, search, users
 
 CPUS = multiprocessing.cpu_count()
-config = configuration.Config()
+config = configuration.get_config()
+
+trace_provider = appTracing.setup_tracing(config.tracing)
 
 logging = appLogging.Logger('api')
 
@@ -38,8 +39,16 @@ async def startup_shutdown_lifespan(app: fastapi.FastAPI):
     :param app:
     :return:
     """
+    operations.passwords.start_executor(max_workers=config.password_hashing.workers or CPUS)
+    operations.images.start_executor(max_workers=config.images.workers or max(1, CPUS // 2))
+    try:
+        await operations.roles.refresh_role_catalog_async()
+    except Exception:
+        logging.exception("Role catalog could not be loaded, it will be loaded on first use")
+    role_catalog_poller = asyncio.create_task(operations.roles.poll_role_catalog())
     try:
         print("Start")
+        await asyncio.to_thread(operations.seeders.seed_search_index)
         # app_seeder.apply_async(link=seed_recipe_categories.si())
         # users_grpc_thread = threading.Thread(target=users_grpc)
         # users_grpc_thread.daemon = True
@@ -54,32 +63,49 @@ async def startup_shutdown_lifespan(app: fastapi.FastAPI):
         else:
             logging.exception(error_message)
     yield
+    role_catalog_poller.cancel()
+    with suppress(asyncio.CancelledError):
+        await role_catalog_poller
+    await operations.messages.close_broker()
+    await operations.llm.close_client()
+    operations.passwords.shutdown_executor()
+    operations.images.shutdown_executor()
+    db.connection.dispose_engines()
+    await db.connection.dispose_async_engines()
+    appMetrics.mark_worker_dead()
+    trace_provider.shutdown()
 
 
 app = fastapi.FastAPI(
     docs_url='/api/docs', redoc_url='/api/redoc', openapi_url='/api/openai.json', lifespan=startup_shutdown_lifespan
 )
-cors_config = configuration.CorsSettings()
+cors_config = configuration.get_settings(configuration.CorsSettings)
 
 app.add_middleware(
     CORSMiddleware,
     **cors_config.__dict__,
 )
+app.add_middleware(appLogging.RequestIdMiddleware)
+app.add_middleware(appMetrics.MetricsMiddleware)
 
-
+app.add_route('/api/metrics', appMetrics.metrics_endpoint, include_in_schema=False)
 app.include_router(users.users_router, prefix='/api/users')
 # app.include_router(features.users.user_router, prefix='/api/users')
-# app.include_router(features.users.role_router, prefix='/api/roles')
+app.include_router(roles.roles_router, prefix='/api/roles')
 # app.include_router(features.recipes.category_router, prefix='/api/categories')
 # app.include_router(features.recipes.recipes_router, prefix='/api/recipes')
 # app.include_router(features.recipes.ingredient_router, prefix='/api/ingredients')
-# app.include_router(features.images.router, prefix='/api/images')
-# app.mount('/api/media', fastapi.staticfiles.StaticFiles(directory=configuration.MEDIA_PATH))
+app.include_router(images.images_router, prefix='/api/images')
+app.include_router(search.search_router, prefix='/api/search')
+app.include_router(generation.generation_router, prefix='/api/generation')
+app.mount('/api/media', appMedia.MediaFiles(configuration.MEDIA_PATH, config.media))
 
-if config.context != configuration.ContextOptions.TEST:
-    FastAPIInstrumentor.instrument_app(app)
+if config.context != configuration.ContextOptions.TEST and \
+        config.tracing.sampling != configuration.TraceSamplingOptions.OFF:
+    FastAPIInstrumentor.instrument_app(app, tracer_provider=trace_provider)
 
 if __name__ == '__main__':
+    appMetrics.reset_metrics_directory()
     uvicorn.run(
         "api:app",
         reload=config.running_on_dev,
@@ -0,0 +1,393 @@
+"""Two tier cache
+
+A per-worker LRU in front of a SQLite file under CACHE_PATH that every worker of the host shares, memory
+mapped so warm reads are served from the page cache. Both tiers are size bounded, the memory one by entries
+and bytes, the disk one by the bytes of its values, evicting the least recently used entries first. Every
+entry has a TTL.
+
+Callers get a namespace of it with `get_cache(name)`. `get_or_set` loads a missing key once however many
+threads ask for it at the same time, `get_or_set_async` does the same for coroutines of the event loop.
+
+    responses = appCache.get_cache("responses", ttl_seconds=60, disk=False)
+    body = responses.get_or_set(key, render)
+"""
+import asyncio
+import collections
+import os
+import pathlib
+import pickle
+import random
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+from starlette.concurrency import run_in_threadpool
+
+import appLogging
+import appMetrics
+import configuration
+
+cache_config = configuration.get_config().cache
+
+logging = appLogging.Logger.get_child_logger('cache')
+
+_MISSING = object()
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_entries_accessed_at ON entries (accessed_at);
+CREATE INDEX IF NOT EXISTS ix_entries_expires_at ON entries (expires_at);
+"""
+# A read refreshes the recency of a disk entry at most this often, so hot keys do not turn reads into writes
+_TOUCH_SECONDS = 60
+
+
+def _size_of(value) -> int:
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(_size_of(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class MemoryTier:
+    """LRU of values with their expiry, bounded by `max_entries` and by the estimated `max_bytes`"""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: collections.OrderedDict[str, tuple[float, Any, int]] = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _pop(self, key: str):
+        if entry := self._entries.pop(key, None):
+            self._size -= entry[2]
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[0] <= time.time():
+                self._pop(key)
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value, expires_at: float):
+        size = _size_of(value)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (expires_at, value, size)
+            self._size += size
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+                appMetrics.CACHE_EVICTIONS.labels("memory").inc()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._pop(key)
+
+    def delete_prefix(self, prefix: str):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                self._pop(key)
+
+
+class DiskTier:
+    """Pickled values in a SQLite file, bounded by `max_bytes` of values"""
+
+    def __init__(self, path: str, max_bytes: int, mmap_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mmap_bytes = mmap_bytes
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread and process, sqlite3 connections are neither thread nor fork safe
+        if getattr(self._local, "pid", None) != os.getpid():
+            pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={int(self.mmap_bytes)}")
+            connection.executescript(_SQLITE_SCHEMA)
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    def get(self, key: str):
+        """Return the value with its expiry, or _MISSING"""
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute(
+            "SELECT value, expires_at, accessed_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return _MISSING
+        value, expires_at, accessed_at = row
+        if expires_at <= now:
+            connection.execute("DELETE FROM entries WHERE key = ? AND expires_at <= ?", (key, now))
+            return _MISSING
+        if accessed_at < now - _TOUCH_SECONDS:
+            connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        try:
+            return pickle.loads(value), expires_at
+        except Exception:
+            logging.exception(f"Cache entry {key} could not be read, it is dropped")
+            self.delete(key)
+            return _MISSING
+
+    def set(self, key: str, value, expires_at: float):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), expires_at, time.time()),
+            )
+        self._writes += 1
+        # Summing the sizes is a scan of the table, checked every few writes rather than on each one
+        if self._writes % 100 == 0 or random.random() < 0.01:
+            self.evict()
+
+    def delete(self, key: str):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def delete_prefix(self, prefix: str):
+        connection = self._connection()
+        with connection:
+            # Keys of a namespace form a contiguous range of the primary key
+            connection.execute("DELETE FROM entries WHERE key >= ? AND key < ?", (prefix, prefix + "\U0010ffff"))
+
+    def evict(self) -> int:
+        """Drop expired entries, then the least recently used down to 90% of `max_bytes`"""
+        connection = self._connection()
+        with connection:
+            evicted = connection.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),)).rowcount
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - int(self.max_bytes * 0.9)
+                keys, freed = [], 0
+                for key, size in connection.execute("SELECT key, size FROM entries ORDER BY accessed_at"):
+                    keys.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+                evicted += len(keys)
+        if evicted:
+            appMetrics.CACHE_EVICTIONS.labels("disk").inc(evicted)
+        return evicted
+
+
+class _Flight:
+    """A load in progress, the threads asking for the same key wait for its result"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: BaseException | None = None
+
+
+class Cache:
+    """Namespace of the shared tiers with its own TTL"""
+
+    def __init__(self, namespace: str, ttl_seconds: float, disk: bool, memory: MemoryTier, disk_tier: DiskTier | None):
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self._memory = memory
+        self._disk = disk_tier if disk else None
+        self._flights: dict[str, _Flight] = {}
+        self._flights_async: dict[str, asyncio.Future] = {}
+        self._flights_lock = threading.Lock()
+
+    def _key(self, key: Hashable) -> str:
+        return f"{self.namespace}:{key}"
+
+    def _record(self, tier: str, result: str):
+        appMetrics.CACHE_REQUESTS.labels(self.namespace, tier, result).inc()
+
+    def _get_memory(self, full_key: str):
+        value = self._memory.get(full_key)
+        self._record("memory", "miss" if value is _MISSING else "hit")
+        return value
+
+    def _get_disk(self, full_key: str):
+        if self._disk is None:
+            return _MISSING
+        try:
+            entry = self._disk.get(full_key)
+        except sqlite3.Error:
+            logging.exception(f"Disk cache read of {full_key} failed")
+            entry = _MISSING
+        self._record("disk", "miss" if entry is _MISSING else "hit")
+        if entry is _MISSING:
+            return _MISSING
+        value, expires_at = entry
+        self._memory.set(full_key, value, expires_at)
+        return value
+
+    def _set(self, full_key: str, value, ttl_seconds: float | None):
+        expires_at = time.time() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        self._memory.set(full_key, value, expires_at)
+        if self._disk is not None:
+            try:
+                self._disk.set(full_key, value, expires_at)
+            except (sqlite3.Error, pickle.PicklingError, TypeError, AttributeError):
+                logging.exception(f"Disk cache write of {full_key} failed")
+
+    def get(self, key: Hashable, default=None):
+        full_key = self._key(key)
+        if (value := self._get_memory(full_key)) is _MISSING and (value := self._get_disk(full_key)) is _MISSING:
+            return default
+        return value
+
+    def set(self, key: Hashable, value, ttl_seconds: float = None):
+        self._set(self._key(key), value, ttl_seconds)
+
+    def delete(self, key: Hashable):
+        full_key = self._key(key)
+        self._memory.delete(full_key)
+        if self._disk is not None:
+            self._disk.delete(full_key)
+
+    def clear(self):
+        """Drop every entry of the namespace"""
+        prefix = self._key("")
+        self._memory.delete_prefix(prefix)
+        if self._disk is not None:
+            self._disk.delete_prefix(prefix)
+
+    def get_or_set(self, key: Hashable, loader: Callable[[], Any], ttl_seconds: float = None):
+        """
+        Return the cached value, or load it once however many threads ask for it at the same time
+        :param key:
+        :param loader: called without arguments on a miss, its exceptions reach every waiting caller
+        :param ttl_seconds: defaults to the TTL of the namespace
+        :return:
+        """
+
+        full_key = self._key(key)
+        if (value := self._get_memory(full_key)) is not _MISSING:
+            return value
+
+        with self._flights_lock:
+            flight = self._flights.get(full_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[full_key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            if (value := self._get_disk(full_key)) is _MISSING:
+                value = loader()
+                self._set(full_key, value, ttl_seconds)
+            flight.value = value
+            return value
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[full_key]
+            flight.done.set()
+
+    async def get_or_set_async(self, key: Hashable, loader: Callable[[], Awaitable], ttl_seconds: float = None):
+        """
+        Return the cached value, or load it once however many coroutines ask for it at the same time
+        :param key:
+        :param loader: coroutine function called without arguments on a miss
+        :param ttl_seconds: defaults to the TTL of the namespace
+        :return:
+        """
+
+        full_key = self._key(key)
+        if (value := self._get_memory(full_key)) is not _MISSING:
+            return value
+
+        loop = asyncio.get_running_loop()
+        with self._flights_lock:
+            flight = self._flights_async.get(full_key)
+            leader = flight is None or flight.get_loop() is not loop
+            if leader:
+                flight = self._flights_async[full_key] = loop.create_future()
+        if not leader:
+            try:
+                # Shielded, a waiter that is cancelled does not cancel the load of the others
+                return await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                if flight.cancelled() and not asyncio.current_task().cancelling():
+                    # The leader was cancelled, not this waiter
+                    return await self.get_or_set_async(key, loader, ttl_seconds)
+                raise
+
+        try:
+            value = await run_in_threadpool(self._get_disk, full_key) if self._disk is not None else _MISSING
+            if value is _MISSING:
+                value = await loader()
+                if self._disk is None:
+                    self._set(full_key, value, ttl_seconds)
+                else:
+                    await run_in_threadpool(self._set, full_key, value, ttl_seconds)
+            flight.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as error:
+            flight.set_exception(error)
+            # Retrieved, so an error nobody else waited for is not reported as never retrieved
+            flight.exception()
+            raise
+        finally:
+            with self._flights_lock:
+                if self._flights_async.get(full_key) is flight:
+                    del self._flights_async[full_key]
+
+
+_memory_tier = MemoryTier(cache_config.memory_entries, cache_config.memory_bytes)
+_disk_tier = DiskTier(cache_config.disk_file, cache_config.disk_bytes, cache_config.mmap_bytes) \
+    if cache_config.disk_enabled else None
+_caches: dict[str, Cache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(namespace: str, ttl_seconds: float = None, disk: bool = True) -> Cache:
+    """
+    Return the namespace of the shared cache, created with these settings on first use
+    :param namespace:
+    :param ttl_seconds: defaults to `cache__default_ttl_seconds`
+    :param disk: keep the entries in the disk tier too, their values have to be picklable
+    :return:
+    """
+
+    with _caches_lock:
+        if namespace not in _caches:
+            _caches[namespace] = Cache(
+                namespace,
+                cache_config.default_ttl_seconds if ttl_seconds is None else ttl_seconds,
+                disk,
+                _memory_tier,
+                _disk_tier,
+            )
+        return _caches[namespace]
+
+
+def evict_disk_cache() -> int:
+    """Drop expired and least recently used disk entries past the size bound"""
+    return _disk_tier.evict() if _disk_tier is not None else 0
@@ -1,80 +1,213 @@
+"""Application logging
+
+Records are handed to a QueueListener thread per log file through a bounded ring buffer, so request threads
+never wait on disk. When a buffer is full its oldest record is dropped and counted in the
+log_records_dropped metric.
+"""
+import atexit
+import collections
+import copy
+import datetime
+import json
 import logging
-from logging.handlers import WatchedFileHandler
-from pathlib import Path
-
+import queue
+import re
+import threading
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+import appMetrics
 import configuration
-from collections import defaultdict
+
+try:
+    from opentelemetry import trace as _otel_trace
+except ImportError:
+    _otel_trace = None
+
+LOGS_PATH = configuration.ROOT_PATH.joinpath("logs")
+LOGS_PATH.mkdir(exist_ok=True)
+
+LOG_FORMAT = '%(asctime)s - %(process)s - %(thread)s - %(name)s - %(levelname)s - %(message)s'
+
+request_id_var: ContextVar[str | None] = ContextVar('request_id', default=None)
+
+_REQUEST_ID_PATTERN = re.compile(r'^[\w\-.]{1,64}$')
+
+
+class RingBufferQueue:
+    """Bounded queue for QueueHandler/QueueListener which overwrites its oldest record instead of blocking"""
+
+    def __init__(self, maxsize: int):
+        self._records = collections.deque(maxlen=maxsize)
+        self._not_empty = threading.Condition()
+        self.dropped = 0
+
+    def put_nowait(self, record):
+        with self._not_empty:
+            if len(self._records) == self._records.maxlen:
+                self.dropped += 1
+                appMetrics.LOG_RECORDS_DROPPED.inc()
+            self._records.append(record)
+            self._not_empty.notify()
+
+    def get(self, block: bool = True):
+        with self._not_empty:
+            while not self._records:
+                if not block:
+                    raise queue.Empty
+                self._not_empty.wait()
+            return self._records.popleft()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.UTC).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'thread': record.thread,
+            'message': record.getMessage(),
+        }
+        if request_id := getattr(record, 'request_id', None):
+            entry['request_id'] = request_id
+        if trace_id := getattr(record, 'trace_id', None):
+            entry['trace_id'] = trace_id
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def _current_trace_id() -> str | None:
+    if _otel_trace is None:
+        return None
+    span_context = _otel_trace.get_current_span().get_span_context()
+    return format(span_context.trace_id, '032x') if span_context.is_valid else None
+
+
+class BufferedHandler(QueueHandler):
+    """
+    Capture the request context and render the message in the calling thread, the listener thread only
+    formats and writes
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.request_id = request_id_var.get()
+        record.trace_id = _current_trace_id()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _start_listener(handler: QueueHandler, file_handler: logging.Handler) -> QueueHandler:
+    listener = QueueListener(handler.queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
+
+
+def _new_buffer() -> RingBufferQueue:
+    return RingBufferQueue(configuration.get_config().log_queue_size)
+
+
+def buffered_file_handler(filename: str) -> QueueHandler:
+    """
+    Handler factory for logging.config.dictConfig, the configured formatter renders the line in the
+    calling thread
+    :param filename:
+    :return:
+    """
+
+    file_handler = WatchedFileHandler(filename, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter('%(message)s'))
+    return _start_listener(QueueHandler(_new_buffer()), file_handler)
 
 
 class Logger:
-    child_logger_registration = defaultdict(list)
     logger = None
 
     def __init__(self, log_name: str, child_logger=False):
+        self.name = log_name
+        self.child_logger = child_logger
+        self._logger = None
 
         if not child_logger:
-            self.logger = logging.getLogger(log_name)
-            self.logger.setLevel(logging.DEBUG)
-
-            logs_folder = Path(f"{configuration.ROOT_PATH}/logs")
-            logs_folder.mkdir(exist_ok=True)
-            log_file = f"{configuration.ROOT_PATH}/logs/{log_name}.log"
-
-            log_handler = WatchedFileHandler(log_file, encoding='utf-8')
-
-            log_formatter = logging.Formatter(
-                '%(asctime)s - %(process)s - %(thread)s - %(name)s - %(levelname)s - %(message)s'
-            )
-            log_handler.setFormatter(log_formatter)
-            self.logger.addHandler(log_handler)
-            self.child_logger = False
-            Logger.logger = self.logger
-        else:
-            self.name = log_name
-            self.child_logger = child_logger
-
-    def register_parent_logger(self):
-        parent_logger = Logger.logger
-        if parent_logger and parent_logger not in Logger.child_logger_registration[self.name]:
-            self.child_logger = logging.getLogger(f"{parent_logger.name}.{self.name}")
-            Logger.child_logger_registration[self.name].append(parent_logger)
-
-    def _log(self, level, *args, **kwargs):
-        if self.child_logger:
-            self.register_parent_logger()
-            getattr(self.child_logger, level)(*args)
-        else:
-            if not Logger.logger:
-                Logger('undefined')
-            getattr(Logger.logger, level)(*args)
+            self._logger = logging.getLogger(log_name)
+            self._logger.setLevel(logging.DEBUG)
+            if not any(isinstance(handler, BufferedHandler) for handler in self._logger.handlers):
+                file_handler = WatchedFileHandler(LOGS_PATH.joinpath(f"{log_name}.log"), encoding='utf-8')
+                file_handler.setFormatter(JsonFormatter())
+                self._logger.addHandler(_start_listener(BufferedHandler(_new_buffer()), file_handler))
+            Logger.logger = self._logger
+
+    def _resolve(self) -> logging.Logger:
+        # Child loggers attach to the first parent registered, until then they log through the root logger
+        if self._logger is None:
+            if Logger.logger is None:
+                return logging.getLogger(self.name)
+            self._logger = Logger.logger.getChild(self.name)
+        return self._logger
 
     def debug(self, *args):
-        self._log('debug', *args)
+        self._resolve().debug(*args)
 
     def info(self, *args):
-        self._log('info', *args)
+        self._resolve().info(*args)
 
     def warning(self, *args):
-        self._log('warning', *args)
+        self._resolve().warning(*args)
 
     def error(self, *args):
-        self._log('error', *args)
+        self._resolve().error(*args)
 
-    def exception(self, *args, **kwargs):
-        self._log('error', *args, **kwargs)
+    def exception(self, *args):
+        self._resolve().exception(*args)
 
     @classmethod
     def get_child_logger(cls, log_name: str):
         return cls(log_name, child_logger=True)
 
 
+class RequestIdMiddleware:
+    """ASGI middleware binding an X-Request-ID to every log record of the request and echoing it back"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')
+        if not _REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), (b'x-request-id', request_id.encode())]
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
+
 UVICORN_LOG_CONFIG = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
         'default': {
             '()': 'uvicorn.logging.DefaultFormatter',
-            'format': '%(asctime)s - %(process)s - %(thread)s - %(name)s - %(levelname)s - %(message)s'
+            'format': LOG_FORMAT
         }
     },
     'handlers': {
@@ -85,19 +218,13 @@ UVICORN_LOG_CONFIG = {
         },
         'error_file_handler': {
             'formatter': 'default',
-            'class': 'logging.handlers.WatchedFileHandler',
-            "filename": "logs/uvicorn_error.log",
-            "when": 'midnight',
-            "utc": True,
-            "encoding": 'utf-8'
+            '()': 'appLogging.buffered_file_handler',
+            "filename": f"{LOGS_PATH}/uvicorn_error.log",
         },
         'access_handler': {
             'formatter': 'default',
-            'class': 'logging.handlers.WatchedFileHandler',
-            "filename": "logs/uvicorn_access.log",
-            "when": 'midnight',
-            "utc": True,
-            "encoding": 'utf-8'
+            '()': 'appLogging.buffered_file_handler',
+            "filename": f"{LOGS_PATH}/uvicorn_access.log",
         },
     },
     'loggers': {
@@ -112,4 +239,4 @@ UVICORN_LOG_CONFIG = {
             'propagate': False
         },
     }
-}
\ No newline at end of file
+}
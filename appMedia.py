@@ -0,0 +1,257 @@
+"""Media file serving
+
+ASGI app mounted on /api/media in place of StaticFiles. Every file gets a strong ETag derived from its
+content: the SHA-256 in the path of content-addressed images, otherwise a hash of the bytes computed once
+per file version. Content-addressed originals are sent with an immutable Cache-Control, variants and other
+files have to be revalidated, a variant is regenerated in place when its settings change. Single byte ranges are answered with a 206, so audio players can seek.
+
+Files up to `media__cache_file_bytes` are kept in a per-worker LRU of at most `media__cache_bytes`, larger
+ones are handed to nginx with X-Accel-Redirect when `media__accel_redirect_prefix` is set, sent with the
+zero-copy or pathsend ASGI extensions when the server offers them, and read in blocks off the event loop
+otherwise.
+"""
+import collections
+import email.utils
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+import threading
+import urllib.parse
+
+from starlette.concurrency import run_in_threadpool
+
+import appCache
+import appMetrics
+import configuration
+import operations.response_cache
+
+mimetypes.add_type("image/webp", ".webp")
+
+# images/<hash[:2]>/<hash>/<file> as written by operations.images
+_CONTENT_ADDRESSED = re.compile(r"^images/[0-9a-f]{2}/(?P<hash>[0-9a-f]{64})/(?P<name>[^/]+)$")
+_SINGLE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class _HotFiles:
+    """Bodies of small files with their ETag, the least recently used are dropped past `max_bytes`"""
+
+    # Not an appCache namespace: file bodies have their own byte budget, so they cannot push the small entries
+    # of other namespaces out of the shared memory tier, and an entry is valid for a file version, not a TTL
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: collections.OrderedDict[str, tuple[tuple, bytes, str]] = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, path: str, version: tuple) -> tuple[bytes, str] | None:
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(path)
+            return entry[1], entry[2]
+
+    def put(self, path: str, version: tuple, body: bytes, etag: str):
+        with self._lock:
+            if previous := self._entries.pop(path, None):
+                self._size -= len(previous[1])
+            self._entries[path] = (version, body, etag)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+def _original_etag(relative: str) -> str | None:
+    """The hash in the path of a content-addressed original is the hash of its bytes"""
+    if (match := _CONTENT_ADDRESSED.match(relative)) and match["name"].startswith("original."):
+        return f'"{match["hash"]}"'
+    return None
+
+
+def _hash_file(path: str, chunk_size: int) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _parse_range(header: str | None, size: int) -> tuple[int, int] | None | bool:
+    """
+    First and last byte of a single range
+    :return: None to send the whole file, False when the range is not satisfiable
+    """
+
+    if not header or not (match := _SINGLE_RANGE.match(header.strip())):
+        # Several ranges or other units, the whole file is a valid answer to them
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last or int(last) == 0:
+            return False
+        return max(0, size - int(last)), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        return False
+    return first, last
+
+
+def _stat(full_path: str) -> os.stat_result | None:
+    try:
+        return os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+class MediaFiles:
+    """Serve the files of `directory`, see the module docstring"""
+
+    def __init__(self, directory: os.PathLike, media: configuration.MediaConfig):
+        self.directory = os.path.realpath(configuration.ensure_directory(directory))
+        self.config = media
+        self._hot_files = _HotFiles(media.cache_bytes)
+        # ETags of files too large for the LRU, by path and version, shared by the workers of the host
+        self._etags = appCache.get_cache("media_etags")
+
+    def _resolve(self, scope) -> tuple[str, str] | None:
+        path, root_path = scope["path"], scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        # The server has already percent-decoded the path, a `%` left in it is part of the file name
+        relative = path.lstrip("/")
+        if any(part.startswith(".") for part in relative.split("/")):
+            # Dot files, among them variants still being written
+            return None
+        full_path = os.path.realpath(os.path.join(self.directory, relative))
+        if not full_path.startswith(self.directory + os.sep):
+            return None
+        return relative, full_path
+
+    async def _etag(self, relative: str, full_path: str, version: tuple) -> str:
+        if etag := _original_etag(relative):
+            return etag
+
+        async def hash_file() -> str:
+            return f'"{await run_in_threadpool(_hash_file, full_path, self.config.chunk_size)}"'
+
+        return await self._etags.get_or_set_async((full_path, *version), hash_file)
+
+    def _is_not_modified(self, request_headers: dict, etag: str, modified: float) -> bool:
+        if (if_none_match := request_headers.get(b"if-none-match")) is not None:
+            return operations.response_cache.etag_matches(if_none_match.decode("latin-1"), etag)
+        if if_modified_since := request_headers.get(b"if-modified-since"):
+            try:
+                return int(modified) <= email.utils.parsedate_to_datetime(if_modified_since.decode()).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        if scope["method"] not in ("GET", "HEAD"):
+            return await _send_empty(send, 405, [(b"allow", b"GET, HEAD")])
+
+        resolved = self._resolve(scope)
+        stat_result = await run_in_threadpool(_stat, resolved[1]) if resolved else None
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            return await _send_empty(send, 404)
+        relative, full_path = resolved
+        version = (stat_result.st_size, stat_result.st_mtime_ns)
+        size = stat_result.st_size
+
+        body = None
+        if size <= self.config.cache_file_bytes:
+            if cached := self._hot_files.get(full_path, version):
+                body, etag = cached
+            else:
+                body = await run_in_threadpool(_read_file, full_path)
+                etag = _original_etag(relative) or f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+                self._hot_files.put(full_path, version, body, etag)
+        else:
+            etag = await self._etag(relative, full_path, version)
+
+        cache_control = f"public, max-age={self.config.immutable_max_age}, immutable" \
+            if _original_etag(relative) else "public, no-cache"
+        content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        last_modified = email.utils.formatdate(stat_result.st_mtime, usegmt=True)
+        headers = [
+            (b"etag", etag.encode()),
+            (b"last-modified", last_modified.encode()),
+            (b"cache-control", cache_control.encode()),
+            (b"accept-ranges", b"bytes"),
+        ]
+        request_headers = dict(scope["headers"])
+        if self._is_not_modified(request_headers, etag, stat_result.st_mtime):
+            appMetrics.MEDIA_RESPONSES.labels("not_modified").inc()
+            return await _send_empty(send, 304, headers)
+
+        byte_range = None
+        if_range = request_headers.get(b"if-range")
+        if if_range is None or if_range.decode("latin-1") in (etag, last_modified):
+            byte_range = _parse_range(request_headers.get(b"range", b"").decode("latin-1"), size)
+        if byte_range is False:
+            return await _send_empty(send, 416, [(b"content-range", f"bytes */{size}".encode())])
+
+        status, first, last = 200, 0, size - 1
+        if byte_range:
+            status, (first, last) = 206, byte_range
+            headers.append((b"content-range", f"bytes {first}-{last}/{size}".encode()))
+        headers += [(b"content-type", content_type.encode()), (b"content-length", str(last - first + 1).encode())]
+
+        if body is None and self.config.accel_redirect_prefix:
+            # nginx sends the file, and answers the range itself
+            location = self.config.accel_redirect_prefix.rstrip("/") + "/" + urllib.parse.quote(relative)
+            appMetrics.MEDIA_RESPONSES.labels("accel_redirect").inc()
+            return await _send_empty(send, 200, [*headers[:4], (b"x-accel-redirect", location.encode())])
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if scope["method"] == "HEAD" or size == 0:
+            return await send({"type": "http.response.body", "body": b""})
+        if body is not None:
+            appMetrics.MEDIA_RESPONSES.labels("memory").inc()
+            return await send({"type": "http.response.body", "body": body[first:last + 1]})
+        await self._send_file(scope, send, full_path, first, last - first + 1, whole=status == 200)
+
+    async def _send_file(self, scope, send, full_path: str, offset: int, count: int, whole: bool):
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            appMetrics.MEDIA_RESPONSES.labels("zerocopy").inc()
+            with open(full_path, "rb") as file:
+                return await send({
+                    "type": "http.response.zerocopysend", "file": file, "offset": offset, "count": count,
+                })
+        if whole and "http.response.pathsend" in extensions:
+            appMetrics.MEDIA_RESPONSES.labels("pathsend").inc()
+            return await send({"type": "http.response.pathsend", "path": full_path})
+
+        appMetrics.MEDIA_RESPONSES.labels("file").inc()
+        descriptor = await run_in_threadpool(os.open, full_path, os.O_RDONLY)
+        try:
+            while count > 0:
+                # pread keeps no file position, blocks are read off the event loop
+                chunk = await run_in_threadpool(os.pread, descriptor, min(self.config.chunk_size, count), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+            if count > 0:
+                # The file shrank while it was sent
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            os.close(descriptor)
+
+
+async def _send_empty(send, status: int, headers: list = ()):
+    await send({"type": "http.response.start", "status": status, "headers": [*headers, (b"content-length", b"0")]})
+    await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,168 @@
+"""Application metrics
+
+Prometheus metrics in multiprocess mode: every uvicorn worker writes its samples to memory mapped files
+under METRICS_PATH and /api/metrics aggregates the files of all workers.
+"""
+import os
+import time
+from contextvars import ContextVar
+
+import configuration
+
+METRICS_PATH = configuration.ensure_directory(configuration.CACHE_PATH.joinpath("metrics"))
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", str(METRICS_PATH))
+
+import prometheus_client  # noqa: E402, the multiprocess directory has to be set before the import
+import sqlalchemy  # noqa: E402
+from prometheus_client import multiprocess  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from starlette.responses import Response  # noqa: E402
+
+REQUEST_LATENCY = prometheus_client.Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUESTS_IN_PROGRESS = prometheus_client.Gauge(
+    "http_requests_in_progress", "HTTP requests being served", ["method"], multiprocess_mode="livesum"
+)
+REQUEST_DB_QUERIES = prometheus_client.Histogram(
+    "http_request_db_queries",
+    "DB queries executed per HTTP request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+REQUEST_DB_SECONDS = prometheus_client.Histogram(
+    "http_request_db_seconds",
+    "Time spent in DB queries per HTTP request",
+    ["route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+DB_QUERY_SECONDS = prometheus_client.Histogram(
+    "db_query_duration_seconds",
+    "DB query latency",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+PASSWORD_HASHING_SECONDS = prometheus_client.Histogram(
+    "password_hashing_seconds",
+    "bcrypt latency including the wait for a hashing worker",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+PASSWORD_HASHING_REJECTED = prometheus_client.Counter(
+    "password_hashing_rejected", "bcrypt calls rejected because the hashing pool was saturated"
+)
+LOGIN_THROTTLED = prometheus_client.Counter(
+    "login_throttled", "Sign in attempts rejected before the password check", ["key"]
+)
+IMAGE_PROCESSING_SECONDS = prometheus_client.Histogram(
+    "image_processing_seconds",
+    "Time to generate the variants of an uploaded image",
+    ["runner"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+IMAGE_UPLOADS = prometheus_client.Counter(
+    "image_uploads", "Image uploads, by created or duplicate", ["result"]
+)
+MEDIA_RESPONSES = prometheus_client.Counter(
+    "media_responses", "Media responses, by how the body was sent", ["source"]
+)
+CACHE_REQUESTS = prometheus_client.Counter(
+    "cache_requests", "Cache lookups, by namespace, tier and hit or miss", ["namespace", "tier", "result"]
+)
+CACHE_EVICTIONS = prometheus_client.Counter(
+    "cache_evictions", "Cache entries evicted before they expired or after, by tier", ["tier"]
+)
+RESPONSE_CACHE = prometheus_client.Counter(
+    "response_cache", "Cached responses served, by hit, miss or not_modified", ["result"]
+)
+LLM_REQUESTS = prometheus_client.Counter(
+    "llm_requests", "Generation requests, by how they were answered: cache, model or coalesced", ["source"]
+)
+LLM_SECONDS = prometheus_client.Histogram(
+    "llm_seconds",
+    "Time of a model call, until its last chunk",
+    ["result"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+SEARCH_QUERIES = prometheus_client.Counter(
+    "search_queries", "Search queries, by how they matched: words, typo, similar or none", ["match"]
+)
+
+LOG_RECORDS_DROPPED = prometheus_client.Counter(
+    "log_records_dropped", "Log records overwritten in a full ring buffer before the listener wrote them"
+)
+
+# [query count, query seconds] of the request being served
+_request_db_usage: ContextVar[list | None] = ContextVar("request_db_usage", default=None)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    DB_QUERY_SECONDS.observe(elapsed)
+    if (usage := _request_db_usage.get()) is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, in-flight requests and DB usage per route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        method = scope["method"]
+        usage = [0, 0.0]
+        token = _request_db_usage.set(usage)
+        in_progress = REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_progress.dec()
+            _request_db_usage.reset(token)
+            # The router stores the matched route in the scope, its template keeps the label cardinality low
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_LATENCY.labels(method, route, str(status)).observe(elapsed)
+            REQUEST_DB_QUERIES.labels(route).observe(usage[0])
+            REQUEST_DB_SECONDS.labels(route).observe(usage[1])
+
+
+def metrics_endpoint(request: Request) -> Response:
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(prometheus_client.generate_latest(registry), media_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def reset_metrics_directory():
+    """Remove the samples of previous runs, call once in the server process before the workers start"""
+    # Files of this process are already memory mapped by the metrics defined above and must stay
+    own_suffix = f"_{os.getpid()}.db"
+    for path in METRICS_PATH.glob("*.db"):
+        if not path.name.endswith(own_suffix):
+            path.unlink(missing_ok=True)
+
+
+def mark_worker_dead():
+    multiprocess.mark_process_dead(os.getpid())
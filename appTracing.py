@@ -0,0 +1,194 @@
+"""Application tracing
+
+Builds the OpenTelemetry tracer provider from configuration.TracingConfig: the sampling mode, the exporter
+and the bounds of the export queue. The OTLP exporter falls back to a local JSON lines file while the
+collector is unreachable instead of retrying every batch.
+"""
+import collections
+import pathlib
+import statistics
+import threading
+import time
+import typing
+
+from opentelemetry import trace
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    ConsoleSpanExporter,
+    SimpleSpanProcessor,
+    SpanExporter,
+    SpanExportResult,
+)
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF, ALWAYS_ON, ParentBased, TraceIdRatioBased
+from opentelemetry.trace import StatusCode
+
+import configuration
+
+memory_exporter = InMemorySpanExporter()
+
+
+class FallbackSpanExporter(SpanExporter):
+    """Export to the primary exporter, switch to the fallback for `cooldown_seconds` after a failed export"""
+
+    def __init__(self, primary: SpanExporter, fallback: SpanExporter, cooldown_seconds: int):
+        self.primary = primary
+        self.fallback = fallback
+        self.cooldown_seconds = cooldown_seconds
+        self._primary_down_until = 0.0
+
+    def export(self, spans: typing.Sequence[ReadableSpan]) -> SpanExportResult:
+        if time.monotonic() >= self._primary_down_until:
+            try:
+                if self.primary.export(spans) == SpanExportResult.SUCCESS:
+                    return SpanExportResult.SUCCESS
+            except Exception:
+                pass
+            self._primary_down_until = time.monotonic() + self.cooldown_seconds
+        return self.fallback.export(spans)
+
+    def shutdown(self):
+        self.primary.shutdown()
+        self.fallback.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.fallback.force_flush(timeout_millis)
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    """
+    Hold the spans of a trace until its local root ends, then forward the whole trace only if it failed,
+    was slow or falls into the sampling ratio
+    """
+
+    def __init__(self, delegate: SpanProcessor, slow_ms: int, ratio: float, max_pending_traces: int):
+        self.delegate = delegate
+        self.slow_ns = slow_ms * 1_000_000
+        self.ratio_sampler = TraceIdRatioBased(ratio)
+        self.max_pending_traces = max_pending_traces
+        self._pending: collections.OrderedDict[int, list[ReadableSpan]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def on_start(self, span, parent_context=None):
+        self.delegate.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan):
+        trace_id = span.context.trace_id
+        with self._lock:
+            spans = self._pending.setdefault(trace_id, [])
+            spans.append(span)
+            # Evict the trace which has been quiet the longest, not the one started first
+            self._pending.move_to_end(trace_id)
+            if span.parent is not None and not span.parent.is_remote:
+                if len(self._pending) > self.max_pending_traces:
+                    self._pending.popitem(last=False)
+                return
+            del self._pending[trace_id]
+
+        if self._keep(span, spans):
+            for finished in spans:
+                self.delegate.on_end(finished)
+
+    def _keep(self, root: ReadableSpan, spans: list[ReadableSpan]) -> bool:
+        if any(span.status.status_code == StatusCode.ERROR for span in spans):
+            return True
+        if root.end_time - root.start_time >= self.slow_ns:
+            return True
+        # TraceIdRatioBased only looks at the trace id, the other arguments are unused
+        return self.ratio_sampler.should_sample(None, root.context.trace_id, root.name).decision.is_sampled()
+
+    def shutdown(self):
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.delegate.force_flush(timeout_millis)
+
+
+def _file_exporter(tracing_config: configuration.TracingConfig) -> SpanExporter:
+    file_path = pathlib.Path(tracing_config.file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    out = file_path.open('a', encoding='utf-8')
+    return ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+
+
+def _span_processor(tracing_config: configuration.TracingConfig) -> SpanProcessor | None:
+    exporter_option = tracing_config.exporter
+    if exporter_option == configuration.TraceExporterOptions.NONE:
+        return None
+    if exporter_option == configuration.TraceExporterOptions.MEMORY:
+        return SimpleSpanProcessor(memory_exporter)
+
+    if exporter_option == configuration.TraceExporterOptions.FILE:
+        exporter = _file_exporter(tracing_config)
+    else:
+        exporter = FallbackSpanExporter(
+            OTLPSpanExporter(endpoint=tracing_config.otlp_endpoint, timeout=tracing_config.export_timeout_ms / 1000),
+            _file_exporter(tracing_config),
+            tracing_config.fallback_cooldown_seconds,
+        )
+    return BatchSpanProcessor(
+        exporter,
+        max_queue_size=tracing_config.max_queue_size,
+        max_export_batch_size=tracing_config.max_export_batch_size,
+        export_timeout_millis=tracing_config.export_timeout_ms,
+    )
+
+
+def setup_tracing(tracing_config: configuration.TracingConfig) -> TracerProvider:
+    """
+    Create the tracer provider of this process and install it globally
+    :param tracing_config:
+    :return:
+    """
+
+    sampling = tracing_config.sampling
+    if sampling == configuration.TraceSamplingOptions.OFF:
+        sampler = ALWAYS_OFF
+    elif sampling == configuration.TraceSamplingOptions.TAIL:
+        sampler = ALWAYS_ON
+    else:
+        sampler = ParentBased(TraceIdRatioBased(tracing_config.ratio))
+
+    trace_provider = TracerProvider(resource=Resource(attributes={SERVICE_NAME: "MPwebApi"}), sampler=sampler)
+    processor = _span_processor(tracing_config) if sampling != configuration.TraceSamplingOptions.OFF else None
+    if processor and sampling == configuration.TraceSamplingOptions.TAIL:
+        processor = TailSamplingSpanProcessor(
+            processor, tracing_config.slow_request_ms, tracing_config.ratio, tracing_config.max_queue_size
+        )
+    if processor:
+        trace_provider.add_span_processor(processor)
+    trace.set_tracer_provider(trace_provider)
+    return trace_provider
+
+
+def _percentile(durations: list[float], percentile: int) -> float:
+    if len(durations) == 1:
+        return durations[0]
+    return statistics.quantiles(durations, n=100, method='inclusive')[percentile - 1]
+
+
+def latency_summary(spans: typing.Iterable[ReadableSpan] = None) -> dict[str, dict]:
+    """
+    Summarise span durations per span name in milliseconds, defaults to the spans of the memory exporter
+    :param spans:
+    :return: {span name: {count, mean, p50, p95, p99, max}}
+    """
+
+    durations = collections.defaultdict(list)
+    for span in memory_exporter.get_finished_spans() if spans is None else spans:
+        durations[span.name].append((span.end_time - span.start_time) / 1_000_000)
+
+    return {
+        name: {
+            'count': len(values),
+            'mean': statistics.fmean(values),
+            'p50': _percentile(values, 50),
+            'p95': _percentile(values, 95),
+            'p99': _percentile(values, 99),
+            'max': max(values),
+        }
+        for name, values in sorted(durations.items())
+    }
@@ -0,0 +1,153 @@
+"""Load test of the authentication endpoints
+
+    python -m benchmarks.auth --database sqlite --workers 4 --concurrency 32 --duration 20 --output auth.json
+
+Starts `api:app` under uvicorn against a fresh SQLite file, or the Postgres of the `postgres__*` settings, seeds
+a benchmark user and drives `/api/users/sign-in` and `/api/users/refresh-token` with `--concurrency` clients
+for `--duration` seconds each, after a warm up that is not recorded. Every client signs in once and follows
+the refresh token cookies it is given. Throughput and p50/p95/p99 latency of successful calls go to the result
+file, failed calls are counted by status.
+"""
+import argparse
+import asyncio
+import collections
+import pathlib
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+import benchmarks.common
+import configuration
+
+SCENARIOS = ("sign_in", "refresh")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(environment: dict, workers: int, port: int) -> subprocess.Popen:
+    """Start uvicorn with the app and wait until it answers"""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=configuration.ROOT_PATH, env=environment,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/api/openai.json", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Server did not start within 60 seconds")
+
+
+async def _sign_in(client: httpx.AsyncClient) -> httpx.Response:
+    return await client.post(
+        "/api/users/sign-in",
+        data={"username": benchmarks.common.BENCHMARK_EMAIL, "password": benchmarks.common.BENCHMARK_PASSWORD},
+    )
+
+
+async def run_scenario(base_url: str, scenario: str, concurrency: int, duration: float, warmup: float) -> dict:
+    """
+    Drive one endpoint with `concurrency` clients
+    :return: summary of the calls started after the warm up
+    """
+
+    latencies = []
+    failures = collections.Counter()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        measure_from = time.perf_counter() + warmup
+        measure_until = measure_from + duration
+
+        async def virtual_client():
+            refresh_token = None
+            if scenario == "refresh":
+                response = await _sign_in(client)
+                response.raise_for_status()
+                refresh_token = response.cookies["refresh_token"]
+            while (started := time.perf_counter()) < measure_until:
+                try:
+                    if scenario == "sign_in":
+                        response = await _sign_in(client)
+                    else:
+                        # The cookie is secure, it would not be sent over plain http by the cookie jar
+                        client.cookies.clear()
+                        response = await client.post(
+                            "/api/users/refresh-token", headers={"Cookie": f"refresh_token={refresh_token}"}
+                        )
+                    status = response.status_code
+                except httpx.HTTPError as error:
+                    status = type(error).__name__
+                finished = time.perf_counter()
+                if status == 200:
+                    refresh_token = response.cookies.get("refresh_token", refresh_token)
+                if started < measure_from:
+                    continue
+                if status == 200:
+                    latencies.append((finished - started) * 1000)
+                else:
+                    failures[str(status)] += 1
+
+        await asyncio.gather(*(virtual_client() for _ in range(concurrency)))
+
+    return {**benchmarks.common.summarize(latencies, duration, sum(failures.values())), "failures": dict(failures)}
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', choices=('sqlite', 'postgres'), default='sqlite')
+    parser.add_argument('--workers', type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument('--concurrency', type=int, default=16, help="clients sending requests at the same time")
+    parser.add_argument('--duration', type=float, default=10, help="seconds measured per scenario")
+    parser.add_argument('--warmup', type=float, default=2, help="seconds before measuring")
+    parser.add_argument('--bcrypt-rounds', type=int, help="cost factor, the configured one by default")
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append', help="defaults to all of them")
+    parser.add_argument('--output', type=pathlib.Path, help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    environment = benchmarks.common.configure_database(args.database, args.bcrypt_rounds)
+    benchmarks.common.seed_database()
+
+    port = _free_port()
+    server = start_server(environment, args.workers, port)
+    try:
+        metrics = {
+            scenario: asyncio.run(run_scenario(
+                f"http://127.0.0.1:{port}", scenario, args.concurrency, args.duration, args.warmup
+            ))
+            for scenario in args.scenario or SCENARIOS
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    benchmarks.common.write_results(
+        "auth",
+        {
+            "database": args.database,
+            "workers": args.workers,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "bcrypt_rounds": configuration.get_config().password_hashing.bcrypt_rounds,
+        },
+        metrics,
+        args.output,
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""Measurements and result files shared by the benchmarks
+
+Every benchmark writes the same JSON layout, `metrics` maps a measured path to its numbers, so
+`python -m benchmarks.compare` can diff any two result files. Metrics ending in `_ms` are better lower,
+metrics ending in `_per_second` better higher, the others are only reported.
+"""
+import datetime
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import tempfile
+
+import configuration
+
+BENCHMARK_EMAIL = "bench@benchmark.local"
+BENCHMARK_PASSWORD = "Benchmark1@"
+
+
+def percentiles(latencies_ms: list[float]) -> dict:
+    """p50/p95/p99 and mean of the latencies"""
+    if not latencies_ms:
+        return {"mean_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    if len(latencies_ms) == 1:
+        cuts = latencies_ms * 99
+    else:
+        cuts = statistics.quantiles(latencies_ms, n=100, method='inclusive')
+    return {
+        "mean_ms": statistics.fmean(latencies_ms),
+        "p50_ms": cuts[49],
+        "p95_ms": cuts[94],
+        "p99_ms": cuts[98],
+        "max_ms": max(latencies_ms),
+    }
+
+
+def summarize(latencies_ms: list[float], elapsed_seconds: float, errors: int = 0) -> dict:
+    """Throughput and latency percentiles of the calls finished within `elapsed_seconds`"""
+    return {
+        "requests": len(latencies_ms),
+        "errors": errors,
+        "requests_per_second": len(latencies_ms) / elapsed_seconds if elapsed_seconds else None,
+        **percentiles(latencies_ms),
+    }
+
+
+def configure_database(database: str, bcrypt_rounds: int = None) -> dict:
+    """
+    Point this process, and the servers it starts, at the benchmark database
+    :param database: sqlite uses a fresh file, postgres the `postgres__*` settings of the environment
+    :param bcrypt_rounds: cost factor of the seeded password and of sign in checks, the configured one by default
+    :return: the environment to start servers with
+    """
+
+    os.environ["DATABASE"] = database
+    if database == "sqlite":
+        os.environ["SQLITE__FILE_NAME"] = str(pathlib.Path(tempfile.mkdtemp(prefix="benchmark-")).joinpath("app.db"))
+    if bcrypt_rounds:
+        os.environ["PASSWORD_HASHING__BCRYPT_ROUNDS"] = str(bcrypt_rounds)
+    return dict(os.environ)
+
+
+def seed_database() -> str:
+    """
+    Create the tables and the benchmark user, it has a role so its tokens carry the same claims as real ones
+    :return: id of the benchmark user
+    """
+
+    import db.connection
+    import db.models
+    import operations.roles
+    import operations.users
+
+    db.models.DbBaseModel.metadata.create_all(db.connection.get_engine())
+    if user := operations.users.get_user_by_email(BENCHMARK_EMAIL):
+        return user.id
+    user = operations.users.create_user("Bench", "Mark", BENCHMARK_EMAIL, None, BENCHMARK_PASSWORD)
+    role = operations.roles.get_role_by_name("BENCHMARK") or operations.roles.create_role("BENCHMARK", user.id)
+    operations.users.add_user_to_role(user.id, role.id, user.id)
+    return user.id
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=configuration.ROOT_PATH, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> dict:
+    return {
+        "commit": _git_commit(),
+        "recorded_on": datetime.datetime.now(datetime.UTC).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_results(benchmark: str, parameters: dict, metrics: dict[str, dict], output: pathlib.Path = None,
+                  **extra) -> dict:
+    """
+    Print the metrics and write the result file
+    :param benchmark: name of the benchmark
+    :param parameters: what the run was configured with, runs are only comparable with the same parameters
+    :param metrics: numbers of each measured path
+    :param output: JSON file, nothing is written without it
+    :param extra: more sections stored in the result file
+    :return: the results
+    """
+
+    results = {"benchmark": benchmark, **environment(), "parameters": parameters, "metrics": metrics, **extra}
+    for name, values in metrics.items():
+        numbers = ", ".join(
+            f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}" for key, value in values.items()
+        )
+        print(f"{name}: {numbers}")
+    if output:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(results, indent=2))
+    return results
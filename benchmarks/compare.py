@@ -0,0 +1,65 @@
+"""Compare two benchmark result files
+
+    python -m benchmarks.compare baseline.json current.json --threshold 10
+
+Prints the change of every metric present in both files. Exits with status 1 when a `_ms` metric grew, or a
+`_per_second` metric shrank, by more than `--threshold` percent, so it can gate a CI job.
+"""
+import argparse
+import json
+import pathlib
+import sys
+
+
+def _direction(metric: str) -> int:
+    """1 when higher is better, -1 when lower is better, 0 when it is only reported"""
+    if metric.endswith('_per_second'):
+        return 1
+    if metric.endswith('_ms'):
+        return -1
+    return 0
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """
+    :return: descriptions of the regressions
+    """
+
+    if baseline.get("parameters") != current.get("parameters"):
+        print(f"warning: parameters differ, {baseline.get('parameters')} != {current.get('parameters')}")
+
+    regressions = []
+    for path, values in current["metrics"].items():
+        for metric, value in values.items():
+            previous = baseline["metrics"].get(path, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+                continue
+            change = (value - previous) / previous * 100
+            direction = _direction(metric)
+            regressed = direction and -direction * change > threshold
+            if regressed:
+                regressions.append(f"{path} {metric}: {previous:.2f} -> {value:.2f} ({change:+.1f}%)")
+            print(f"{'REGRESSION ' if regressed else ''}{path} {metric}: {previous:.2f} -> {value:.2f} ({change:+.1f}%)")
+    return regressions
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline', type=pathlib.Path)
+    parser.add_argument('current', type=pathlib.Path)
+    parser.add_argument('--threshold', type=float, default=10, help="allowed change in percent")
+    args = parser.parse_args(argv)
+
+    baseline, current = json.loads(args.baseline.read_text()), json.loads(args.current.read_text())
+    if baseline["benchmark"] != current["benchmark"]:
+        parser.error(f"Cannot compare {baseline['benchmark']} with {current['benchmark']} results")
+    print(f"{baseline['benchmark']}: {baseline.get('commit')} -> {current.get('commit')}")
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {args.threshold}%")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""Micro benchmarks of the authentication hot paths
+
+    python -m benchmarks.hot_paths --database sqlite --min-time 2 --profile --output hot_paths.json
+
+Times bcrypt, JWT encoding and verification, the `get_user` queries and session creation in this process,
+each repeated for at least `--min-time` seconds. With `--profile` every path also runs under cProfile and the
+functions with the highest cumulative time are stored next to its numbers.
+"""
+import argparse
+import asyncio
+import cProfile
+import functools
+import pathlib
+import pstats
+import sys
+import time
+from typing import Awaitable, Callable
+
+import benchmarks.common
+import configuration
+
+
+def _measure(function: Callable, min_time: float, min_iterations: int) -> list[float]:
+    latencies = []
+    deadline = time.perf_counter() + min_time
+    while len(latencies) < min_iterations or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def _measure_async(loop: asyncio.AbstractEventLoop, function: Callable[[], Awaitable], min_time: float,
+                   min_iterations: int) -> list[float]:
+    async def measure():
+        latencies = []
+        deadline = time.perf_counter() + min_time
+        while len(latencies) < min_iterations or time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await function()
+            latencies.append((time.perf_counter() - started) * 1000)
+        return latencies
+
+    return loop.run_until_complete(measure())
+
+
+def _top_functions(profile: cProfile.Profile, limit: int) -> list[dict]:
+    stats = pstats.Stats(profile)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [
+        {
+            "function": f"{pathlib.Path(filename).name}:{line}({name})",
+            "calls": calls,
+            "self_ms": total_time * 1000,
+            "cumulative_ms": cumulative_time * 1000,
+        }
+        for (filename, line, name), (_, calls, total_time, cumulative_time, _) in rows
+    ]
+
+
+def _hot_paths(user_id: str) -> dict[str, tuple[bool, Callable]]:
+    """Paths by name, with whether they are coroutines"""
+    import sqlalchemy
+
+    import db.connection
+    import operations.passwords
+    import operations.tokens
+    import operations.users
+
+    password = benchmarks.common.BENCHMARK_PASSWORD
+    hashed_password = operations.passwords.hash_password(password)
+    access_token = operations.tokens.create_access_token(user_id, role="BENCHMARK")
+    email = benchmarks.common.BENCHMARK_EMAIL
+
+    def verify_access_token():
+        operations.tokens._verified_tokens.clear()
+        operations.tokens.decode_access_token(access_token)
+
+    def open_session():
+        with db.connection.get_session() as session:
+            session.execute(sqlalchemy.select(1))
+
+    async def open_async_session():
+        async with db.connection.get_async_session() as session:
+            await session.execute(sqlalchemy.select(1))
+
+    return {
+        "bcrypt_hash": (False, lambda: operations.passwords.hash_password(password)),
+        "bcrypt_check": (False, lambda: operations.passwords.check_password(password, hashed_password)),
+        "jwt_encode": (False, lambda: operations.tokens.create_access_token(user_id, role="BENCHMARK")),
+        "jwt_decode": (False, verify_access_token),
+        "jwt_decode_cached": (False, lambda: operations.tokens.decode_access_token(access_token)),
+        "get_user_by_id": (False, lambda: operations.users.get_user_by_id(user_id)),
+        "get_user_by_email": (False, lambda: operations.users.get_user_by_email(email)),
+        "get_user_by_email_async": (True, lambda: operations.users.get_user_by_email_async(email)),
+        "get_cached_user_async": (True, lambda: operations.users.get_cached_user_async(email=email)),
+        "session": (False, open_session),
+        "async_session": (True, open_async_session),
+    }
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', choices=('sqlite', 'postgres'), default='sqlite')
+    parser.add_argument('--bcrypt-rounds', type=int, help="cost factor, the configured one by default")
+    parser.add_argument('--min-time', type=float, default=1, help="seconds each path is repeated for")
+    parser.add_argument('--min-iterations', type=int, default=5)
+    parser.add_argument('--path', action='append', help="only these paths, defaults to all of them")
+    parser.add_argument('--profile', action='store_true', help="store the top functions of each path")
+    parser.add_argument('--profile-limit', type=int, default=15)
+    parser.add_argument('--output', type=pathlib.Path, help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    benchmarks.common.configure_database(args.database, args.bcrypt_rounds)
+    user_id = benchmarks.common.seed_database()
+
+    # Async engines are bound to the loop they connect on, every async path shares this one
+    loop = asyncio.new_event_loop()
+    metrics, profiles = {}, {}
+    for name, (is_coroutine, function) in _hot_paths(user_id).items():
+        if args.path and name not in args.path:
+            continue
+        measure = functools.partial(_measure_async, loop) if is_coroutine else _measure
+        # One untimed call opens connections and fills caches
+        measure(function, 0, 1)
+        latencies = measure(function, args.min_time, args.min_iterations)
+        metrics[name] = {
+            "iterations": len(latencies),
+            "operations_per_second": len(latencies) / (sum(latencies) / 1000),
+            **benchmarks.common.percentiles(latencies),
+        }
+        if args.profile:
+            profile = cProfile.Profile()
+            profile.enable()
+            measure(function, args.min_time, args.min_iterations)
+            profile.disable()
+            profiles[name] = _top_functions(profile, args.profile_limit)
+    loop.close()
+
+    benchmarks.common.write_results(
+        "hot_paths",
+        {
+            "database": args.database,
+            "bcrypt_rounds": configuration.get_config().password_hashing.bcrypt_rounds,
+            "min_time": args.min_time,
+        },
+        metrics,
+        args.output,
+        **({"profiles": profiles} if args.profile else {}),
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Worker cold start benchmark
+
+    python -m benchmarks.startup --runs 5 --top 15 --output startup.json
+
+Imports the module a uvicorn worker loads (`api` by default) in fresh interpreters under `python -X importtime`
+and reports the wall time of each run, the median, and the modules with the highest cumulative import time
+of the median run. Every one of the `CPUS` workers pays this cost on start.
+"""
+import argparse
+import pathlib
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import benchmarks.common
+import configuration
+
+_IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def _parse_import_times(stderr: str) -> list[dict]:
+    modules = []
+    for line in stderr.splitlines():
+        if match := _IMPORT_TIME_LINE.match(line):
+            self_us, cumulative_us, indent, module = match.groups()
+            modules.append({
+                "module": module,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+                "depth": (len(indent) - 1) // 2,
+            })
+    return modules
+
+
+def measure(module: str) -> dict:
+    """
+    Import the module in a fresh interpreter
+    :param module:
+    :return: wall time of the run and the import time of every module it loaded
+    """
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=configuration.ROOT_PATH, capture_output=True, text=True,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    return {"wall_ms": wall_ms, "modules": _parse_import_times(result.stderr)}
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='api')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--output', type=pathlib.Path, help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    # The first run warms the bytecode cache, it is not representative of a worker start
+    measure(args.module)
+    runs = sorted((measure(args.module) for _ in range(args.runs)), key=lambda run: run["wall_ms"])
+    median = runs[len(runs) // 2]
+    top = sorted(median["modules"], key=lambda entry: entry["cumulative_ms"], reverse=True)[:args.top]
+
+    benchmarks.common.write_results(
+        "startup",
+        {"module": args.module, "runs": args.runs},
+        {f"import {args.module}": {
+            "median_ms": statistics.median(run["wall_ms"] for run in runs),
+            "min_ms": runs[0]["wall_ms"],
+            "max_ms": runs[-1]["wall_ms"],
+        }},
+        args.output,
+        top_modules=top,
+    )
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for entry in top:
+        print(f"{entry['cumulative_ms']:>14.1f} {entry['self_ms']:>9.1f}  {entry['module']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
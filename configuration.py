@@ -1,21 +1,18 @@
 """Configuation module"""
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
+import functools
 import pathlib
 from pydantic import BaseModel, model_validator
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, TypeVar
 from enum import StrEnum, auto
-from celery import Celery
 
 
 _module_path = pathlib.Path(__file__).resolve()
 ROOT_PATH = _module_path.parent
-ROOT_PATH.joinpath("cache").mkdir(exist_ok=True)
 CACHE_PATH = ROOT_PATH.joinpath("cache")
-ROOT_PATH.joinpath('media').mkdir(exist_ok=True)
 MEDIA_PATH = ROOT_PATH.joinpath("media")
-MEDIA_PATH.joinpath("audio").mkdir(exist_ok=True)
-MEDIA_PATH.joinpath("images").mkdir(exist_ok=True)
+IMAGES_PATH = MEDIA_PATH.joinpath("images")
 AUDIO_PATH = MEDIA_PATH.joinpath("audio")
 
 _ENV_FILES_PATHS = (
@@ -62,6 +59,38 @@ class DbTypeOptions(CaseInsensitiveEnum):
     POSTGRES = auto()
 
 
+class TraceSamplingOptions(CaseInsensitiveEnum):
+    """Trace sampling options"""
+
+    PARENT_RATIO = auto()
+    TAIL = auto()
+    OFF = auto()
+
+
+class TraceExporterOptions(CaseInsensitiveEnum):
+    """Trace exporter options"""
+
+    OTLP = auto()
+    FILE = auto()
+    MEMORY = auto()
+    NONE = auto()
+
+
+class MessageBrokerOptions(CaseInsensitiveEnum):
+    """Message broker options"""
+
+    RABBITMQ = auto()
+    MEMORY = auto()
+
+
+class ThrottleBackendOptions(CaseInsensitiveEnum):
+    """Login throttling counter backends"""
+
+    SQLITE = auto()
+    REDIS = auto()
+    MEMORY = auto()
+
+
 class SqliteConfig(BaseModel):
     """SQLite configuration"""
 
@@ -72,6 +101,11 @@ class SqliteConfig(BaseModel):
         """Get connection string"""
         return f"sqlite:///{self.file_name if self.file_name else ':memory:'}"
 
+    @property
+    def async_connection_string(self) -> str:
+        """Get aiosqlite connection string"""
+        return f"sqlite+aiosqlite:///{self.file_name if self.file_name else ':memory:'}"
+
     @property
     def is_in_memory(self) -> bool:
         """Check if sqlite is running in memory"""
@@ -92,12 +126,166 @@ class PostgresConfig(BaseModel):
         """Get connection string"""
         return f"postgresql+psycopg2://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
 
+    @property
+    def async_connection_string(self) -> str:
+        """Get asyncpg connection string"""
+        return f"postgresql+asyncpg://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
+
     @property
     def are_all_fields_populated(self):
         """Check if all fields are populated"""
         return self.host and self.port and self.user and self.password and self.database
 
 
+class DbPoolConfig(BaseModel):
+    """DB connection pool configuration"""
+
+    size: int = 5
+    max_overflow: int = 10
+    timeout: int = 30
+    pre_ping: bool = True
+    recycle: int = 1800
+
+
+class PasswordHashingConfig(BaseModel):
+    """Password hashing configuration"""
+
+    bcrypt_rounds: int = 12
+    workers: Optional[int] = None
+    max_pending: int = 64
+    retry_after: int = 1
+
+
+class UserCacheConfig(BaseModel):
+    """Per-worker user cache configuration, its entries count towards `cache__memory_entries`"""
+
+    ttl_seconds: int = 60
+
+
+class CacheConfig(BaseModel):
+    """Two tier cache configuration"""
+
+    default_ttl_seconds: int = 300
+    memory_entries: int = 10000
+    memory_bytes: int = 64 * 1024 * 1024
+    disk_enabled: bool = True
+    disk_file: str = str(CACHE_PATH.joinpath("cache.db"))
+    disk_bytes: int = 512 * 1024 * 1024
+    mmap_bytes: int = 256 * 1024 * 1024
+
+
+class ResponseCacheConfig(BaseModel):
+    """Per-worker response cache configuration"""
+
+    ttl_seconds: int = 3600
+    cache_control: str = "private, no-cache"
+
+
+class LoginThrottlingConfig(BaseModel):
+    """Sign in throttling configuration"""
+
+    enabled: bool = True
+    backend: ThrottleBackendOptions = ThrottleBackendOptions.SQLITE
+    sqlite_file: str = str(CACHE_PATH.joinpath("login_throttling.db"))
+    redis_url: str = "redis://localhost:6379/0"
+    window_seconds: int = 900
+    free_attempts: int = 3
+    ip_free_attempts: int = 30
+    base_backoff_seconds: float = 1
+    max_backoff_seconds: float = 60
+    username_max_failures: int = 10
+    ip_max_failures: int = 100
+    lockout_seconds: int = 900
+
+
+class EmailDispatchConfig(BaseModel):
+    """Transactional email dispatch configuration"""
+
+    batch_size: int = 100
+    rate_per_second: float = 2
+    burst: int = 5
+    max_attempts: int = 6
+    retry_base_seconds: int = 30
+    retry_max_seconds: int = 3600
+    lease_seconds: int = 300
+    timeout_seconds: float = 10
+    dedupe_seconds: int = 600
+    max_batches_per_run: int = 20
+    confirmation_url: str = "http://localhost:3000/confirm-email?token={token}"
+    password_reset_url: str = "http://localhost:3000/reset-password?token={token}"
+
+
+class ImagesConfig(BaseModel):
+    """Image upload and processing configuration"""
+
+    max_upload_bytes: int = 20 * 1024 * 1024
+    max_pixels: int = 50_000_000
+    write_buffer_bytes: int = 1024 * 1024
+    workers: Optional[int] = None
+    max_pending: int = 8
+    variants: Dict[str, int] = {"thumbnail": 256, "medium": 1024, "large": 2048}
+    formats: List[str] = ["webp", "jpeg"]
+    quality: int = 80
+    stale_seconds: int = 300
+
+
+class LlmConfig(BaseModel):
+    """Language model client configuration"""
+
+    model: str = "gpt-4o-mini"
+    temperature: float = 0.7
+    max_tokens: int = 1200
+    # Model calls in flight per worker, the others wait up to queue_timeout_seconds for a slot
+    max_concurrency: int = 4
+    queue_timeout_seconds: float = 30
+    connect_timeout_seconds: float = 5
+    # Longest wait for the next chunk, and for a whole answer
+    read_timeout_seconds: float = 30
+    total_timeout_seconds: float = 120
+    max_retries: int = 2
+    cache_ttl_seconds: int = 30 * 24 * 3600
+    recipe_system_prompt: str = (
+        "You are a cooking assistant. Answer with one recipe: a title, the ingredients with quantities and "
+        "numbered steps."
+    )
+
+
+class SearchConfig(BaseModel):
+    """Full-text search configuration"""
+
+    default_page_size: int = 20
+    max_page_size: int = 100
+    max_terms: int = 8
+    # Words at least this long that match nothing are replaced by known words one edit away
+    typo_min_length: int = 4
+    typo_candidates: int = 5
+
+
+class MediaConfig(BaseModel):
+    """Media serving configuration"""
+
+    cache_bytes: int = 32 * 1024 * 1024
+    cache_file_bytes: int = 128 * 1024
+    chunk_size: int = 256 * 1024
+    immutable_max_age: int = 31536000
+    accel_redirect_prefix: Optional[str] = None
+
+
+class TracingConfig(BaseModel):
+    """OpenTelemetry tracing configuration"""
+
+    sampling: TraceSamplingOptions = TraceSamplingOptions.PARENT_RATIO
+    ratio: float = 1.0
+    slow_request_ms: int = 500
+    exporter: TraceExporterOptions = TraceExporterOptions.OTLP
+    otlp_endpoint: str = "http://jaeger:4318/v1/traces"
+    file_path: str = str(ROOT_PATH.joinpath("logs", "traces.jsonl"))
+    max_queue_size: int = 2048
+    max_export_batch_size: int = 512
+    export_timeout_ms: int = 5000
+    fallback_cooldown_seconds: int = 60
+
+
 class JwtToken(CustomBaseSettings):
     """JWT Token settings"""
 
@@ -106,6 +294,14 @@ class JwtToken(CustomBaseSettings):
     algorithm: str
     secret_key: str
     refresh_secret_key: str
+    refresh_algorithm: str = "HS256"
+    private_key_file: Optional[str] = None
+    public_key_file: Optional[str] = None
+
+    @property
+    def is_asymmetric(self) -> bool:
+        """Check if access tokens are signed with a private/public key pair"""
+        return not self.algorithm.upper().startswith("HS")
 
 
 class CorsSettings(CustomBaseSettings):
@@ -114,6 +310,7 @@ class CorsSettings(CustomBaseSettings):
     allow_origins: List[str]
     allow_methods: List[str]
     allow_headers: List[str]
+    expose_headers: List[str] = ["ETag"]
 
 
 class BrevoSettings(CustomBaseSettings):
@@ -140,6 +337,19 @@ class ServerConfiguration(BaseModel):
 class RabbitmqConfiguration(BaseModel):
     user: str
     password: str
+    host: str = "localhost"
+    port: int = 5672
+    virtual_host: str = "/"
+    broker: MessageBrokerOptions = MessageBrokerOptions.RABBITMQ
+    publisher_channels: int = 4
+    prefetch_count: int = 50
+    ack_batch_size: int = 25
+    ack_interval_ms: int = 200
+    heartbeat: int = 60
+
+    @property
+    def url(self) -> str:
+        return f"amqp://{self.user}:{self.password}@{self.host}:{self.port}/{self.virtual_host.lstrip('/')}"
 
 
 class CelerySettings(BaseModel):
@@ -165,8 +375,22 @@ class Config(CustomBaseSettings):
     context: ContextOptions = ContextOptions.DEV
     database: DbTypeOptions = DbTypeOptions.SQLITE
     log_queries: bool
+    log_queue_size: int = 10000
     sqlite: SqliteConfig
     postgres: PostgresConfig
+    db_pool: DbPoolConfig = DbPoolConfig()
+    password_hashing: PasswordHashingConfig = PasswordHashingConfig()
+    user_cache: UserCacheConfig = UserCacheConfig()
+    cache: CacheConfig = CacheConfig()
+    response_cache: ResponseCacheConfig = ResponseCacheConfig()
+    role_catalog_poll_seconds: int = 30
+    tracing: TracingConfig = TracingConfig()
+    email_dispatch: EmailDispatchConfig = EmailDispatchConfig()
+    images: ImagesConfig = ImagesConfig()
+    media: MediaConfig = MediaConfig()
+    search: SearchConfig = SearchConfig()
+    llm: LlmConfig = LlmConfig()
+    login_throttling: LoginThrottlingConfig = LoginThrottlingConfig()
     server: ServerConfiguration
     rabbitmq: RabbitmqConfiguration
     celery: CelerySettings
@@ -184,10 +408,17 @@ class Config(CustomBaseSettings):
             return self.postgres.connection_string
         return self.sqlite.connection_string
 
+    @property
+    def async_connection_string(self):
+        if self.database == DbTypeOptions.POSTGRES:
+            return self.postgres.async_connection_string
+        return self.sqlite.async_connection_string
+
     @model_validator(mode="after")
     def validate_db_configuration(self):
         if self.database == DbTypeOptions.POSTGRES and not self.postgres.are_all_fields_populated:
             raise ValueError("You have selected postgres as database but did not provide its configuration")
+        return self
 
     def get_celery_broker_url(self) -> str:
         return (
@@ -220,6 +451,7 @@ class Cloudinary(CustomBaseSettings):
 
 class OpenAi(CustomBaseSettings):
     chatgpt_api_key: str
+    chatgpt_api_url: str = "https://api.openai.com/v1"
 
 
 class AppUsers(CustomBaseSettings):
@@ -234,19 +466,57 @@ class AppRecipeCategories(CustomBaseSettings):
     categories: List[str]
 
 
-""" Celery configuration"""
-config = Config()
-
-celery = Celery(
-    __name__,
-    broker=config.get_celery_broker_url(),
-    backend=config.celery.backend,
-    task_serializer=config.celery.task_serializer,
-    result_serializer=config.celery.result_serializer,
-    accept_content=config.celery.accept_content,
-    timezone=config.celery.timezone,
-    enable_utc=config.celery.enable_utc,
-    broker_connection_retry_on_startup=config.celery.broker_connection_retry_on_startup,
-    include=config.celery.include_tasks,
-    beat_schedule=config.get_celery_beat_schedule(),
-)
+SettingsType = TypeVar("SettingsType", bound=CustomBaseSettings)
+
+
+@functools.cache
+def get_settings(settings_class: type[SettingsType]) -> SettingsType:
+    """
+    Return the settings section, the env files are parsed once per section and process
+    :param settings_class:
+    :return:
+    """
+
+    return settings_class()
+
+
+def get_config() -> Config:
+    """Return the base configuration of this process"""
+    return get_settings(Config)
+
+
+@functools.cache
+def ensure_directory(path: pathlib.Path) -> pathlib.Path:
+    """Create the directory on first use"""
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@functools.cache
+def get_celery():
+    """Celery configuration, the app is built on first use"""
+    from celery import Celery
+
+    config = get_config()
+    return Celery(
+        __name__,
+        broker=config.get_celery_broker_url(),
+        backend=config.celery.backend,
+        task_serializer=config.celery.task_serializer,
+        result_serializer=config.celery.result_serializer,
+        accept_content=config.celery.accept_content,
+        timezone=config.celery.timezone,
+        enable_utc=config.celery.enable_utc,
+        broker_connection_retry_on_startup=config.celery.broker_connection_retry_on_startup,
+        include=config.celery.include_tasks,
+        beat_schedule=config.get_celery_beat_schedule(),
+    )
+
+
+def __getattr__(name: str):
+    # Keeps `configuration.config` and `configuration.celery` working without building them at import
+    if name == "config":
+        return get_config()
+    if name == "celery":
+        return get_celery()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,29 +1,150 @@
 """DB connection module"""
+import os
+import threading
+
 import sqlalchemy
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
 import sqlalchemy.orm
+import sqlalchemy.ext.asyncio
 import configuration
 
-config = configuration.Config()
+config = configuration.get_config()
 
 CONNECTION_STRING = config.connection_string
+ASYNC_CONNECTION_STRING = config.async_connection_string
+
+_engines: dict[str, sqlalchemy.Engine] = {}
+_async_engines: dict[str, sqlalchemy.ext.asyncio.AsyncEngine] = {}
+_engines_lock = threading.Lock()
+
+
+# The in-memory database of this process, one shared by the sync and the async engine, so rows written by
+# one of them are seen by the other. It lives as long as a connection to it is open, StaticPool keeps one
+_SHARED_MEMORY_DATABASE = "file:kitchen_helper_{pid}?mode=memory&cache=shared&uri=true"
 
 
-def _get_test_engine() -> sqlalchemy.Engine:
+def _shared_memory_url(connection_string: str) -> str:
+    driver = connection_string.split(":///", 1)[0]
+    return f"{driver}:///{_SHARED_MEMORY_DATABASE.format(pid=os.getpid())}"
+
+
+def _get_test_engine(connection_string: str) -> sqlalchemy.Engine:
     return sqlalchemy.create_engine(
-        CONNECTION_STRING, echo=False, connect_args={"check_same_thread": False}, poolclass=sqlalchemy.StaticPool
+        _shared_memory_url(connection_string), echo=False, connect_args={"check_same_thread": False},
+        poolclass=sqlalchemy.StaticPool,
+    )
+
+
+def _get_async_test_engine(connection_string: str) -> sqlalchemy.ext.asyncio.AsyncEngine:
+    return sqlalchemy.ext.asyncio.create_async_engine(
+        _shared_memory_url(connection_string), echo=False, connect_args={"check_same_thread": False},
+        poolclass=sqlalchemy.StaticPool,
     )
 
 
-def get_engine() -> sqlalchemy.Engine:
+def _is_in_memory() -> bool:
+    return config.database == configuration.DbTypeOptions.SQLITE and config.sqlite.is_in_memory
+
+
+def _pool_options() -> dict:
+    pool = config.db_pool
+    return {
+        "echo": config.log_queries,
+        "pool_size": pool.size,
+        "max_overflow": pool.max_overflow,
+        "pool_timeout": pool.timeout,
+        "pool_pre_ping": pool.pre_ping,
+        "pool_recycle": pool.recycle,
+    }
+
+
+def _create_engine(connection_string: str) -> sqlalchemy.Engine:
+    if _is_in_memory():
+        return _get_test_engine(connection_string)
+    return sqlalchemy.create_engine(connection_string, **_pool_options())
+
+
+def _create_async_engine(connection_string: str) -> sqlalchemy.ext.asyncio.AsyncEngine:
+    if _is_in_memory():
+        return _get_async_test_engine(connection_string)
+    # aiosqlite defaults to NullPool, which would reconnect on every session
+    return sqlalchemy.ext.asyncio.create_async_engine(
+        connection_string, poolclass=sqlalchemy.AsyncAdaptedQueuePool, **_pool_options()
+    )
+
+
+def get_engine(connection_string: str = None) -> sqlalchemy.Engine:
+    """
+    Return the engine for the connection string, creating it once per worker process
+    :param connection_string:
+    :return:
+    """
+
+    connection_string = connection_string or CONNECTION_STRING
+    engine = _engines.get(connection_string)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(connection_string)
+            if engine is None:
+                engine = _engines[connection_string] = _create_engine(connection_string)
+    return engine
+
+
+def get_async_engine(connection_string: str = None) -> sqlalchemy.ext.asyncio.AsyncEngine:
+    """
+    Return the async engine for the connection string, creating it once per worker process
+    :param connection_string:
+    :return:
+    """
+
+    connection_string = connection_string or ASYNC_CONNECTION_STRING
+    engine = _async_engines.get(connection_string)
+    if engine is None:
+        with _engines_lock:
+            engine = _async_engines.get(connection_string)
+            if engine is None:
+                engine = _async_engines[connection_string] = _create_async_engine(connection_string)
+    return engine
+
+
+def dispose_engines():
+    """
+    Close the pooled connections of every registered engine and clear the registry
+    :return:
+    """
+
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+async def dispose_async_engines():
     """
-    Return engine
+    Close the pooled connections of every registered async engine and clear the registry
     :return:
     """
 
-    echo = config.log_queries
-    if config.database == configuration.DbTypeOptions.SQLITE and config.sqlite.is_in_memory:
-        return _get_test_engine()
-    return sqlalchemy.create_engine(CONNECTION_STRING, echo=echo)
+    engines = list(_async_engines.values())
+    _async_engines.clear()
+    for engine in engines:
+        await engine.dispose()
+
+
+def _reset_engines_after_fork():
+    # A forked worker must not reuse sockets owned by the parent process
+    global _engines_lock
+    _engines_lock = threading.Lock()
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.clear()
+    for engine in _async_engines.values():
+        engine.sync_engine.dispose(close=False)
+    _async_engines.clear()
+
+
+os.register_at_fork(after_in_child=_reset_engines_after_fork)
 
 
 def get_connection(engine: sqlalchemy.Engine = None) -> sqlalchemy.Connection:
@@ -49,3 +170,27 @@ def get_session(engine: sqlalchemy.Engine = None) -> sqlalchemy.orm.Session:
     if not engine:
         engine = get_engine()
     return sqlalchemy.orm.Session(bind=engine, autocommit=False, autoflush=False)
+
+
+def get_async_session(engine: sqlalchemy.ext.asyncio.AsyncEngine = None) -> sqlalchemy.ext.asyncio.AsyncSession:
+    """
+    Get async session
+    :param engine:
+    :return:
+    """
+
+    if not engine:
+        engine = get_async_engine()
+    return sqlalchemy.ext.asyncio.AsyncSession(bind=engine, autoflush=False, expire_on_commit=False)
+
+
+def get_insert(model):
+    """
+    Return the dialect specific insert, which supports ON CONFLICT clauses
+    :param model:
+    :return:
+    """
+
+    if config.database == configuration.DbTypeOptions.POSTGRES:
+        return sqlalchemy.dialects.postgresql.insert(model)
+    return sqlalchemy.dialects.sqlite.insert(model)
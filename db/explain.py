@@ -0,0 +1,128 @@
+"""Query plan regression check
+
+    python -m db.explain
+
+Runs a scenario through the sync operations, captures every statement they execute and runs it again
+under EXPLAIN (SQLite `EXPLAIN QUERY PLAN`, Postgres `EXPLAIN` with sequential scans disabled). Exits with
+status 1 when a filtered statement has to scan a whole table, statements without a WHERE clause read the
+whole table by design and are only reported.
+
+tests/test_query_plans.py runs it in CI against the in-memory test database. Run as a module it writes to the
+configured database, point it at a scratch database when checking Postgres.
+"""
+import re
+import sys
+import uuid
+
+import sqlalchemy
+
+import db.connection
+import db.models
+
+# SQLite before 3.36 words it `SCAN TABLE x`
+_SQLITE_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+_POSTGRES_FULL_SCAN = re.compile(r"Seq Scan on (\w+)")
+_EXPLAINED_STATEMENTS = ("SELECT", "UPDATE", "DELETE")
+
+
+def _run_scenario():
+    import operations.emails
+    import operations.images
+    import operations.refresh_tokens
+    import operations.roles
+    import operations.search
+    import operations.users
+
+    suffix = uuid.uuid4().hex[:8]
+    admin = operations.users.create_user("Explain", "Admin", f"admin-{suffix}@explain", f"1{suffix}", "Password1@")
+    role = operations.roles.create_role(f"EXPLAIN-{suffix}", admin.id)
+    operations.users.add_user_to_role(admin.id, role.id, admin.id)
+    report = operations.users.bulk_create_users([
+        {"first_name": "Bulk", "last_name": str(index), "email": f"bulk-{index}-{suffix}@explain", "password": "pw"}
+        for index in range(3)
+    ])
+    operations.users.bulk_add_users_to_role([entry["id"] for entry in report], role.id, admin.id)
+
+    operations.users.get_user(user_id=admin.id)
+    operations.users.get_user(email=admin.email)
+    operations.users.get_user(phone_number=admin.phone_number)
+    _, refresh_token = operations.users.sign_in(admin.email, "Password1@")
+    operations.users.refresh_tokens(refresh_token)
+    operations.users.has_users()
+    operations.users.count_users()
+    _, after = operations.users.list_users_page(limit=2)
+    operations.users.list_users_page(after, limit=2)
+    list(operations.users.iter_users(batch_size=2))
+    operations.users.update_user(admin.id, "first_name", "Explained")
+    operations.users.remove_user_from_role(admin.id, role.id)
+    operations.roles.refresh_role_catalog()
+    operations.emails.queue_confirmation_email(admin)
+    operations.emails._claim_batch(1)
+    operations.refresh_tokens.revoke_user_refresh_tokens(admin.id)
+    operations.refresh_tokens.delete_expired_refresh_tokens()
+    operations.images.process_pending_images()
+    operations.search.index_document(operations.search.RECIPE, admin.id, "Explained tomato soup", "tomatoes basil")
+    operations.search.search("tomat soup", [operations.search.RECIPE])
+    operations.search.search("tomatos")
+    operations.search.remove_document(operations.search.RECIPE, admin.id)
+
+
+def _capture(engine: sqlalchemy.Engine) -> list[tuple[str, object]]:
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(_EXPLAINED_STATEMENTS) and not executemany:
+            statements.append((statement, parameters))
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        _run_scenario()
+    finally:
+        sqlalchemy.event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+
+def _full_scans(connection: sqlalchemy.Connection, statement: str, parameters) -> tuple[list[str], list[str]]:
+    if connection.dialect.name == "postgresql":
+        plan = [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}", parameters)]
+        return plan, [match.group(1) for line in plan if (match := _POSTGRES_FULL_SCAN.search(line))]
+
+    plan = [row[3] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+    return plan, [match.group(1) for line in plan if (match := _SQLITE_FULL_SCAN.match(line))]
+
+
+def check() -> int:
+    """
+    Run the scenario and EXPLAIN every captured statement
+    :return: number of filtered statements that need a full table scan
+    """
+
+    engine = db.connection.get_engine()
+    db.models.DbBaseModel.metadata.create_all(engine)
+
+    failures = 0
+    seen = set()
+    with engine.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql("SET enable_seqscan = off")
+        for statement, parameters in _capture(engine):
+            if statement in seen:
+                continue
+            seen.add(statement)
+
+            plan, scanned_tables = _full_scans(connection, statement, parameters)
+            filtered = " WHERE " in statement.upper()
+            status = "FULL SCAN" if scanned_tables and filtered else "ok"
+            if status != "ok":
+                failures += 1
+            sys.stdout.write(f"[{status}] {' '.join(statement.split())}\n")
+            for line in plan:
+                sys.stdout.write(f"    {line}\n")
+        connection.rollback()
+    return failures
+
+
+if __name__ == '__main__':
+    if (failures := check()):
+        sys.stderr.write(f"{failures} statement(s) scan a whole table\n")
+    sys.exit(1 if failures else 0)
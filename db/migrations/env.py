@@ -26,7 +26,7 @@ target_metadata = models.DbBaseModel.metadata
 
 Path(f"{config.get_section_option('alembic', 'script_location')}/versions").mkdir(exist_ok=True)
 
-config.set_main_option('sqlalchemy.url', configuration.Config().connection_string)
+config.set_main_option('sqlalchemy.url', configuration.get_config().connection_string)
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
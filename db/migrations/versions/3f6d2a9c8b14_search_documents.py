@@ -0,0 +1,88 @@
+"""Search documents and terms
+
+Revision ID: 3f6d2a9c8b14
+Revises: e81b4c7a3d25
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f6d2a9c8b14'
+down_revision: Union[str, None] = 'e81b4c7a3d25'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SQLITE_UPGRADE = (
+    "CREATE VIRTUAL TABLE search_index USING fts5("
+    "title, body, tags, content='search_documents', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER search_documents_ai AFTER INSERT ON search_documents BEGIN "
+    "INSERT INTO search_index(rowid, title, body, tags) VALUES (new.id, new.title, new.body, new.tags); END",
+    "CREATE TRIGGER search_documents_ad AFTER DELETE ON search_documents BEGIN "
+    "INSERT INTO search_index(search_index, rowid, title, body, tags) "
+    "VALUES ('delete', old.id, old.title, old.body, old.tags); END",
+    "CREATE TRIGGER search_documents_au AFTER UPDATE ON search_documents BEGIN "
+    "INSERT INTO search_index(search_index, rowid, title, body, tags) "
+    "VALUES ('delete', old.id, old.title, old.body, old.tags); "
+    "INSERT INTO search_index(rowid, title, body, tags) VALUES (new.id, new.title, new.body, new.tags); END",
+)
+SQLITE_DOWNGRADE = (
+    "DROP TRIGGER IF EXISTS search_documents_au",
+    "DROP TRIGGER IF EXISTS search_documents_ad",
+    "DROP TRIGGER IF EXISTS search_documents_ai",
+    "DROP TABLE IF EXISTS search_index",
+)
+POSTGRES_UPGRADE = (
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    "CREATE OR REPLACE FUNCTION search_unaccent(text) RETURNS text LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT "
+    "AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$",
+    "ALTER TABLE search_documents ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', search_unaccent(title)), 'A') || "
+    "setweight(to_tsvector('simple', search_unaccent(tags)), 'B') || "
+    "setweight(to_tsvector('simple', search_unaccent(body)), 'C')) STORED",
+    "CREATE INDEX ix_search_documents_search_vector ON search_documents USING GIN (search_vector)",
+)
+
+
+def upgrade() -> None:
+    op.create_table(
+        'search_documents',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('document_id', sa.String(length=36), nullable=False),
+        sa.Column('title', sa.String(length=255), nullable=False),
+        sa.Column('body', sa.Text(), server_default='', nullable=False),
+        sa.Column('tags', sa.String(length=500), server_default='', nullable=False),
+        sa.Column('updated_on', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('kind', 'document_id')
+    )
+    op.create_table(
+        'search_terms',
+        sa.Column('term', sa.String(length=64), nullable=False),
+        sa.Column('initial', sa.String(length=1), nullable=False),
+        sa.Column('length', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('term')
+    )
+    op.create_index('ix_search_terms_initial_length', 'search_terms', ['initial', 'length'], unique=False)
+    dialect = op.get_bind().dialect.name
+    for statement in SQLITE_UPGRADE if dialect == 'sqlite' else POSTGRES_UPGRADE:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        for statement in SQLITE_DOWNGRADE:
+            op.execute(statement)
+    else:
+        op.drop_index('ix_search_documents_search_vector', table_name='search_documents')
+    op.drop_index('ix_search_terms_initial_length', table_name='search_terms')
+    op.drop_table('search_terms')
+    op.drop_table('search_documents')
+    if op.get_bind().dialect.name != 'sqlite':
+        op.execute("DROP FUNCTION IF EXISTS search_unaccent(text)")
@@ -0,0 +1,51 @@
+"""Email outbox
+
+Revision ID: 5b2e8c1f9a47
+Revises: c4f1a9d2b7e3
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b2e8c1f9a47'
+down_revision: Union[str, None] = 'c4f1a9d2b7e3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'email_outbox',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('idempotency_key', sa.String(length=64), nullable=False),
+        sa.Column('kind', sa.String(length=30), nullable=False),
+        sa.Column('recipient_email', sa.String(length=255), nullable=False),
+        sa.Column('recipient_name', sa.String(length=61), nullable=False),
+        sa.Column('params', sa.JSON(), nullable=False),
+        sa.Column('user_id', sa.String(length=36), nullable=True),
+        sa.Column('status', sa.String(length=10), server_default='pending', nullable=False),
+        sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('next_attempt_on', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+        sa.Column('last_error', sa.String(length=500), nullable=True),
+        sa.Column('provider_message_id', sa.String(length=255), nullable=True),
+        sa.Column('created_on', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+        sa.Column('sent_on', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('idempotency_key')
+    )
+    op.create_index('ix_email_outbox_user_id', 'email_outbox', ['user_id'], unique=False)
+    op.create_index(
+        'ix_email_outbox_status_next_attempt_on', 'email_outbox', ['status', 'next_attempt_on'], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_email_outbox_status_next_attempt_on', table_name='email_outbox')
+    op.drop_index('ix_email_outbox_user_id', table_name='email_outbox')
+    op.drop_table('email_outbox')
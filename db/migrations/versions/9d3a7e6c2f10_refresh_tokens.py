@@ -0,0 +1,44 @@
+"""Refresh tokens
+
+Revision ID: 9d3a7e6c2f10
+Revises: 5b2e8c1f9a47
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d3a7e6c2f10'
+down_revision: Union[str, None] = '5b2e8c1f9a47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'refresh_tokens',
+        sa.Column('jti', sa.String(length=36), nullable=False),
+        sa.Column('family_id', sa.String(length=36), nullable=False),
+        sa.Column('user_id', sa.String(length=36), nullable=False),
+        sa.Column('expires_on', sa.DateTime(), nullable=False),
+        sa.Column('issued_on', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+        sa.Column('replaced_by', sa.String(length=36), nullable=True),
+        sa.Column('used_on', sa.DateTime(), nullable=True),
+        sa.Column('revoked_on', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('jti')
+    )
+    op.create_index('ix_refresh_tokens_family_id', 'refresh_tokens', ['family_id'], unique=False)
+    op.create_index('ix_refresh_tokens_user_id', 'refresh_tokens', ['user_id'], unique=False)
+    op.create_index('ix_refresh_tokens_expires_on', 'refresh_tokens', ['expires_on'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_refresh_tokens_expires_on', table_name='refresh_tokens')
+    op.drop_index('ix_refresh_tokens_user_id', table_name='refresh_tokens')
+    op.drop_index('ix_refresh_tokens_family_id', table_name='refresh_tokens')
+    op.drop_table('refresh_tokens')
@@ -0,0 +1,58 @@
+"""Role catalog version
+
+Revision ID: a7c3e5f1d9b2
+Revises: 3f6d2a9c8b14
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c3e5f1d9b2'
+down_revision: Union[str, None] = '3f6d2a9c8b14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SQLITE_UPGRADE = tuple(
+    f"CREATE TRIGGER roles_version_{suffix} AFTER {event_name} ON roles BEGIN "
+    "UPDATE role_catalog_version SET version = version + 1; END"
+    for suffix, event_name in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE"))
+)
+SQLITE_DOWNGRADE = (
+    "DROP TRIGGER IF EXISTS roles_version_ad",
+    "DROP TRIGGER IF EXISTS roles_version_au",
+    "DROP TRIGGER IF EXISTS roles_version_ai",
+)
+POSTGRES_UPGRADE = (
+    "CREATE OR REPLACE FUNCTION bump_role_catalog_version() RETURNS trigger LANGUAGE plpgsql AS "
+    "$$ BEGIN UPDATE role_catalog_version SET version = version + 1; RETURN NULL; END $$",
+    "CREATE TRIGGER roles_version AFTER INSERT OR UPDATE OR DELETE ON roles "
+    "FOR EACH STATEMENT EXECUTE FUNCTION bump_role_catalog_version()",
+)
+POSTGRES_DOWNGRADE = (
+    "DROP TRIGGER IF EXISTS roles_version ON roles",
+    "DROP FUNCTION IF EXISTS bump_role_catalog_version()",
+)
+
+
+def upgrade() -> None:
+    op.create_table(
+        'role_catalog_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.execute("INSERT INTO role_catalog_version (id, version) VALUES (1, 0)")
+    dialect = op.get_bind().dialect.name
+    for statement in SQLITE_UPGRADE if dialect == 'sqlite' else POSTGRES_UPGRADE:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    for statement in SQLITE_DOWNGRADE if op.get_bind().dialect.name == 'sqlite' else POSTGRES_DOWNGRADE:
+        op.execute(statement)
+    op.drop_table('role_catalog_version')
@@ -0,0 +1,42 @@
+"""Hot path indexes
+
+Revision ID: c4f1a9d2b7e3
+Revises: 87812312ee62
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4f1a9d2b7e3'
+down_revision: Union[str, None] = '87812312ee62'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column(
+            'phone_number', existing_type=sa.String(length=255), type_=sa.String(length=32), existing_nullable=True
+        )
+    op.create_index('ix_users_updated_by', 'users', ['updated_by'], unique=False)
+    op.create_index('ix_users_updated_on_id', 'users', ['updated_on', 'id'], unique=False)
+    op.create_index('ix_roles_created_by', 'roles', ['created_by'], unique=False)
+    op.create_index('ix_user_roles_role_id', 'user_roles', ['role_id'], unique=False)
+    op.create_index('ix_user_roles_added_by', 'user_roles', ['added_by'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_roles_added_by', table_name='user_roles')
+    op.drop_index('ix_user_roles_role_id', table_name='user_roles')
+    op.drop_index('ix_roles_created_by', table_name='roles')
+    op.drop_index('ix_users_updated_on_id', table_name='users')
+    op.drop_index('ix_users_updated_by', table_name='users')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column(
+            'phone_number', existing_type=sa.String(length=32), type_=sa.String(length=255), existing_nullable=True
+        )
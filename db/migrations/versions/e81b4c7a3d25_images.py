@@ -0,0 +1,46 @@
+"""Images
+
+Revision ID: e81b4c7a3d25
+Revises: 9d3a7e6c2f10
+Create Date: 2026-10-17 23:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e81b4c7a3d25'
+down_revision: Union[str, None] = '9d3a7e6c2f10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'images',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('content_hash', sa.String(length=64), nullable=False),
+        sa.Column('content_type', sa.String(length=30), nullable=False),
+        sa.Column('size_bytes', sa.Integer(), nullable=False),
+        sa.Column('uploaded_by', sa.String(length=36), nullable=True),
+        sa.Column('status', sa.String(length=10), server_default='pending', nullable=False),
+        sa.Column('width', sa.Integer(), nullable=True),
+        sa.Column('height', sa.Integer(), nullable=True),
+        sa.Column('variants', sa.JSON(), nullable=False),
+        sa.Column('created_on', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+        sa.Column('processed_on', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['uploaded_by'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('content_hash')
+    )
+    op.create_index('ix_images_uploaded_by', 'images', ['uploaded_by'], unique=False)
+    op.create_index('ix_images_status_created_on', 'images', ['status', 'created_on'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_images_status_created_on', table_name='images')
+    op.drop_index('ix_images_uploaded_by', table_name='images')
+    op.drop_table('images')
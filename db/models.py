@@ -1,7 +1,9 @@
 import datetime
 import uuid
 
-from sqlalchemy import String, Integer, Boolean, ForeignKey, DateTime, func
+from sqlalchemy import (
+    DDL, String, Integer, Boolean, ForeignKey, DateTime, Index, JSON, Text, UniqueConstraint, event, func
+)
 from sqlalchemy.orm import DeclarativeBase, MappedAsDataclass, Mapped, mapped_column, relationship
 
 
@@ -21,12 +23,12 @@ class UserRole(DbBaseModel):
         String(36), ForeignKey("users.id", ondelete="RESTRICT"), primary_key=True
     )
     role_id: Mapped[str] = mapped_column(
-        String(36), ForeignKey("roles.id", ondelete="RESTRICT"), primary_key=True
+        String(36), ForeignKey("roles.id", ondelete="RESTRICT"), primary_key=True, index=True
     )
 
     role: Mapped['Role'] = relationship(lazy='selectin', init=False)
 
-    added_by: Mapped[str] = mapped_column(ForeignKey("users.id"), nullable=True)
+    added_by: Mapped[str] = mapped_column(ForeignKey("users.id"), nullable=True, index=True)
     added_on: Mapped[datetime.datetime] = mapped_column(
         DateTime, server_default=func.current_timestamp(), init=False
     )
@@ -39,12 +41,13 @@ class User(DbBaseModel):
     """User DB model"""
 
     __tablename__ = "users"
+    __table_args__ = (Index("ix_users_updated_on_id", "updated_on", "id"),)
 
     id: Mapped[str] = mapped_column(String(36), primary_key=True, default_factory=_uuid_primary_key, init=False)
     first_name: Mapped[str] = mapped_column(String(30))
     last_name: Mapped[str] = mapped_column(String(30))
     email: Mapped[str | None] = mapped_column(String(255), unique=True, nullable=True)
-    phone_number: Mapped[int | None] = mapped_column(String(255), unique=True, nullable=True)
+    phone_number: Mapped[str | None] = mapped_column(String(32), unique=True, nullable=True)
     password: Mapped[str] = mapped_column(String(100))
     role: Mapped['UserRole'] = relationship(foreign_keys=[UserRole.user_id], lazy='selectin', init=False)
     is_email_confirmed: Mapped[bool] = mapped_column(
@@ -53,8 +56,8 @@ class User(DbBaseModel):
     is_phone_confirmed: Mapped[bool] = mapped_column(
         Boolean, default=False, server_default="FALSE"
     )
-    updated_by: Mapped[int | None] = mapped_column(
-        ForeignKey("users.id"), nullable=True, init=False
+    updated_by: Mapped[str | None] = mapped_column(
+        ForeignKey("users.id"), nullable=True, init=False, index=True
     )
     updated_on: Mapped[datetime.datetime] = mapped_column(
         DateTime,
@@ -86,5 +89,168 @@ class Role(DbBaseModel):
     created_on: Mapped[datetime.datetime] = mapped_column(
         DateTime, server_default=func.current_timestamp(), init=False
     )
-    created_by: Mapped[str] = mapped_column(ForeignKey("users.id"), nullable=True)
+    created_by: Mapped[str] = mapped_column(ForeignKey("users.id"), nullable=True, index=True)
 
+
+class RoleCatalogVersion(DbBaseModel):
+    """Single row counting the writes to roles, the role catalog of a worker is stale when it differs"""
+
+    __tablename__ = "role_catalog_version"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+
+# Triggers count every insert, update and delete of roles, whichever code or SQL console made it
+SQLITE_ROLE_VERSION_DDL = tuple(
+    f"CREATE TRIGGER roles_version_{suffix} AFTER {event_name} ON roles BEGIN "
+    "UPDATE role_catalog_version SET version = version + 1; END"
+    for suffix, event_name in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE"))
+)
+POSTGRES_ROLE_VERSION_DDL = (
+    "CREATE OR REPLACE FUNCTION bump_role_catalog_version() RETURNS trigger LANGUAGE plpgsql AS "
+    "$$ BEGIN UPDATE role_catalog_version SET version = version + 1; RETURN NULL; END $$",
+    "CREATE TRIGGER roles_version AFTER INSERT OR UPDATE OR DELETE ON roles "
+    "FOR EACH STATEMENT EXECUTE FUNCTION bump_role_catalog_version()",
+)
+ROLE_VERSION_SEED = "INSERT INTO role_catalog_version (id, version) VALUES (1, 0)"
+
+event.listen(RoleCatalogVersion.__table__, "after_create", DDL(ROLE_VERSION_SEED))
+for _statement in SQLITE_ROLE_VERSION_DDL:
+    event.listen(Role.__table__, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+for _statement in POSTGRES_ROLE_VERSION_DDL:
+    event.listen(Role.__table__, "after_create", DDL(_statement).execute_if(dialect="postgresql"))
+
+
+class RefreshToken(DbBaseModel):
+    """Issued refresh token, tokens rotated from the same sign in share a family"""
+
+    __tablename__ = "refresh_tokens"
+
+    jti: Mapped[str] = mapped_column(String(36), primary_key=True)
+    family_id: Mapped[str] = mapped_column(String(36), index=True)
+    user_id: Mapped[str] = mapped_column(ForeignKey("users.id"), index=True)
+    expires_on: Mapped[datetime.datetime] = mapped_column(DateTime, index=True)
+    issued_on: Mapped[datetime.datetime] = mapped_column(
+        DateTime, server_default=func.current_timestamp(), init=False
+    )
+    replaced_by: Mapped[str | None] = mapped_column(String(36), nullable=True, default=None)
+    used_on: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True, default=None)
+    revoked_on: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True, default=None)
+
+
+class EmailOutbox(DbBaseModel):
+    """Transactional email waiting to be sent, or the record of its sending"""
+
+    __tablename__ = "email_outbox"
+    __table_args__ = (Index("ix_email_outbox_status_next_attempt_on", "status", "next_attempt_on"),)
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default_factory=_uuid_primary_key, init=False)
+    idempotency_key: Mapped[str] = mapped_column(String(64), unique=True)
+    kind: Mapped[str] = mapped_column(String(30))
+    recipient_email: Mapped[str] = mapped_column(String(255))
+    recipient_name: Mapped[str] = mapped_column(String(61))
+    params: Mapped[dict] = mapped_column(JSON)
+    user_id: Mapped[str | None] = mapped_column(ForeignKey("users.id"), nullable=True, index=True)
+    status: Mapped[str] = mapped_column(String(10), default="pending", server_default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    next_attempt_on: Mapped[datetime.datetime] = mapped_column(
+        DateTime, server_default=func.current_timestamp(), init=False
+    )
+    last_error: Mapped[str | None] = mapped_column(String(500), nullable=True, default=None)
+    provider_message_id: Mapped[str | None] = mapped_column(String(255), nullable=True, default=None)
+    created_on: Mapped[datetime.datetime] = mapped_column(
+        DateTime, server_default=func.current_timestamp(), init=False
+    )
+    sent_on: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True, default=None)
+
+
+class Image(DbBaseModel):
+    """Uploaded image, stored once per content hash with its generated variants"""
+
+    __tablename__ = "images"
+    __table_args__ = (Index("ix_images_status_created_on", "status", "created_on"),)
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default_factory=_uuid_primary_key, init=False)
+    content_hash: Mapped[str] = mapped_column(String(64), unique=True)
+    content_type: Mapped[str] = mapped_column(String(30))
+    size_bytes: Mapped[int] = mapped_column(Integer)
+    uploaded_by: Mapped[str | None] = mapped_column(ForeignKey("users.id"), nullable=True, index=True)
+    status: Mapped[str] = mapped_column(String(10), default="pending", server_default="pending")
+    width: Mapped[int | None] = mapped_column(Integer, nullable=True, default=None)
+    height: Mapped[int | None] = mapped_column(Integer, nullable=True, default=None)
+    variants: Mapped[list] = mapped_column(JSON, default_factory=list)
+    created_on: Mapped[datetime.datetime] = mapped_column(
+        DateTime, server_default=func.current_timestamp(), init=False
+    )
+    processed_on: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True, default=None)
+
+
+class SearchDocument(DbBaseModel):
+    """
+    Searchable text of a recipe, ingredient or category. SQLite indexes the rows in the `search_index` FTS5
+    table kept in sync by triggers, Postgres in the generated `search_vector` column, see the DDL below
+    """
+
+    __tablename__ = "search_documents"
+    __table_args__ = (UniqueConstraint("kind", "document_id"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True, init=False)
+    kind: Mapped[str] = mapped_column(String(20))
+    document_id: Mapped[str] = mapped_column(String(36))
+    title: Mapped[str] = mapped_column(String(255))
+    body: Mapped[str] = mapped_column(Text, default="", server_default="")
+    tags: Mapped[str] = mapped_column(String(500), default="", server_default="")
+    updated_on: Mapped[datetime.datetime] = mapped_column(
+        DateTime, server_default=func.current_timestamp(), onupdate=func.current_timestamp(), init=False
+    )
+
+
+class SearchTerm(DbBaseModel):
+    """Words of the indexed documents, looked up by first character and length to correct typos"""
+
+    __tablename__ = "search_terms"
+    __table_args__ = (Index("ix_search_terms_initial_length", "initial", "length"),)
+
+    term: Mapped[str] = mapped_column(String(64), primary_key=True)
+    initial: Mapped[str] = mapped_column(String(1))
+    length: Mapped[int] = mapped_column(Integer)
+
+
+# Columns of search_index are title, body, tags. External content: the text is only stored in search_documents
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE search_index USING fts5("
+    "title, body, tags, content='search_documents', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER search_documents_ai AFTER INSERT ON search_documents BEGIN "
+    "INSERT INTO search_index(rowid, title, body, tags) VALUES (new.id, new.title, new.body, new.tags); END",
+    "CREATE TRIGGER search_documents_ad AFTER DELETE ON search_documents BEGIN "
+    "INSERT INTO search_index(search_index, rowid, title, body, tags) "
+    "VALUES ('delete', old.id, old.title, old.body, old.tags); END",
+    "CREATE TRIGGER search_documents_au AFTER UPDATE ON search_documents BEGIN "
+    "INSERT INTO search_index(search_index, rowid, title, body, tags) "
+    "VALUES ('delete', old.id, old.title, old.body, old.tags); "
+    "INSERT INTO search_index(rowid, title, body, tags) VALUES (new.id, new.title, new.body, new.tags); END",
+)
+# 'simple' does not stem, like the unicode61 tokenizer. unaccent strips the diacritics SQLite keeps too, e.g. of
+# Cyrillic ё, so the query goes through search_unaccent as well. A generated column needs an immutable function,
+# unaccent is only stable because its dictionary can be changed. Title words are weighted A, tags B and body C,
+# a query restricted to A only matches titles
+POSTGRES_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    "CREATE OR REPLACE FUNCTION search_unaccent(text) RETURNS text LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT "
+    "AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$",
+    "ALTER TABLE search_documents ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', search_unaccent(title)), 'A') || "
+    "setweight(to_tsvector('simple', search_unaccent(tags)), 'B') || "
+    "setweight(to_tsvector('simple', search_unaccent(body)), 'C')) STORED",
+    "CREATE INDEX ix_search_documents_search_vector ON search_documents USING GIN (search_vector)",
+)
+
+for _statement in SQLITE_SEARCH_DDL:
+    event.listen(SearchDocument.__table__, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+for _statement in POSTGRES_SEARCH_DDL:
+    event.listen(SearchDocument.__table__, "after_create", DDL(_statement).execute_if(dialect="postgresql"))
+event.listen(
+    SearchDocument.__table__, "before_drop", DDL("DROP TABLE IF EXISTS search_index").execute_if(dialect="sqlite")
+)
@@ -0,0 +1,13 @@
+"""Roles dependencies"""
+from typing import Annotated
+
+import fastapi
+
+import operations.roles
+
+
+def get_role_catalog() -> operations.roles.RoleCatalog:
+    return operations.roles.get_role_catalog()
+
+
+RoleCatalog = Annotated[operations.roles.RoleCatalog, fastapi.Depends(get_role_catalog)]
@@ -0,0 +1,81 @@
+"""Users dependencies"""
+from typing import Annotated
+
+import fastapi
+import pydantic
+from fastapi.security import OAuth2PasswordBearer
+from jose import JWTError, ExpiredSignatureError
+
+import db.models
+import operations.tokens
+import operations.users
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/api/users/sign-in')
+
+
+class Principal(pydantic.BaseModel):
+    """Authenticated caller built from the access token claims"""
+
+    id: str
+    role: str | None = None
+
+
+def _unauthorized(detail: str) -> fastapi.HTTPException:
+    return fastapi.HTTPException(
+        status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+async def get_current_principal(token: Annotated[str, fastapi.Depends(oauth2_scheme)]) -> Principal:
+    """
+    Resolve the caller from the access token alone, no database round-trip
+    :param token:
+    :return:
+    """
+
+    try:
+        claims = operations.tokens.decode_access_token(token)
+    except ExpiredSignatureError:
+        raise _unauthorized("Access token expired")
+    except JWTError:
+        raise _unauthorized("Invalid access token")
+
+    return Principal(id=claims["sub"], role=claims.get("role"))
+
+
+async def get_current_user(principal: Annotated[Principal, fastapi.Depends(get_current_principal)]) -> db.models.User:
+    """
+    Resolve the full user profile, only for routes that need more than the principal
+    :param principal:
+    :return:
+    """
+
+    if user := await operations.users.get_cached_user_async(principal.id):
+        return user
+    raise _unauthorized("User does not exist")
+
+
+def require_role(*roles: str):
+    """
+    Build a dependency that lets through only callers with one of the given roles
+    :param roles:
+    :return:
+    """
+
+    allowed = {role.lower() for role in roles}
+
+    async def _require_role(principal: Annotated[Principal, fastapi.Depends(get_current_principal)]) -> Principal:
+        if not principal.role or principal.role.lower() not in allowed:
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_403_FORBIDDEN,
+                detail="Not enough permissions",
+            )
+        return principal
+
+    return _require_role
+
+
+CurrentPrincipal = Annotated[Principal, fastapi.Depends(get_current_principal)]
+CurrentUser = Annotated[db.models.User, fastapi.Depends(get_current_user)]
@@ -0,0 +1,6 @@
+class ImageTooLargeException(Exception):
+    ...
+
+
+class UnsupportedImageTypeException(Exception):
+    ...
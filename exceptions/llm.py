@@ -0,0 +1,6 @@
+class LlmUnavailableException(Exception):
+    ...
+
+
+class LlmRequestException(Exception):
+    ...
@@ -0,0 +1,6 @@
+class MessageBrokerUnavailableException(Exception):
+    ...
+
+
+class MessageNotConfirmedException(Exception):
+    ...
@@ -0,0 +1,2 @@
+class PasswordHashingOverloadedException(Exception):
+    ...
@@ -0,0 +1,5 @@
+class LoginThrottledException(Exception):
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many failed sign in attempts, retry after {retry_after:.0f} seconds")
+        self.retry_after = retry_after
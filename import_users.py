@@ -0,0 +1,67 @@
+"""Bulk import users from a CSV or JSONL file
+
+    python import_users.py partners.csv --role PARTNER --added-by <admin user id>
+
+CSV files need a header row with first_name, last_name, email, phone_number and password columns,
+JSONL files one object per line with the same keys. The per row report is written to stdout as JSON lines, with
+the outcome of the role assignment in `role_status` when --role is given.
+"""
+import argparse
+import csv
+import json
+import pathlib
+import sys
+
+import operations.roles
+import operations.users
+
+
+def _read_rows(path: pathlib.Path, file_format: str) -> list[dict]:
+    with path.open(encoding='utf-8', newline='') as file:
+        if file_format == 'csv':
+            return list(csv.DictReader(file))
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', type=pathlib.Path)
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help="defaults to the file extension")
+    parser.add_argument('--role', help="name of the role to assign to the created users")
+    parser.add_argument('--added-by', help="id of the user recorded as assigning the role, required with --role")
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    file_format = args.format or ('csv' if args.path.suffix.lower() == '.csv' else 'jsonl')
+    role = None
+    if args.role:
+        if not args.added_by:
+            parser.error("--role needs --added-by")
+        if not (role := operations.roles.get_role_by_name(args.role)):
+            parser.error(f"Role {args.role} does not exist")
+        if not operations.users.get_user_by_id(args.added_by):
+            parser.error(f"User {args.added_by} does not exist")
+
+    report = operations.users.bulk_create_users(_read_rows(args.path, file_format), batch_size=args.batch_size)
+    created = [entry["id"] for entry in report if entry["status"] == "created"]
+    if role:
+        role_report = operations.users.bulk_add_users_to_role(
+            created, role.id, args.added_by, batch_size=args.batch_size
+        )
+        role_statuses = {entry["user_id"]: entry["status"] for entry in role_report}
+        for entry in report:
+            if entry["status"] == "created":
+                entry["role_status"] = role_statuses[entry["id"]]
+
+    for entry in report:
+        sys.stdout.write(json.dumps(entry) + "\n")
+
+    statuses = [entry["status"] for entry in report]
+    summary = ", ".join(f"{status}: {statuses.count(status)}" for status in sorted(set(statuses)))
+    sys.stderr.write(f"{len(report)} rows ({summary})\n")
+    all_assigned = all(entry.get("role_status", "added") == "added" for entry in report)
+    return 0 if len(created) == len(report) and all_assigned else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
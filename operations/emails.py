@@ -0,0 +1,338 @@
+"""Transactional email operations
+
+Requests only add emails to the `email_outbox` table, they never wait for the provider. The
+`tasks.emails.dispatch_emails` Celery task claims pending emails, groups them by kind and sends every group
+to Brevo as one call with a message version per recipient, paced by a token bucket. Failed sends go back to
+pending with an exponential, jittered delay.
+"""
+import datetime
+import hashlib
+import random
+import threading
+import time
+import uuid
+
+import httpx
+import sqlalchemy
+
+import appLogging
+import configuration
+import db.connection
+import db.models
+import operations.tokens
+
+dispatch_config = configuration.get_config().email_dispatch
+
+logging = appLogging.Logger.get_child_logger('emails')
+
+CONFIRMATION = "email_confirmation"
+PASSWORD_RESET = "password_reset"
+
+_TEMPLATES = {
+    CONFIRMATION: (
+        "Confirm your email address",
+        "<p>Hi {{params.name}},</p>"
+        "<p><a href=\"{{params.link}}\">Confirm your email address</a>, the link expires in "
+        "{{params.expires_in}} minutes.</p>",
+    ),
+    PASSWORD_RESET: (
+        "Reset your password",
+        "<p>Hi {{params.name}},</p>"
+        "<p><a href=\"{{params.link}}\">Choose a new password</a>, the link expires in "
+        "{{params.expires_in}} minutes. If you did not ask for it, ignore this email.</p>",
+    ),
+}
+
+_CLAIMABLE = sqlalchemy.and_(
+    db.models.EmailOutbox.status.in_(("pending", "sending")),
+    db.models.EmailOutbox.next_attempt_on <= sqlalchemy.bindparam("now"),
+)
+
+_client: httpx.Client | None = None
+
+
+class TokenBucket:
+    """Blocking token bucket, refilled with `rate` tokens per second up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_rate_limiter = TokenBucket(dispatch_config.rate_per_second, dispatch_config.burst)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+
+def _outbox_values(kind: str, user: db.models.User, idempotency_key: str | None) -> dict:
+    if not user.email:
+        raise ValueError(f"User {user.id} has no email address")
+
+    token_config = configuration.get_settings(configuration.ConfirmationToken)
+    if kind == CONFIRMATION:
+        expire_minutes, url = token_config.email_token_expiration_minutes, dispatch_config.confirmation_url
+    else:
+        expire_minutes, url = token_config.password_token_expiration_minutes, dispatch_config.password_reset_url
+    if idempotency_key is None:
+        idempotency_key = f"{kind}:{user.id}:{int(time.time()) // dispatch_config.dedupe_seconds}"
+
+    token = operations.tokens.create_email_token(user.id, kind, expire_minutes)
+    return {
+        "id": str(uuid.uuid4()),
+        "idempotency_key": hashlib.sha256(idempotency_key.encode('utf-8')).hexdigest(),
+        "kind": kind,
+        "recipient_email": user.email,
+        "recipient_name": f"{user.first_name} {user.last_name}",
+        "params": {"name": user.first_name, "link": url.format(token=token), "expires_in": expire_minutes},
+        "user_id": user.id,
+    }
+
+
+def _queue_statement(kind: str, user: db.models.User, idempotency_key: str | None):
+    return (
+        db.connection.get_insert(db.models.EmailOutbox)
+        .values(**_outbox_values(kind, user, idempotency_key))
+        .on_conflict_do_nothing(index_elements=["idempotency_key"])
+        .returning(db.models.EmailOutbox.id)
+    )
+
+
+def queue_email(kind: str, user: db.models.User, idempotency_key: str = None) -> str | None:
+    """
+    Add the email to the outbox
+    :param kind: CONFIRMATION or PASSWORD_RESET
+    :param user:
+    :param idempotency_key: defaults to the kind and user within `email_dispatch__dedupe_seconds`
+    :return: id of the queued email, None when an email with the same idempotency key was already queued
+    """
+
+    with db.connection.get_session() as session:
+        email_id = session.scalar(_queue_statement(kind, user, idempotency_key))
+        session.commit()
+    return email_id
+
+
+async def queue_email_async(kind: str, user: db.models.User, idempotency_key: str = None) -> str | None:
+    async with db.connection.get_async_session() as session:
+        email_id = await session.scalar(_queue_statement(kind, user, idempotency_key))
+        await session.commit()
+    return email_id
+
+
+def queue_confirmation_email(user: db.models.User, idempotency_key: str = None) -> str | None:
+    return queue_email(CONFIRMATION, user, idempotency_key)
+
+
+async def queue_confirmation_email_async(user: db.models.User, idempotency_key: str = None) -> str | None:
+    return await queue_email_async(CONFIRMATION, user, idempotency_key)
+
+
+def queue_password_reset_email(user: db.models.User, idempotency_key: str = None) -> str | None:
+    return queue_email(PASSWORD_RESET, user, idempotency_key)
+
+
+async def queue_password_reset_email_async(user: db.models.User, idempotency_key: str = None) -> str | None:
+    return await queue_email_async(PASSWORD_RESET, user, idempotency_key)
+
+
+def _claim_batch(limit: int) -> list[sqlalchemy.Row]:
+    """Lease up to `limit` due emails, a lease that runs out makes them claimable again"""
+    now = _now()
+    with db.connection.get_session() as session:
+        email_ids = session.scalars(
+            sqlalchemy.select(db.models.EmailOutbox.id)
+            .where(_CLAIMABLE)
+            .order_by(db.models.EmailOutbox.next_attempt_on)
+            .limit(limit),
+            {"now": now},
+        ).all()
+        if not email_ids:
+            return []
+        # Only the worker whose update still sees the email as claimable gets it
+        rows = session.execute(
+            sqlalchemy.update(db.models.EmailOutbox)
+            .where(db.models.EmailOutbox.id.in_(email_ids), _CLAIMABLE)
+            .values(status="sending", next_attempt_on=now + datetime.timedelta(seconds=dispatch_config.lease_seconds))
+            .returning(
+                db.models.EmailOutbox.id,
+                db.models.EmailOutbox.kind,
+                db.models.EmailOutbox.idempotency_key,
+                db.models.EmailOutbox.recipient_email,
+                db.models.EmailOutbox.recipient_name,
+                db.models.EmailOutbox.params,
+                db.models.EmailOutbox.attempts,
+            )
+            .execution_options(synchronize_session=False),
+            {"now": now},
+        ).all()
+        session.commit()
+    return rows
+
+
+def _get_client() -> httpx.Client:
+    global _client
+    if _client is None:
+        _client = httpx.Client(timeout=dispatch_config.timeout_seconds)
+    return _client
+
+
+def _send(kind: str, rows: list[sqlalchemy.Row]) -> list[str]:
+    brevo = configuration.get_settings(configuration.BrevoSettings)
+    subject, html_content = _TEMPLATES[kind]
+    # A retried call carries the same key, so the provider can drop it if the first one went through
+    batch_key = hashlib.sha256("".join(sorted(row.idempotency_key for row in rows)).encode('utf-8')).hexdigest()
+    response = _get_client().post(
+        f"{brevo.email_api_url.rstrip('/')}/smtp/email",
+        headers={"api-key": brevo.email_api_key, "Idempotency-Key": batch_key},
+        json={
+            "sender": {"email": brevo.email_sender, "name": brevo.email_from},
+            "subject": subject,
+            "htmlContent": html_content,
+            "messageVersions": [
+                {"to": [{"email": row.recipient_email, "name": row.recipient_name}], "params": row.params}
+                for row in rows
+            ],
+        },
+    )
+    response.raise_for_status()
+    return response.json().get("messageIds", [])
+
+
+def _retry_delay(attempts: int) -> float:
+    """Exponential backoff with jitter over the upper half, so emails failed together spread out"""
+    ceiling = min(dispatch_config.retry_max_seconds, dispatch_config.retry_base_seconds * 2 ** (attempts - 1))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _mark_sent(rows: list[sqlalchemy.Row], message_ids: list[str], counts: dict):
+    now = _now()
+    with db.connection.get_session() as session:
+        session.execute(sqlalchemy.update(db.models.EmailOutbox), [
+            {
+                "id": row.id,
+                "status": "sent",
+                "attempts": row.attempts + 1,
+                "sent_on": now,
+                "last_error": None,
+                "provider_message_id": message_ids[index] if index < len(message_ids) else None,
+            }
+            for index, row in enumerate(rows)
+        ])
+        session.commit()
+    counts["sent"] += len(rows)
+
+
+def _mark_failed(rows: list[sqlalchemy.Row], error: str, counts: dict, *, permanent: bool = False,
+                 delay: float = None, attempted: bool = True):
+    now = _now()
+    values = []
+    for row in rows:
+        attempts = row.attempts + (1 if attempted else 0)
+        if permanent or attempts >= dispatch_config.max_attempts:
+            values.append({"id": row.id, "status": "failed", "attempts": attempts, "last_error": error[:500]})
+            counts["failed"] += 1
+        else:
+            retry_on = now + datetime.timedelta(seconds=max(delay or 0, _retry_delay(max(attempts, 1))))
+            values.append({
+                "id": row.id, "status": "pending", "attempts": attempts, "last_error": error[:500],
+                "next_attempt_on": retry_on,
+            })
+            counts["retried"] += 1
+    with db.connection.get_session() as session:
+        session.execute(sqlalchemy.update(db.models.EmailOutbox), values)
+        session.commit()
+
+
+def _dispatch_group(kind: str, rows: list[sqlalchemy.Row], counts: dict) -> float | None:
+    """
+    Send emails of one kind in a single call
+    :return: seconds to hold off when the provider is rate limiting, otherwise None
+    """
+
+    _rate_limiter.acquire()
+    try:
+        message_ids = _send(kind, rows)
+    except httpx.HTTPStatusError as error:
+        status_code = error.response.status_code
+        if status_code in (400, 422) and len(rows) > 1:
+            # One bad recipient rejects the whole call, send them one at a time to fail only that one
+            for index, row in enumerate(rows):
+                if (hold_off := _dispatch_group(kind, [row], counts)) is not None:
+                    _mark_failed(rows[index + 1:], "Provider is rate limiting", counts, delay=hold_off, attempted=False)
+                    return hold_off
+            return None
+        message = f"Provider returned {status_code}: {error.response.text}"
+        if status_code in (400, 422):
+            _mark_failed(rows, message, counts, permanent=True)
+            return None
+        if status_code == 429:
+            hold_off = _retry_after(error.response) or dispatch_config.retry_base_seconds
+            _mark_failed(rows, message, counts, delay=hold_off)
+            return hold_off
+        _mark_failed(rows, message, counts)
+        return None
+    except httpx.TransportError as error:
+        _mark_failed(rows, f"Provider unreachable: {error!r}", counts)
+        return None
+    except Exception as error:
+        logging.exception(f"Sending {len(rows)} {kind} emails failed")
+        _mark_failed(rows, repr(error), counts)
+        return None
+
+    _mark_sent(rows, message_ids, counts)
+    return None
+
+
+def dispatch_pending_emails(max_batches: int = None) -> dict:
+    """
+    Send due emails of the outbox in batches
+    :param max_batches: claims per run, defaults to `email_dispatch__max_batches_per_run`
+    :return: number of emails sent, scheduled for a retry and failed for good
+    """
+
+    counts = {"sent": 0, "retried": 0, "failed": 0}
+    for _ in range(max_batches or dispatch_config.max_batches_per_run):
+        rows = _claim_batch(dispatch_config.batch_size)
+        if not rows:
+            break
+
+        groups: dict[str, list[sqlalchemy.Row]] = {}
+        for row in rows:
+            groups.setdefault(row.kind, []).append(row)
+        hold_off = None
+        for kind, group in groups.items():
+            if hold_off is not None:
+                _mark_failed(group, "Provider is rate limiting", counts, delay=hold_off, attempted=False)
+            else:
+                hold_off = _dispatch_group(kind, group, counts)
+        if hold_off is not None:
+            logging.warning(f"Email provider is rate limiting, holding off for {hold_off} seconds")
+            break
+
+    if any(counts.values()):
+        logging.info(f"Email dispatch: {counts}")
+    return counts
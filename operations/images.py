@@ -0,0 +1,419 @@
+"""Image upload and processing operations
+
+Uploads are streamed to a temp file and hashed while they are written, at most `images__write_buffer_bytes`
+of an upload is held in memory. An image is stored once per SHA-256 of its bytes under
+`media/images/<hash[:2]>/<hash>/`, uploading the same bytes again returns the existing image, or processes it
+again when its processing failed.
+
+Variants, every size of `images__variants` in every format of `images__formats`, are generated in a process
+pool of the API worker. Past `images__max_pending` jobs in the pool an image is handed to the
+`tasks.images.process_image` Celery task instead, so large photos neither block the event loop nor queue up
+behind each other.
+"""
+import asyncio
+import concurrent.futures
+import datetime
+import hashlib
+import multiprocessing
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import AsyncIterator
+
+import PIL.ExifTags
+import PIL.Image
+import PIL.ImageOps
+from sqlalchemy import select, update
+from starlette.concurrency import run_in_threadpool
+
+import appLogging
+import appMetrics
+import configuration
+import db.connection
+import db.models
+import exceptions.images
+
+images_config = configuration.get_config().images
+
+logging = appLogging.Logger.get_child_logger('images')
+
+# Leading bytes of the accepted formats, the declared content type is not trusted
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/gif": "gif", "image/webp": "webp"}
+_SAVE_OPTIONS = {"jpeg": {"optimize": True, "progressive": True}, "webp": {"method": 4}, "png": {"optimize": True}}
+# Pillow errors of images it cannot decode, anything else is a problem of the pool
+_IMAGE_ERRORS = (PIL.Image.DecompressionBombError, PIL.UnidentifiedImageError, OSError, ValueError)
+# EXIF orientations with the image stored rotated by 90 degrees
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+_executor: concurrent.futures.ProcessPoolExecutor | None = None
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+
+def sniff_content_type(head: bytes) -> str | None:
+    """Content type from the first 12 bytes, None for unsupported formats"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+def image_directory(content_hash: str) -> pathlib.Path:
+    return configuration.IMAGES_PATH.joinpath(content_hash[:2], content_hash)
+
+
+def original_name(content_type: str) -> str:
+    return f"original.{_EXTENSIONS[content_type]}"
+
+
+def image_urls(image: db.models.Image) -> dict[str, str]:
+    """URLs of the original and the generated variants, by file name without the `original` extension"""
+    base_url = f"/api/media/images/{image.content_hash[:2]}/{image.content_hash}"
+    urls = {"original": f"{base_url}/{original_name(image.content_type)}"}
+    urls.update((name, f"{base_url}/{name}") for name in image.variants)
+    return urls
+
+
+def start_executor(max_workers: int):
+    """
+    Start the image processing pool of the current worker
+    :param max_workers:
+    :return:
+    """
+
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver')
+        )
+
+
+def shutdown_executor():
+    """
+    Stop the image processing pool, uploads are handed to Celery afterwards
+    :return:
+    """
+
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def get_image(image_id: str) -> db.models.Image | None:
+    with db.connection.get_session() as session:
+        return session.get(db.models.Image, image_id)
+
+
+async def get_image_async(image_id: str) -> db.models.Image | None:
+    async with db.connection.get_async_session() as session:
+        return await session.get(db.models.Image, image_id)
+
+
+async def get_image_by_hash_async(content_hash: str) -> db.models.Image | None:
+    async with db.connection.get_async_session() as session:
+        return await session.scalar(select(db.models.Image).where(db.models.Image.content_hash == content_hash))
+
+
+async def _write_upload(chunks: AsyncIterator[bytes], temp_file) -> tuple[str, str, int]:
+    """
+    Write the chunks to the file in blocks, off the event loop
+    :return: content type, SHA-256 and size of the upload
+    """
+
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    size = 0
+    content_type = None
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > images_config.max_upload_bytes:
+            raise exceptions.images.ImageTooLargeException(
+                f"Images are limited to {images_config.max_upload_bytes} bytes"
+            )
+        digest.update(chunk)
+        buffer += chunk
+        if content_type is None and size >= 12:
+            if not (content_type := sniff_content_type(bytes(buffer[:12]))):
+                raise exceptions.images.UnsupportedImageTypeException("Only JPEG, PNG, GIF and WebP are accepted")
+        if len(buffer) >= images_config.write_buffer_bytes:
+            await run_in_threadpool(temp_file.write, buffer)
+            buffer.clear()
+
+    if content_type is None and not (content_type := sniff_content_type(bytes(buffer))):
+        raise exceptions.images.UnsupportedImageTypeException("Only JPEG, PNG, GIF and WebP are accepted")
+    if buffer:
+        await run_in_threadpool(temp_file.write, buffer)
+    return content_type, digest.hexdigest(), size
+
+
+def _move_into_place(temp_path: str, target: pathlib.Path):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # A rename when both are on the same file system, so the original never appears half written
+    shutil.move(temp_path, target)
+
+
+def _discard_original(target: pathlib.Path):
+    target.unlink(missing_ok=True)
+    try:
+        target.parent.rmdir()
+    except OSError:
+        # Variants or a concurrent upload of the same bytes are in it
+        pass
+
+
+async def _requeue_failed_async(image_id: str) -> db.models.Image | None:
+    """Set a failed image back to pending, None when it is no longer failed"""
+    async with db.connection.get_async_session() as session:
+        requeued = (await session.execute(
+            update(db.models.Image)
+            .where(db.models.Image.id == image_id, db.models.Image.status == "failed")
+            .values(status="pending", processed_on=None)
+            .execution_options(synchronize_session=False)
+        )).rowcount
+        await session.commit()
+    return await get_image_async(image_id) if requeued else None
+
+
+async def store_upload(chunks: AsyncIterator[bytes], uploaded_by: str | None) -> tuple[db.models.Image, bool]:
+    """
+    Stream an upload to disk and record it
+
+    Uploading the bytes of an image whose processing failed puts the original back in place and sets the image
+    back to pending, so it is processed again.
+    :param chunks: body of the request, e.g. `request.stream()`
+    :param uploaded_by: id of the user
+    :return: the image and whether it has to be processed, False when the same bytes were uploaded before
+    """
+
+    temp_directory = configuration.ensure_directory(configuration.CACHE_PATH.joinpath("uploads"))
+    temp_file = await run_in_threadpool(tempfile.NamedTemporaryFile, dir=temp_directory, delete=False)
+    try:
+        try:
+            content_type, content_hash, size = await _write_upload(chunks, temp_file)
+        finally:
+            await run_in_threadpool(temp_file.close)
+
+        existing = await get_image_by_hash_async(content_hash)
+        if existing and existing.status != "failed":
+            appMetrics.IMAGE_UPLOADS.labels("duplicate").inc()
+            return existing, False
+        target = image_directory(content_hash).joinpath(original_name(content_type))
+        await run_in_threadpool(_move_into_place, temp_file.name, target)
+    finally:
+        # Already gone when it was moved into place
+        await run_in_threadpool(pathlib.Path(temp_file.name).unlink, missing_ok=True)
+
+    if existing:
+        if image := await _requeue_failed_async(existing.id):
+            appMetrics.IMAGE_UPLOADS.labels("requeued").inc()
+            return image, True
+        # Requeued by a concurrent upload of the same bytes
+        appMetrics.IMAGE_UPLOADS.labels("duplicate").inc()
+        return await get_image_async(existing.id), False
+
+    try:
+        async with db.connection.get_async_session() as session:
+            image_id = await session.scalar(
+                db.connection.get_insert(db.models.Image)
+                .values(
+                    id=str(uuid.uuid4()),
+                    content_hash=content_hash,
+                    content_type=content_type,
+                    size_bytes=size,
+                    uploaded_by=uploaded_by,
+                    variants=[],
+                )
+                .on_conflict_do_nothing(index_elements=["content_hash"])
+                .returning(db.models.Image.id)
+            )
+            await session.commit()
+    except BaseException:
+        # No image refers to the original
+        await run_in_threadpool(_discard_original, target)
+        raise
+
+    if image_id is None:
+        # The same bytes were uploaded concurrently and recorded first
+        appMetrics.IMAGE_UPLOADS.labels("duplicate").inc()
+        return await get_image_by_hash_async(content_hash), False
+    appMetrics.IMAGE_UPLOADS.labels("created").inc()
+    return await get_image_async(image_id), True
+
+
+def render_variants(original: str, directory: str, variants: dict[str, int], formats: list[str], quality: int,
+                    max_pixels: int) -> tuple[int, int, list[str]]:
+    """
+    Generate the variants of an image, runs in the processing pool or a Celery worker
+    :return: width and height of the original as displayed and the file names written to `directory`
+    """
+
+    PIL.Image.MAX_IMAGE_PIXELS = max_pixels
+    written = []
+    with PIL.Image.open(original) as image:
+        width, height = image.size
+        if image.getexif().get(PIL.ExifTags.Base.Orientation) in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        # JPEGs are decoded straight at the smallest scale still covering the largest variant
+        largest = max(variants.values())
+        image.draft("RGB", (largest, largest))
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        current = PIL.ImageOps.exif_transpose(image).convert("RGBA" if has_alpha else "RGB")
+
+    for name, size in sorted(variants.items(), key=lambda item: item[1], reverse=True):
+        # Every variant is scaled down from the previous, larger one
+        current = current.copy()
+        current.thumbnail((size, size), PIL.Image.Resampling.LANCZOS)
+        for image_format in formats:
+            file_name = f"{name}.{image_format}"
+            frame = current.convert("RGB") if image_format == "jpeg" and current.mode == "RGBA" else current
+            target = pathlib.Path(directory, file_name)
+            partial = target.with_name(f".{file_name}.part")
+            frame.save(partial, format=image_format.upper(), quality=quality, **_SAVE_OPTIONS.get(image_format, {}))
+            os.replace(partial, target)
+            written.append(file_name)
+    return width, height, written
+
+
+def _render_arguments(image: db.models.Image) -> tuple:
+    directory = image_directory(image.content_hash)
+    return (
+        str(directory.joinpath(original_name(image.content_type))),
+        str(directory),
+        images_config.variants,
+        images_config.formats,
+        images_config.quality,
+        images_config.max_pixels,
+    )
+
+
+def _processed_statement(image_id: str, result: tuple[int, int, list[str]] | None):
+    if result is None:
+        values = {"status": "failed", "processed_on": _now()}
+    else:
+        width, height, variants = result
+        values = {"status": "ready", "width": width, "height": height, "variants": variants, "processed_on": _now()}
+    return (
+        update(db.models.Image)
+        .where(db.models.Image.id == image_id)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def process_image(image_id: str) -> str:
+    """
+    Generate the variants of a pending image in this process, for Celery workers
+    :param image_id:
+    :return: status of the image afterwards
+    """
+
+    image = get_image(image_id)
+    if image is None or image.status != "pending":
+        return image.status if image else "missing"
+
+    started = time.perf_counter()
+    try:
+        result = render_variants(*_render_arguments(image))
+    except _IMAGE_ERRORS:
+        logging.exception(f"Variants of image {image_id} could not be generated")
+        result = None
+    appMetrics.IMAGE_PROCESSING_SECONDS.labels("celery").observe(time.perf_counter() - started)
+
+    with db.connection.get_session() as session:
+        session.execute(_processed_statement(image_id, result))
+        session.commit()
+    return "failed" if result is None else "ready"
+
+
+async def _hand_over(image_id: str):
+    import tasks.images
+
+    try:
+        await run_in_threadpool(tasks.images.process_image.delay, image_id)
+    except Exception:
+        logging.exception(f"Image {image_id} could not be handed to Celery, it stays pending until picked up")
+
+
+def _reserve_slot() -> concurrent.futures.ProcessPoolExecutor | None:
+    global _pending
+    with _pending_lock:
+        if _executor is None or _pending >= images_config.max_pending:
+            return None
+        _pending += 1
+        return _executor
+
+
+def _release_slot():
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+async def process_image_async(image: db.models.Image) -> db.models.Image:
+    """
+    Generate the variants in the processing pool, or hand the image to Celery when the pool is saturated
+    :param image: a pending image
+    :return: the image afterwards, still pending when it was handed over
+    """
+
+    if (executor := _reserve_slot()) is None:
+        await _hand_over(image.id)
+        return image
+
+    started = time.perf_counter()
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            executor, render_variants, *_render_arguments(image)
+        )
+    except _IMAGE_ERRORS:
+        logging.exception(f"Variants of image {image.id} could not be generated")
+        result = None
+    except concurrent.futures.process.BrokenProcessPool:
+        logging.exception(f"Processing pool broke on image {image.id}")
+        await _hand_over(image.id)
+        return image
+    finally:
+        _release_slot()
+    appMetrics.IMAGE_PROCESSING_SECONDS.labels("pool").observe(time.perf_counter() - started)
+
+    async with db.connection.get_async_session() as session:
+        await session.execute(_processed_statement(image.id, result))
+        await session.commit()
+    return await get_image_async(image.id)
+
+
+def process_pending_images(limit: int = 100) -> int:
+    """
+    Process images left pending past `images__stale_seconds`, e.g. while Celery was unreachable
+    :param limit:
+    :return: number of images processed
+    """
+
+    stale_before = _now() - datetime.timedelta(seconds=images_config.stale_seconds)
+    with db.connection.get_session() as session:
+        image_ids = session.scalars(
+            select(db.models.Image.id)
+            .where(db.models.Image.status == "pending", db.models.Image.created_on < stale_before)
+            .order_by(db.models.Image.created_on)
+            .limit(limit)
+        ).all()
+    for image_id in image_ids:
+        process_image(image_id)
+    return len(image_ids)
@@ -0,0 +1,279 @@
+"""Language model client
+
+Recipe generation calls the OpenAi chat completions API. Answers take seconds and cost money, so a prompt is
+sent to the model once:
+
+- messages are normalised (NFC, whitespace collapsed, case folded) and hashed with the model and sampling
+  settings, the answer is kept under that hash in the `llm` namespace of appCache, disk tier included, so
+  every worker of the host reuses it for `llm__cache_ttl_seconds`
+- a request for a prompt this worker is already generating reads that generation, from its first chunk
+- at most `llm__max_concurrency` model calls run per worker, a call waits up to `llm__queue_timeout_seconds`
+  for a slot before LlmUnavailableException is raised
+
+`stream` yields the answer while it is generated, `complete` returns all of it. A generation runs in its own
+task, a client going away does not stop it, the others still get the whole answer and it is cached.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import unicodedata
+from typing import AsyncIterator
+
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+import appCache
+import appLogging
+import appMetrics
+import configuration
+import exceptions.llm
+
+llm_config = configuration.get_config().llm
+
+logging = appLogging.Logger.get_child_logger('llm')
+
+_WHITESPACE = re.compile(r"\s+")
+_RETRY_MAX_SECONDS = 10
+
+_completions = appCache.get_cache("llm", ttl_seconds=llm_config.cache_ttl_seconds)
+# Client and slots of the event loop they were created on
+_client: tuple[asyncio.AbstractEventLoop, httpx.AsyncClient] | None = None
+_slots: tuple[asyncio.AbstractEventLoop, asyncio.Semaphore] | None = None
+
+
+class _Generation:
+    """An answer being generated, its chunks are kept so a request joining late reads it from the start"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.chunks: list[str] = []
+        self.finished = False
+        self.error: BaseException | None = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: BaseException = None):
+        self.finished = True
+        self.error = error
+        self._notify()
+
+    async def follow(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                index += 1
+                yield self.chunks[index - 1]
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+_generations: dict[str, _Generation] = {}
+# Strong references, the event loop only keeps weak ones to its tasks
+_tasks: set[asyncio.Task] = set()
+
+
+def normalize_prompt(prompt: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", prompt)).strip().casefold()
+
+
+def prompt_key(messages: list[dict]) -> str:
+    """Hash of the normalised messages and of the settings the answer depends on"""
+    identity = json.dumps(
+        {
+            "model": llm_config.model,
+            "temperature": llm_config.temperature,
+            "max_tokens": llm_config.max_tokens,
+            "messages": [[message["role"], normalize_prompt(message["content"])] for message in messages],
+        },
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def recipe_messages(request: str) -> list[dict]:
+    """Messages asking for a recipe, `request` is what the user typed"""
+    return [
+        {"role": "system", "content": llm_config.recipe_system_prompt},
+        {"role": "user", "content": request},
+    ]
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    loop = asyncio.get_running_loop()
+    if _client is None or _client[0] is not loop:
+        _client = (loop, httpx.AsyncClient(timeout=httpx.Timeout(
+            llm_config.read_timeout_seconds, connect=llm_config.connect_timeout_seconds
+        )))
+    return _client[1]
+
+
+def _get_slots() -> asyncio.Semaphore:
+    global _slots
+    loop = asyncio.get_running_loop()
+    if _slots is None or _slots[0] is not loop:
+        _slots = (loop, asyncio.Semaphore(llm_config.max_concurrency))
+    return _slots[1]
+
+
+async def close_client():
+    """Close the connections of this worker"""
+    global _client
+    if _client is not None:
+        (_, client), _client = _client, None
+        await client.aclose()
+
+
+def _retry_delay(attempt: int, response: httpx.Response = None) -> float:
+    try:
+        return min(float(response.headers["Retry-After"]), _RETRY_MAX_SECONDS)
+    except (AttributeError, KeyError, ValueError):
+        return min(_RETRY_MAX_SECONDS, 0.5 * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+async def _call_model(generation: _Generation, messages: list[dict]):
+    """Stream the answer of the model into the generation, calls failing before a chunk arrived are retried"""
+    openai = configuration.get_settings(configuration.OpenAi)
+    if not openai.chatgpt_api_key:
+        raise exceptions.llm.LlmRequestException("chatgpt_api_key is not set")
+    payload = {
+        "model": llm_config.model,
+        "messages": messages,
+        "temperature": llm_config.temperature,
+        "max_tokens": llm_config.max_tokens,
+        "stream": True,
+    }
+    for attempt in range(llm_config.max_retries + 1):
+        response = None
+        try:
+            async with _get_client().stream(
+                "POST",
+                f"{openai.chatgpt_api_url.rstrip('/')}/chat/completions",
+                headers={"Authorization": f"Bearer {openai.chatgpt_api_key}"},
+                json=payload,
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        return
+                    try:
+                        choices = json.loads(data).get("choices") or [{}]
+                    except (json.JSONDecodeError, AttributeError):
+                        failure = f"Model sent a malformed chunk: {data[:200]}"
+                        break
+                    if content := (choices[0].get("delta") or {}).get("content"):
+                        generation.publish(content)
+                else:
+                    # A cut connection ends the stream without an error, the answer would be cached truncated
+                    failure = "Model stream ended before [DONE]"
+        except httpx.HTTPStatusError as error:
+            status_code = error.response.status_code
+            if status_code != 429 and status_code < 500:
+                raise exceptions.llm.LlmRequestException(
+                    f"Model rejected the request with {status_code}: {error.response.text[:500]}"
+                ) from error
+            failure = f"Model answered {status_code}"
+        except httpx.TransportError as error:
+            failure = f"Model unreachable: {error!r}"
+        if generation.chunks or attempt == llm_config.max_retries:
+            raise exceptions.llm.LlmUnavailableException(failure)
+        logging.warning(f"{failure}, retrying")
+        await asyncio.sleep(_retry_delay(attempt, response))
+
+
+async def _generate(key: str, generation: _Generation, messages: list[dict]):
+    try:
+        if (cached := await run_in_threadpool(_completions.get, key)) is not None:
+            appMetrics.LLM_REQUESTS.labels("cache").inc()
+            generation.publish(cached)
+            generation.finish()
+            return
+
+        appMetrics.LLM_REQUESTS.labels("model").inc()
+        slots = _get_slots()
+        try:
+            async with asyncio.timeout(llm_config.queue_timeout_seconds):
+                await slots.acquire()
+        except TimeoutError:
+            raise exceptions.llm.LlmUnavailableException("Too many generations in progress") from None
+
+        started = time.perf_counter()
+        result = "error"
+        try:
+            async with asyncio.timeout(llm_config.total_timeout_seconds):
+                await _call_model(generation, messages)
+            result = "ok"
+        except TimeoutError:
+            raise exceptions.llm.LlmUnavailableException(
+                f"Model did not answer within {llm_config.total_timeout_seconds} seconds"
+            ) from None
+        finally:
+            slots.release()
+            appMetrics.LLM_SECONDS.labels(result).observe(time.perf_counter() - started)
+
+        if answer := "".join(generation.chunks):
+            await run_in_threadpool(_completions.set, key, answer)
+        generation.finish()
+    except asyncio.CancelledError:
+        generation.finish(exceptions.llm.LlmUnavailableException("Generation was cancelled"))
+        raise
+    except Exception as error:
+        if not isinstance(error, (exceptions.llm.LlmUnavailableException, exceptions.llm.LlmRequestException)):
+            logging.exception("Generation failed")
+        generation.finish(error)
+    finally:
+        if _generations.get(key) is generation:
+            del _generations[key]
+
+
+def _join(messages: list[dict]) -> _Generation:
+    """The generation of these messages in progress in this worker, started when there is none"""
+    key = prompt_key(messages)
+    loop = asyncio.get_running_loop()
+    generation = _generations.get(key)
+    if generation is not None and generation.loop is loop:
+        appMetrics.LLM_REQUESTS.labels("coalesced").inc()
+        return generation
+
+    generation = _generations[key] = _Generation(loop)
+    task = loop.create_task(_generate(key, generation, messages))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return generation
+
+
+async def stream(messages: list[dict]) -> AsyncIterator[str]:
+    """
+    Yield the answer to the messages as it is generated, or in one chunk when it is cached
+    :param messages: chat messages, e.g. recipe_messages(request)
+    :return:
+    :raises exceptions.llm.LlmUnavailableException: no slot, timeout, or the model failed or was unreachable
+    :raises exceptions.llm.LlmRequestException: the model rejected the request
+    """
+
+    async for chunk in _join(messages).follow():
+        yield chunk
+
+
+async def complete(messages: list[dict]) -> str:
+    """The whole answer to the messages, see stream"""
+    return "".join([chunk async for chunk in stream(messages)])
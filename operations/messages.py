@@ -1,21 +1,548 @@
-"""RabbitMQ opperations"""
-from typing import Optional
+"""RabbitMQ opperations
+
+Every worker keeps one connection with a pool of publisher channels in confirm mode. Publishes are not
+waited on one by one, the broker confirms them in batches and each publish resolves when its confirm
+arrives. Consumers get messages pushed up to the prefetch count and acknowledge them in batches. When the
+connection is lost the consumers are subscribed again on the next one, the broker redelivers what they had
+not acknowledged.
+
+With `rabbitmq__broker=memory` the same interface is served by queues held inside the worker, for tests.
+"""
+import abc
+import asyncio
+import collections
+import itertools
+import json
+from typing import Awaitable, Callable, Optional
 
 import pika
+import pika.spec
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+import appLogging
 import configuration
-from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
+import exceptions.messages
+
+rabbitmq_config = configuration.get_config().rabbitmq
+
+logging = appLogging.Logger.get_child_logger('messages')
+
+MessageBody = str | bytes | dict | list
+
+_RECONNECT_TIMEOUT_SECONDS = 30
+
+
+class Message:
+    """Message delivered to a consumer"""
+
+    __slots__ = ('queue', 'body', 'headers', 'delivery_tag', 'redelivered')
+
+    def __init__(self, queue: str, body: bytes, headers: Optional[dict] = None, delivery_tag: int = 0,
+                 redelivered: bool = False):
+        self.queue = queue
+        self.body = body
+        self.headers = headers or {}
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+
+    @property
+    def text(self) -> str:
+        return self.body.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.body)
+
+
+MessageHandler = Callable[[Message], Awaitable[None]]
+
+
+def _encode(body: MessageBody) -> tuple[bytes, str]:
+    if isinstance(body, bytes):
+        return body, 'application/octet-stream'
+    if isinstance(body, str):
+        return body.encode('utf-8'), 'text/plain'
+    return json.dumps(body).encode('utf-8'), 'application/json'
+
+
+class Consumer(abc.ABC):
+    """
+    Runs the handler on pushed messages one at a time, in delivery order.
+    Handled messages are acknowledged together once `ack_batch_size` of them are pending or the queue has been
+    quiet for `ack_interval_ms`. A message whose handler raises is rejected without requeue, a consumer that is
+    cancelled leaves its unacknowledged messages to be redelivered.
+    """
+
+    def __init__(self, queue: str, handler: MessageHandler, prefetch_count: int):
+        self.queue = queue
+        self._handler = handler
+        self._deliveries: asyncio.Queue[Message] = asyncio.Queue()
+        # Acknowledging by half windows keeps messages flowing, a batch as large as the prefetch would stall it
+        self._ack_batch_size = max(1, min(rabbitmq_config.ack_batch_size, prefetch_count // 2))
+        self._ack_interval = rabbitmq_config.ack_interval_ms / 1000
+        self._last_handled_tag = 0
+        self._unacked = 0
+        # Bumped when the deliveries start over on a new channel, tags of the old one are not settled on it
+        self._epoch = 0
+        self._task: asyncio.Task | None = None
+
+    @property
+    def active(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _deliver(self, message: Message):
+        self._deliveries.put_nowait(message)
+
+    def _restart_deliveries(self):
+        """Forget deliveries of a lost channel, the broker delivers them again"""
+        self._epoch += 1
+        while not self._deliveries.empty():
+            self._deliveries.get_nowait()
+        self._last_handled_tag = 0
+        self._unacked = 0
+
+    @abc.abstractmethod
+    def _ack(self, delivery_tag: int):
+        """Acknowledge every message up to and including the delivery tag"""
+
+    @abc.abstractmethod
+    def _reject(self, delivery_tag: int):
+        ...
+
+    @abc.abstractmethod
+    async def _stop(self):
+        ...
+
+    def _start(self):
+        self._task = asyncio.create_task(self._run(), name=f"consumer-{self.queue}")
+
+    def _flush_acks(self):
+        if self._unacked:
+            self._ack(self._last_handled_tag)
+            self._unacked = 0
+
+    async def _run(self):
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    self._deliveries.get(), timeout=self._ack_interval if self._unacked else None
+                )
+            except asyncio.TimeoutError:
+                self._flush_acks()
+                continue
+            epoch = self._epoch
+            try:
+                await self._handler(message)
+            except Exception:
+                logging.exception(f"Handler failed on a message from {self.queue}, it is rejected")
+                if epoch == self._epoch:
+                    self._flush_acks()
+                    self._reject(message.delivery_tag)
+                continue
+            if epoch != self._epoch:
+                continue
+            self._last_handled_tag = message.delivery_tag
+            self._unacked += 1
+            if self._unacked >= self._ack_batch_size:
+                self._flush_acks()
+
+    async def cancel(self):
+        """Stop consuming, acknowledging what was already handled"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._flush_acks()
+        await self._stop()
+
+
+class MessageBroker(abc.ABC):
+    """Interface shared by the RabbitMQ client and its in-memory stand-in"""
+
+    async def publish(self, queue: str, body: MessageBody, headers: Optional[dict] = None):
+        """
+        Publish a message and wait for the broker to confirm it
+        :param queue:
+        :param body: bytes and strings are sent as they are, anything else as JSON
+        :param headers:
+        :return:
+        """
+        await self.publish_many(queue, [body], headers)
+
+    @abc.abstractmethod
+    async def publish_many(self, queue: str, bodies: list[MessageBody], headers: Optional[dict] = None):
+        """Publish messages without waiting between them, then wait for all of their confirms"""
+
+    @abc.abstractmethod
+    async def consume(self, queue: str, handler: MessageHandler, prefetch_count: Optional[int] = None) -> Consumer:
+        """
+        Start pushing messages of the queue to the handler
+        :param queue:
+        :param handler: coroutine called with each message
+        :param prefetch_count: unacknowledged messages in flight, defaults to `rabbitmq__prefetch_count`
+        :return: the consumer, cancel it to stop
+        """
+
+    @abc.abstractmethod
+    async def close(self):
+        ...
+
+
+def _callback_future() -> tuple[asyncio.Future, Callable]:
+    """Future resolved with the last argument pika passes to the callback"""
+    future = asyncio.get_running_loop().create_future()
+
+    def callback(*args):
+        if not future.done():
+            future.set_result(args[-1] if args else None)
+
+    return future, callback
+
+
+class _ConfirmChannel:
+    """Channel in confirm mode, resolving the future of each publish when the broker confirms it"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._delivery_tags = itertools.count(1)
+        self._pending: dict[int, asyncio.Future] = {}
+        channel.add_on_close_callback(self._on_close)
+
+    async def enable_confirms(self):
+        selected, callback = _callback_future()
+        self.channel.confirm_delivery(self._on_confirm, callback=callback)
+        await selected
+
+    @property
+    def is_open(self) -> bool:
+        return self.channel.is_open
+
+    def publish(self, queue: str, body: bytes, properties: pika.BasicProperties) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[next(self._delivery_tags)] = future
+        self.channel.basic_publish(exchange='', routing_key=queue, body=body, properties=properties)
+        return future
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            delivery_tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+        else:
+            delivery_tags = [method.delivery_tag]
+        confirmed = isinstance(method, pika.spec.Basic.Ack)
+        for delivery_tag in delivery_tags:
+            future = self._pending.pop(delivery_tag, None)
+            if future is None or future.done():
+                continue
+            if confirmed:
+                future.set_result(None)
+            else:
+                future.set_exception(exceptions.messages.MessageNotConfirmedException(delivery_tag))
+
+    def _on_close(self, channel, reason):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exceptions.messages.MessageBrokerUnavailableException(str(reason)))
+        self._pending.clear()
+
+
+class _RabbitmqConsumer(Consumer):
+
+    def __init__(self, queue: str, handler: MessageHandler, prefetch_count: int, channel):
+        super().__init__(queue, handler, prefetch_count)
+        self._prefetch_count = prefetch_count
+        self._channel = channel
+        self._consumer_tag = None
+
+    async def _subscribe(self):
+        qos_ok, callback = _callback_future()
+        self._channel.basic_qos(prefetch_count=self._prefetch_count, callback=callback)
+        await qos_ok
+        self._consumer_tag = self._channel.basic_consume(self.queue, self._on_message, auto_ack=False)
+        if not self.active:
+            self._start()
+
+    async def _resubscribe(self, channel):
+        """Consume again on a channel of a new connection"""
+        self._channel = channel
+        self._restart_deliveries()
+        await self._subscribe()
+
+    def _on_message(self, channel, method, properties, body):
+        self._deliver(Message(self.queue, body, properties.headers, method.delivery_tag, method.redelivered))
+
+    def _ack(self, delivery_tag: int):
+        if self._channel.is_open:
+            self._channel.basic_ack(delivery_tag, multiple=True)
+
+    def _reject(self, delivery_tag: int):
+        if self._channel.is_open:
+            self._channel.basic_nack(delivery_tag, requeue=False)
+
+    async def _stop(self):
+        if self._channel.is_open:
+            cancelled, callback = _callback_future()
+            self._channel.basic_cancel(self._consumer_tag, callback=callback)
+            await cancelled
+            self._channel.close()
+
+
+class RabbitmqBroker(MessageBroker):
+    """Long-lived connection of the worker, opened on first use and reopened after it is lost"""
+
+    def __init__(self, rabbitmq: configuration.RabbitmqConfiguration):
+        self._config = rabbitmq
+        self._connection: AsyncioConnection | None = None
+        self._connection_lock = asyncio.Lock()
+        self._channels: list[_ConfirmChannel] = []
+        self._channel_turns = itertools.count()
+        self._declared_queues: set[str] = set()
+        self._consumers: list[_RabbitmqConsumer] = []
+        self._reconnecting: asyncio.Task | None = None
+        self._closing = False
+
+    def _parameters(self) -> pika.ConnectionParameters:
+        return pika.ConnectionParameters(
+            host=self._config.host,
+            port=self._config.port,
+            virtual_host=self._config.virtual_host,
+            credentials=pika.PlainCredentials(self._config.user, self._config.password),
+            heartbeat=self._config.heartbeat,
+        )
+
+    async def _connect(self) -> AsyncioConnection:
+        if self._connection and self._connection.is_open:
+            return self._connection
+        async with self._connection_lock:
+            if self._connection and self._connection.is_open:
+                return self._connection
+            loop = asyncio.get_running_loop()
+            opened = loop.create_future()
+
+            def on_open_error(connection, error):
+                if not opened.done():
+                    opened.set_exception(exceptions.messages.MessageBrokerUnavailableException(
+                        f"RabbitMQ at {self._config.host}:{self._config.port} is unreachable: {error!r}"
+                    ))
+
+            AsyncioConnection(
+                self._parameters(),
+                on_open_callback=lambda connection: opened.done() or opened.set_result(connection),
+                on_open_error_callback=on_open_error,
+                on_close_callback=self._on_connection_closed,
+                custom_ioloop=loop,
+            )
+            connection = await opened
+            self._declared_queues.clear()
+            self._channels = [await self._open_confirm_channel(connection) for _ in range(self._config.publisher_channels)]
+            self._connection = connection
+            self._consumers = [consumer for consumer in self._consumers if consumer.active]
+            for consumer in self._consumers:
+                channel = await self._open_channel(connection)
+                await self._declare(channel, consumer.queue)
+                await consumer._resubscribe(channel)
+            return connection
+
+    def _on_connection_closed(self, connection, reason):
+        if connection is self._connection:
+            self._connection = None
+            if self._consumers and not self._closing and not self._reconnecting:
+                logging.warning(f"RabbitMQ connection closed with {len(self._consumers)} consumers: {reason}")
+                self._reconnecting = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        """Connect again until the consumers are subscribed, waiting longer after each failure"""
+        try:
+            for attempt in itertools.count():
+                try:
+                    # A connection lost again while it opens leaves its callbacks unresolved
+                    async with asyncio.timeout(_RECONNECT_TIMEOUT_SECONDS):
+                        await self._connect()
+                    return
+                except Exception as error:
+                    delay = min(_RECONNECT_TIMEOUT_SECONDS, 2 ** attempt)
+                    logging.warning(f"Consumers not resubscribed, retrying in {delay} seconds: {error}")
+                    await asyncio.sleep(delay)
+        finally:
+            self._reconnecting = None
+
+    @staticmethod
+    async def _open_channel(connection: AsyncioConnection):
+        opened, callback = _callback_future()
+        connection.channel(on_open_callback=callback)
+        return await opened
+
+    async def _open_confirm_channel(self, connection: AsyncioConnection) -> _ConfirmChannel:
+        channel = _ConfirmChannel(await self._open_channel(connection))
+        await channel.enable_confirms()
+        return channel
+
+    async def _publisher_channel(self) -> _ConfirmChannel:
+        connection = await self._connect()
+        index = next(self._channel_turns) % len(self._channels)
+        if not self._channels[index].is_open:
+            self._channels[index] = await self._open_confirm_channel(connection)
+        return self._channels[index]
+
+    async def _declare(self, channel, queue: str):
+        if queue not in self._declared_queues:
+            declared, callback = _callback_future()
+            channel.queue_declare(queue, durable=True, callback=callback)
+            await declared
+            self._declared_queues.add(queue)
+
+    async def publish_many(self, queue: str, bodies: list[MessageBody], headers: Optional[dict] = None):
+        channel = await self._publisher_channel()
+        await self._declare(channel.channel, queue)
+        confirms = []
+        for body in bodies:
+            payload, content_type = _encode(body)
+            properties = pika.BasicProperties(content_type=content_type, headers=headers, delivery_mode=2)
+            confirms.append(channel.publish(queue, payload, properties))
+        await asyncio.gather(*confirms)
+
+    async def consume(self, queue: str, handler: MessageHandler, prefetch_count: Optional[int] = None) -> Consumer:
+        channel = await self._open_channel(await self._connect())
+        await self._declare(channel, queue)
+        consumer = _RabbitmqConsumer(queue, handler, prefetch_count or self._config.prefetch_count, channel)
+        await consumer._subscribe()
+        self._consumers.append(consumer)
+        return consumer
+
+    async def close(self):
+        self._closing = True
+        if self._reconnecting:
+            self._reconnecting.cancel()
+            try:
+                await self._reconnecting
+            except asyncio.CancelledError:
+                pass
+        for consumer in self._consumers:
+            await consumer.cancel()
+        self._consumers.clear()
+        if self._connection and self._connection.is_open:
+            connection, self._connection = self._connection, None
+            closed, callback = _callback_future()
+            connection.add_on_close_callback(callback)
+            connection.close()
+            await closed
+
+
+class _MemoryConsumer(Consumer):
+
+    def __init__(self, queue: str, handler: MessageHandler, broker: "InMemoryBroker", prefetch_count: int):
+        super().__init__(queue, handler, prefetch_count)
+        self._broker = broker
+        self._slots = asyncio.Semaphore(prefetch_count)
+        self._delivery_tags = itertools.count(1)
+        self._in_flight: collections.OrderedDict[int, Message] = collections.OrderedDict()
+        self._feeder: asyncio.Task | None = None
+
+    def _start(self):
+        super()._start()
+        self._feeder = asyncio.create_task(self._feed(), name=f"memory-feeder-{self.queue}")
+
+    async def _feed(self):
+        source = self._broker._queue(self.queue)
+        while True:
+            await self._slots.acquire()
+            message = await source.get()
+            message = Message(self.queue, message.body, message.headers, next(self._delivery_tags), message.redelivered)
+            self._in_flight[message.delivery_tag] = message
+            self._deliver(message)
+
+    def _settle(self, delivery_tag: int):
+        self._in_flight.pop(delivery_tag, None)
+        self._slots.release()
+
+    def _ack(self, delivery_tag: int):
+        for tag in [tag for tag in self._in_flight if tag <= delivery_tag]:
+            self._settle(tag)
+
+    def _reject(self, delivery_tag: int):
+        self._broker.dead_letters.append(self._in_flight[delivery_tag])
+        self._settle(delivery_tag)
+
+    async def _stop(self):
+        self._feeder.cancel()
+        try:
+            await self._feeder
+        except asyncio.CancelledError:
+            pass
+        source = self._broker._queue(self.queue)
+        for message in self._in_flight.values():
+            source.put_nowait(Message(self.queue, message.body, message.headers, redelivered=True))
+        self._in_flight.clear()
+
+
+class InMemoryBroker(MessageBroker):
+    """
+    Stand-in for RabbitMQ inside a single worker, with the same delivery, prefetch and acknowledgement rules.
+    Rejected messages are kept in `dead_letters`.
+    """
+
+    def __init__(self):
+        self._queues: dict[str, asyncio.Queue[Message]] = {}
+        self._consumers: list[_MemoryConsumer] = []
+        self.dead_letters: list[Message] = []
+
+    def _queue(self, queue: str) -> asyncio.Queue[Message]:
+        if queue not in self._queues:
+            self._queues[queue] = asyncio.Queue()
+        return self._queues[queue]
+
+    def pending(self, queue: str) -> int:
+        """Messages waiting in the queue, not counting those delivered to a consumer"""
+        return self._queue(queue).qsize()
+
+    async def publish_many(self, queue: str, bodies: list[MessageBody], headers: Optional[dict] = None):
+        for body in bodies:
+            payload, _ = _encode(body)
+            self._queue(queue).put_nowait(Message(queue, payload, dict(headers or {})))
+
+    async def consume(self, queue: str, handler: MessageHandler, prefetch_count: Optional[int] = None) -> Consumer:
+        consumer = _MemoryConsumer(queue, handler, self, prefetch_count or rabbitmq_config.prefetch_count)
+        consumer._start()
+        self._consumers.append(consumer)
+        return consumer
+
+    async def close(self):
+        for consumer in self._consumers:
+            await consumer.cancel()
+        self._consumers.clear()
+
+
+_broker: MessageBroker | None = None
+
+
+def get_broker() -> MessageBroker:
+    """Message broker of this worker, it connects on first use"""
+    global _broker
+    if _broker is None:
+        if rabbitmq_config.broker == configuration.MessageBrokerOptions.MEMORY:
+            _broker = InMemoryBroker()
+        else:
+            _broker = RabbitmqBroker(rabbitmq_config)
+    return _broker
+
+
+async def publish(queue: str, body: MessageBody, headers: Optional[dict] = None):
+    await get_broker().publish(queue, body, headers)
+
 
-rabbitmq_config = configuration.Config().rabbitmq
+async def publish_many(queue: str, bodies: list[MessageBody], headers: Optional[dict] = None):
+    await get_broker().publish_many(queue, bodies, headers)
 
 
-def get_connection() -> BlockingConnection:
-    credentials = pika.PlainCredentials(username=rabbitmq_config.username, password=rabbitmq_config.password)
-    return pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_config.host, rabbitmq_config.port, credentials=credentials))
+async def consume(queue: str, handler: MessageHandler, prefetch_count: Optional[int] = None) -> Consumer:
+    return await get_broker().consume(queue, handler, prefetch_count)
 
 
-def get_message_from_queue(channel: BlockingChannel, queue: str) -> Optional[str]:
-    method_frame, header_frame, body = channel.basic_get(queue)
-    if method_frame:
-        channel.basic_ack(method_frame.delivery_tag)
-        return body.decode('utf-8')
-    return None
+async def close_broker():
+    """Cancel the consumers and close the connection of this worker"""
+    global _broker
+    if _broker is not None:
+        broker, _broker = _broker, None
+        await broker.close()
@@ -0,0 +1,144 @@
+"""Password hashing operations"""
+import asyncio
+import concurrent.futures
+import multiprocessing
+import threading
+import time
+
+import bcrypt
+from starlette.concurrency import run_in_threadpool
+
+import appLogging
+import appMetrics
+import configuration
+import exceptions.passwords
+
+hashing_config = configuration.get_config().password_hashing
+
+logging = appLogging.Logger.get_child_logger('passwords')
+
+_executor: concurrent.futures.ProcessPoolExecutor | None = None
+_pending = 0
+_pending_lock = threading.Lock()
+_metrics = {
+    'hash': {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0},
+    'check': {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0},
+    'rejected': 0,
+}
+
+
+def hash_password(password: str) -> str:
+    salt = bcrypt.gensalt(rounds=hashing_config.bcrypt_rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def check_password(password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """Check if the hash was made with a cost factor other than the configured one"""
+    try:
+        rounds = int(hashed_password.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != hashing_config.bcrypt_rounds
+
+
+def start_executor(max_workers: int):
+    """
+    Start the hashing process pool of the current worker
+    :param max_workers:
+    :return:
+    """
+
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver')
+        )
+
+
+def shutdown_executor():
+    """
+    Stop the hashing process pool, hashing falls back to the threadpool afterwards
+    :return:
+    """
+
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _reserve_slot():
+    global _pending
+    with _pending_lock:
+        if _pending >= hashing_config.max_pending:
+            _metrics['rejected'] += 1
+            appMetrics.PASSWORD_HASHING_REJECTED.inc()
+            raise exceptions.passwords.PasswordHashingOverloadedException()
+        _pending += 1
+
+
+def _release_slot(operation: str, started: float):
+    global _pending
+    elapsed = time.perf_counter() - started
+    with _pending_lock:
+        _pending -= 1
+        metric = _metrics[operation]
+        metric['count'] += 1
+        metric['total_seconds'] += elapsed
+        metric['max_seconds'] = max(metric['max_seconds'], elapsed)
+    appMetrics.PASSWORD_HASHING_SECONDS.labels(operation).observe(elapsed)
+    logging.debug(f"bcrypt {operation} took {elapsed * 1000:.1f} ms")
+
+
+async def _run(operation: str, func, *args):
+    _reserve_slot()
+    started = time.perf_counter()
+    try:
+        if _executor is None:
+            return await run_in_threadpool(func, *args)
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _release_slot(operation, started)
+
+
+def hash_passwords(passwords: list[str], max_workers: int = None) -> list[str]:
+    """
+    Hash a batch of passwords across all cores, for bulk imports outside the request path
+    :param passwords:
+    :param max_workers:
+    :return:
+    """
+
+    if len(passwords) < 2:
+        return [hash_password(password) for password in passwords]
+    if _executor is not None:
+        return list(_executor.map(hash_password, passwords, chunksize=16))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers or multiprocessing.cpu_count(), mp_context=multiprocessing.get_context('forkserver')
+    ) as executor:
+        return list(executor.map(hash_password, passwords, chunksize=16))
+
+
+async def hash_password_async(password: str) -> str:
+    """Hash the password in the hashing pool, raises PasswordHashingOverloadedException when it is saturated"""
+    return await _run('hash', hash_password, password)
+
+
+async def check_password_async(password: str, hashed_password: str) -> bool:
+    """Verify the password in the hashing pool, raises PasswordHashingOverloadedException when it is saturated"""
+    return await _run('check', check_password, password, hashed_password)
+
+
+def get_metrics() -> dict:
+    """Return a snapshot of the hashing latency metrics"""
+    with _pending_lock:
+        return {
+            'pending': _pending,
+            'rejected': _metrics['rejected'],
+            'hash': dict(_metrics['hash']),
+            'check': dict(_metrics['check']),
+        }
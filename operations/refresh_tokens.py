@@ -0,0 +1,195 @@
+"""Refresh token rotation
+
+Every refresh token is recorded by its `jti` with the family of the sign in it descends from, and can be used
+once: using it records the token that replaces it. A token presented again after it was replaced was stolen
+or replayed, so the whole family is revoked and both holders have to sign in again.
+
+Used tokens and revoked families are kept in the memory tier of appCache until the tokens expire, a replay
+seen by this worker is turned away without a DB query. The DB stays the source of truth, the rotating UPDATE
+only succeeds once per token.
+"""
+import datetime
+import uuid
+
+from jose import ExpiredSignatureError, JWTError
+from sqlalchemy import delete, select, update
+
+import appCache
+import appLogging
+import configuration
+import db.connection
+import db.models
+import exceptions.tokens
+import operations.tokens
+
+jwt_config = configuration.get_settings(configuration.JwtToken)
+
+logging = appLogging.Logger.get_child_logger('refresh_tokens')
+
+
+# jti of used tokens -> their family, and revoked families. Memory tier only, they are read on the event loop
+_used_tokens = appCache.get_cache(
+    "used_refresh_tokens", ttl_seconds=jwt_config.refresh_token_expire_minutes * 60, disk=False
+)
+_revoked_families = appCache.get_cache(
+    "revoked_token_families", ttl_seconds=jwt_config.refresh_token_expire_minutes * 60, disk=False
+)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+
+def _new_token(user_id: str, family_id: str) -> tuple[db.models.RefreshToken, str]:
+    jti = str(uuid.uuid4())
+    expires_on = _now() + datetime.timedelta(minutes=jwt_config.refresh_token_expire_minutes)
+    record = db.models.RefreshToken(jti=jti, family_id=family_id, user_id=user_id, expires_on=expires_on)
+    return record, operations.tokens.create_refresh_token(user_id, jti=jti, fam=family_id)
+
+
+def issue_refresh_token(user_id: str) -> str:
+    """Start a new family of refresh tokens, on sign in"""
+    record, token = _new_token(user_id, str(uuid.uuid4()))
+    with db.connection.get_session() as session:
+        session.add(record)
+        session.commit()
+    return token
+
+
+async def issue_refresh_token_async(user_id: str) -> str:
+    record, token = _new_token(user_id, str(uuid.uuid4()))
+    async with db.connection.get_async_session() as session:
+        session.add(record)
+        await session.commit()
+    return token
+
+
+def _verify(refresh_token: str) -> dict:
+    """Check the signature and the revoked families"""
+    try:
+        claims = operations.tokens.decode_refresh_token(refresh_token)
+    except ExpiredSignatureError:
+        raise exceptions.tokens.InvalidRefreshTokenException("Refresh token expired")
+    except JWTError:
+        raise exceptions.tokens.InvalidRefreshTokenException("Invalid refresh token")
+    if not claims.get("jti") or not claims.get("fam"):
+        raise exceptions.tokens.InvalidRefreshTokenException("Invalid refresh token")
+    if _revoked_families.get(claims["fam"]) is not None:
+        raise exceptions.tokens.InvalidRefreshTokenException("Refresh token revoked")
+    return claims
+
+
+def _rotate_statement(claims: dict, successor: db.models.RefreshToken):
+    return (
+        update(db.models.RefreshToken)
+        .where(
+            db.models.RefreshToken.jti == claims["jti"],
+            db.models.RefreshToken.replaced_by.is_(None),
+            db.models.RefreshToken.revoked_on.is_(None),
+        )
+        .values(replaced_by=successor.jti, used_on=_now())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _revoke_family_statement(family_id: str):
+    return (
+        update(db.models.RefreshToken)
+        .where(db.models.RefreshToken.family_id == family_id, db.models.RefreshToken.revoked_on.is_(None))
+        .values(revoked_on=_now())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _reused(claims: dict) -> exceptions.tokens.InvalidRefreshTokenException:
+    _revoked_families.set(claims["fam"], True)
+    logging.warning(f"Refresh token {claims['jti']} of user {claims['sub']} was reused, its family is revoked")
+    return exceptions.tokens.InvalidRefreshTokenException("Refresh token reused")
+
+
+def rotate_refresh_token(refresh_token: str) -> tuple[str, str]:
+    """
+    Replace the refresh token with a new one of the same family
+    :param refresh_token:
+    :return: id of the user and the new refresh token
+    """
+
+    claims = _verify(refresh_token)
+    successor, token = _new_token(claims["sub"], claims["fam"])
+    with db.connection.get_session() as session:
+        if _used_tokens.get(claims["jti"]) is None and session.execute(_rotate_statement(claims, successor)).rowcount:
+            session.add(successor)
+            session.commit()
+            _used_tokens.set(claims["jti"], claims["fam"])
+            return claims["sub"], token
+        if session.get(db.models.RefreshToken, claims["jti"]) is None:
+            raise exceptions.tokens.InvalidRefreshTokenException("Invalid refresh token")
+        session.execute(_revoke_family_statement(claims["fam"]))
+        session.commit()
+    raise _reused(claims)
+
+
+async def rotate_refresh_token_async(refresh_token: str) -> tuple[str, str]:
+    claims = _verify(refresh_token)
+    successor, token = _new_token(claims["sub"], claims["fam"])
+    async with db.connection.get_async_session() as session:
+        if _used_tokens.get(claims["jti"]) is None and \
+                (await session.execute(_rotate_statement(claims, successor))).rowcount:
+            session.add(successor)
+            await session.commit()
+            _used_tokens.set(claims["jti"], claims["fam"])
+            return claims["sub"], token
+        if await session.get(db.models.RefreshToken, claims["jti"]) is None:
+            raise exceptions.tokens.InvalidRefreshTokenException("Invalid refresh token")
+        await session.execute(_revoke_family_statement(claims["fam"]))
+        await session.commit()
+    raise _reused(claims)
+
+
+def _user_families_statement(user_id: str):
+    return (
+        select(db.models.RefreshToken.family_id)
+        .where(db.models.RefreshToken.user_id == user_id, db.models.RefreshToken.revoked_on.is_(None))
+        .distinct()
+    )
+
+
+def _revoke_user_statement(user_id: str):
+    return (
+        update(db.models.RefreshToken)
+        .where(db.models.RefreshToken.user_id == user_id, db.models.RefreshToken.revoked_on.is_(None))
+        .values(revoked_on=_now())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def revoke_user_refresh_tokens(user_id: str) -> int:
+    """Revoke every refresh token of the user, e.g. after a password change"""
+    with db.connection.get_session() as session:
+        families = session.scalars(_user_families_statement(user_id)).all()
+        revoked = session.execute(_revoke_user_statement(user_id)).rowcount
+        session.commit()
+    for family_id in families:
+        _revoked_families.set(family_id, True)
+    return revoked
+
+
+async def revoke_user_refresh_tokens_async(user_id: str) -> int:
+    async with db.connection.get_async_session() as session:
+        families = (await session.scalars(_user_families_statement(user_id))).all()
+        revoked = (await session.execute(_revoke_user_statement(user_id))).rowcount
+        await session.commit()
+    for family_id in families:
+        _revoked_families.set(family_id, True)
+    return revoked
+
+
+def delete_expired_refresh_tokens() -> int:
+    """Delete the records of expired tokens, their signature check already rejects them"""
+    with db.connection.get_session() as session:
+        deleted = session.execute(
+            delete(db.models.RefreshToken).where(db.models.RefreshToken.expires_on < _now())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        session.commit()
+    return deleted
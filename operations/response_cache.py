@@ -0,0 +1,72 @@
+"""Per-worker cache of serialised responses
+
+Read-only endpoints render a resource to JSON once per version of it. The ETag is derived from what changes
+with the resource (`updated_on`, the role catalog version, ...), a request whose If-None-Match carries it is
+answered with a 304 before anything is rendered, other requests get the bytes kept in the `responses`
+namespace of appCache, memory tier only. Writes drop the entries of what they touch, an entry stored under
+an older ETag is rendered again anyway.
+"""
+import hashlib
+from typing import Callable, Hashable
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+import appCache
+import appMetrics
+import configuration
+
+response_cache_config = configuration.get_config().response_cache
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag of the parts identifying a version of a resource"""
+    digest = hashlib.blake2b("\x1f".join(str(part) for part in parts).encode('utf-8'), digest_size=12)
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match uses the weak comparison, `*` matches any current representation"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque_tag for candidate in if_none_match.split(","))
+
+
+_responses = appCache.get_cache("responses", ttl_seconds=response_cache_config.ttl_seconds, disk=False)
+
+
+def invalidate(key: Hashable):
+    _responses.delete(key)
+
+
+def clear():
+    _responses.clear()
+
+
+def cached_response(request: Request, key: Hashable, etag: str, render: Callable[[], bytes]) -> Response:
+    """
+    Answer with a 304, the cached body or a freshly rendered one
+    :param request:
+    :param key: identifies the resource, e.g. ("user", user_id)
+    :param etag: of the current version, see make_etag
+    :param render: serialises the current version to JSON bytes, only called on a miss
+    :return:
+    """
+
+    headers = {"ETag": etag, "Cache-Control": response_cache_config.cache_control, "Vary": "Authorization"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        appMetrics.RESPONSE_CACHE.labels("not_modified").inc()
+        return Response(status_code=304, headers=headers)
+
+    cached = _responses.get(key)
+    if cached is not None and cached[0] == etag:
+        appMetrics.RESPONSE_CACHE.labels("hit").inc()
+        body = cached[1]
+    else:
+        appMetrics.RESPONSE_CACHE.labels("miss").inc()
+        body = render()
+        _responses.set(key, (etag, body))
+    return Response(body, media_type="application/json", headers=headers)
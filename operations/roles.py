@@ -1,11 +1,104 @@
+import asyncio
+import threading
+
+import appLogging
 import db.connection
 import db.models
 import configuration
+import operations.response_cache
+
+from sqlalchemy import select
+
+config = configuration.get_config()
+
+logging = appLogging.Logger.get_child_logger('roles')
+
+
+class RoleCatalog:
+    """Immutable snapshot of the roles table indexed by id and by case-insensitive name"""
+
+    def __init__(self, roles: list[db.models.Role] = (), version: int = None):
+        self.version = version
+        self._by_id = {role.id: role for role in roles}
+        self._by_name = {role.name.lower(): role for role in roles}
+
+    def get_by_id(self, role_id: str) -> db.models.Role | None:
+        return self._by_id.get(role_id)
+
+    def get_by_name(self, name: str) -> db.models.Role | None:
+        return self._by_name.get(name.lower())
+
+    def name_of(self, role_id: str) -> str | None:
+        role = self._by_id.get(role_id)
+        return role.name if role else None
+
+    @property
+    def roles(self) -> list[db.models.Role]:
+        return list(self._by_id.values())
+
+
+_catalog: RoleCatalog | None = None
+_catalog_lock = threading.Lock()
+
+# Bumped by triggers on every write to roles, see db.models.RoleCatalogVersion
+_VERSION_STATEMENT = select(db.models.RoleCatalogVersion.version)
 
 
-def get_all_roles():
+def get_all_roles() -> list[db.models.Role]:
     with db.connection.get_session() as session:
-        return session.query(db.models.Role)
+        return list(session.scalars(select(db.models.Role)))
+
+
+def refresh_role_catalog() -> RoleCatalog:
+    global _catalog
+    with db.connection.get_session() as session:
+        version = session.scalar(_VERSION_STATEMENT)
+        catalog = RoleCatalog(list(session.scalars(select(db.models.Role))), version)
+    with _catalog_lock:
+        _catalog = catalog
+    return catalog
+
+
+async def refresh_role_catalog_async() -> RoleCatalog:
+    global _catalog
+    async with db.connection.get_async_session() as session:
+        version = await session.scalar(_VERSION_STATEMENT)
+        catalog = RoleCatalog(list(await session.scalars(select(db.models.Role))), version)
+    with _catalog_lock:
+        _catalog = catalog
+    return catalog
+
+
+def get_role_catalog() -> RoleCatalog:
+    """Return the in-process role catalog, loading it on first use"""
+    return _catalog or refresh_role_catalog()
+
+
+async def get_role_catalog_async() -> RoleCatalog:
+    return _catalog or await refresh_role_catalog_async()
+
+
+async def poll_role_catalog(interval: int = None):
+    """
+    Reload the catalog whenever the roles table version changes, picks up roles created by other workers
+    :param interval: seconds between version checks
+    :return:
+    """
+
+    interval = interval or config.role_catalog_poll_seconds
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with db.connection.get_async_session() as session:
+                version = await session.scalar(_VERSION_STATEMENT)
+            if not _catalog or version != _catalog.version:
+                await refresh_role_catalog_async()
+        except Exception:
+            logging.exception("Role catalog refresh failed")
+
+
+def get_role_by_name(name: str) -> db.models.Role | None:
+    return get_role_catalog().get_by_name(name)
 
 
 def create_role(name: str, created_by: str):
@@ -14,4 +107,6 @@ def create_role(name: str, created_by: str):
         session.add(new_role)
         session.commit()
         session.refresh(new_role)
-        return new_role
+    refresh_role_catalog()
+    operations.response_cache.invalidate(("roles",))
+    return new_role
@@ -0,0 +1,363 @@
+"""Full-text search of recipes, ingredients and categories
+
+What is searchable lives in search_documents, one row per kind and id. The operations writing a recipe,
+ingredient or category execute `index_statements` in their transaction, or call index_document after it,
+and delete_statement / remove_document when it goes away. SQLite keeps the FTS5 `search_index` in sync with
+triggers, Postgres the generated `search_vector` column, no batch job has to catch up.
+
+Every word of a query is matched as a prefix and all of them have to match. Documents matching all the words
+in their title come first, then the others, each group ranked by bm25 on SQLite and ts_rank_cd on Postgres.
+Ranking reads every match, the title group keeps that to a small set for a page of common words. A word
+long enough that nothing starts with it is replaced by the indexed words one edit away (search_terms).
+"""
+import re
+import unicodedata
+
+from sqlalchemy import bindparam, delete, func, select, text
+
+import appMetrics
+import configuration
+import db.connection
+import db.models
+
+RECIPE = "recipe"
+INGREDIENT = "ingredient"
+CATEGORY = "category"
+KINDS = (RECIPE, INGREDIENT, CATEGORY)
+
+config = configuration.get_config()
+search_config = config.search
+
+# Words as the unicode61 tokenizer splits them, the underscore is a separator
+_WORD = re.compile(r"[^\W_]+")
+
+
+def _latin_diacritics() -> dict[int, str]:
+    """Letters made of an ASCII letter and diacritics, e.g. é or İ, mapped to that letter"""
+    table = {}
+    for code_point in range(0xC0, 0x1F00):
+        decomposed = unicodedata.normalize("NFD", chr(code_point))
+        if decomposed[0].isascii() and all(unicodedata.combining(mark) for mark in decomposed[1:]):
+            table[code_point] = decomposed[0]
+    return table
+
+
+# unicode61 with remove_diacritics 2 folds these and keeps the diacritics of other scripts, the ё of ёлка stays
+_LATIN_DIACRITICS = _latin_diacritics()
+_TERMS_PER_STATEMENT = 1000
+
+# Column weights of title, body, tags, the order of the search_index columns
+_SQLITE_RANK = "bm25(10.0, 1.0, 4.0)"
+
+_TYPO_CANDIDATES = (
+    select(db.models.SearchTerm.term)
+    .where(
+        db.models.SearchTerm.initial == bindparam("initial"),
+        db.models.SearchTerm.length.between(bindparam("shortest"), bindparam("longest")),
+    )
+)
+
+
+def _is_postgres() -> bool:
+    return config.database == configuration.DbTypeOptions.POSTGRES
+
+
+def _words(text_: str) -> list[str]:
+    """
+    Lowercase words as the index stores them. SQLite drops the diacritics of Latin letters, Postgres strips
+    diacritics with unaccent in SQL, on the indexed text and on the query alike
+    """
+    if not _is_postgres():
+        text_ = text_.translate(_LATIN_DIACRITICS)
+    return _WORD.findall(text_.lower())
+
+
+def normalize_terms(query: str) -> list[str]:
+    """
+    Words of the query as the index stores them
+    :param query:
+    :return: distinct words, at most `search__max_terms`
+    """
+
+    return list(dict.fromkeys(_words(query)))[:search_config.max_terms]
+
+
+def index_statements(kind: str, document_id: str, title: str, body: str = "", tags: list[str] = ()) -> list:
+    """
+    Upsert of the searchable text of a document and of its words, unchanged rows are not rewritten
+    :param kind: RECIPE, INGREDIENT or CATEGORY
+    :param document_id: id of the recipe, ingredient or category
+    :param title: weighs the most in the ranking
+    :param body: e.g. the ingredients and steps of a recipe
+    :param tags: e.g. the category names of a recipe
+    :return: statements to execute in order
+    """
+
+    tags = " ".join(tags)
+    statement = db.connection.get_insert(db.models.SearchDocument).values(
+        kind=kind, document_id=document_id, title=title[:255], body=body or "", tags=tags[:500]
+    )
+    table = db.models.SearchDocument.__table__
+    statements = [statement.on_conflict_do_update(
+        index_elements=["kind", "document_id"],
+        set_={
+            "title": statement.excluded.title,
+            "body": statement.excluded.body,
+            "tags": statement.excluded.tags,
+            "updated_on": func.current_timestamp(),
+        },
+        where=(table.c.title != statement.excluded.title) | (table.c.body != statement.excluded.body)
+        | (table.c.tags != statement.excluded.tags),
+    )]
+
+    # Only words long enough to be a correction are kept, sorted so concurrent writers lock them in one order
+    terms = sorted({
+        word for word in _words(f"{title} {body} {tags}") if search_config.typo_min_length - 1 <= len(word) <= 64
+    })
+    for start in range(0, len(terms), _TERMS_PER_STATEMENT):
+        statements.append(
+            db.connection.get_insert(db.models.SearchTerm)
+            .values([
+                {"term": term, "initial": term[0], "length": len(term)}
+                for term in terms[start:start + _TERMS_PER_STATEMENT]
+            ])
+            .on_conflict_do_nothing(index_elements=["term"])
+        )
+    return statements
+
+
+def delete_statement(kind: str, document_id: str):
+    # Words stay in search_terms, a correction to a word nothing contains anymore matches nothing
+    return delete(db.models.SearchDocument).where(
+        db.models.SearchDocument.kind == kind, db.models.SearchDocument.document_id == document_id
+    )
+
+
+def index_document(kind: str, document_id: str, title: str, body: str = "", tags: list[str] = ()):
+    """Index a document in its own transaction, see index_statements"""
+    with db.connection.get_session() as session:
+        for statement in index_statements(kind, document_id, title, body, tags):
+            session.execute(statement)
+        session.commit()
+
+
+async def index_document_async(kind: str, document_id: str, title: str, body: str = "", tags: list[str] = ()):
+    async with db.connection.get_async_session() as session:
+        for statement in index_statements(kind, document_id, title, body, tags):
+            await session.execute(statement)
+        await session.commit()
+
+
+def remove_document(kind: str, document_id: str):
+    with db.connection.get_session() as session:
+        session.execute(delete_statement(kind, document_id))
+        session.commit()
+
+
+async def remove_document_async(kind: str, document_id: str):
+    async with db.connection.get_async_session() as session:
+        await session.execute(delete_statement(kind, document_id))
+        await session.commit()
+
+
+def index_categories() -> int:
+    """
+    Index the seeded recipe categories, their id is the lowercase name
+    :return: number of categories
+    """
+
+    categories = configuration.get_settings(configuration.AppRecipeCategories).categories
+    with db.connection.get_session() as session:
+        for category in categories:
+            for statement in index_statements(CATEGORY, category.lower()[:36], category):
+                session.execute(statement)
+        session.commit()
+    return len(categories)
+
+
+def optimize_index():
+    """Merge the FTS5 segments left by incremental writes, Postgres maintains its GIN index itself"""
+    if _is_postgres():
+        return
+    with db.connection.get_session() as session:
+        session.execute(text("INSERT INTO search_index(search_index) VALUES ('optimize')"))
+        session.commit()
+
+
+def rebuild_index():
+    """Build the FTS5 index again from search_documents, e.g. after rows were copied in without triggers"""
+    if _is_postgres():
+        return
+    with db.connection.get_session() as session:
+        session.execute(text("INSERT INTO search_index(search_index) VALUES ('rebuild')"))
+        session.commit()
+
+
+def _within_one_edit(word: str, candidate: str) -> bool:
+    """One insertion, deletion, substitution or transposition of adjacent characters apart"""
+    if abs(len(word) - len(candidate)) > 1:
+        return False
+    if len(word) == len(candidate):
+        differences = [index for index, (a, b) in enumerate(zip(word, candidate)) if a != b]
+        if len(differences) == 1:
+            return True
+        if len(differences) != 2 or differences[1] != differences[0] + 1:
+            return False
+        first, second = differences
+        return word[first] == candidate[second] and word[second] == candidate[first]
+    shorter, longer = sorted((word, candidate), key=len)
+    index = next((index for index, (a, b) in enumerate(zip(shorter, longer)) if a != b), len(shorter))
+    return shorter[index:] == longer[index + 1:]
+
+
+def _kinds_filter(statement: str, kinds: list[str] | None):
+    statement = text(statement.format(kinds=" AND search_documents.kind IN :kinds" if kinds else ""))
+    return statement.bindparams(bindparam("kinds", expanding=True)) if kinds else statement
+
+
+def _sqlite_statements(kinds: list[str] | None) -> dict:
+    source = "FROM search_index JOIN search_documents ON search_documents.id = search_index.rowid " \
+             "WHERE search_index MATCH :match{kinds}"
+    return {
+        "exists": text("SELECT 1 FROM search_index WHERE search_index MATCH :match LIMIT 1"),
+        "page": _kinds_filter(
+            "SELECT search_documents.kind, search_documents.document_id, search_documents.title, -rank AS score "
+            f"{source} AND rank MATCH '{_SQLITE_RANK}' ORDER BY rank, search_documents.id LIMIT :limit OFFSET :offset",
+            kinds,
+        ),
+        "count": _kinds_filter(f"SELECT count(*) {source}", kinds),
+    }
+
+
+def _postgres_statements(kinds: list[str] | None) -> dict:
+    return {
+        "exists": text(
+            "SELECT 1 FROM search_documents WHERE search_vector @@ to_tsquery('simple', search_unaccent(:match)) "
+            "LIMIT 1"
+        ),
+        "page": _kinds_filter(
+            "SELECT search_documents.kind, search_documents.document_id, search_documents.title, "
+            "ts_rank_cd(search_vector, query) AS score "
+            "FROM search_documents, to_tsquery('simple', search_unaccent(:match)) AS query "
+            "WHERE search_vector @@ query{kinds} ORDER BY score DESC, search_documents.id LIMIT :limit OFFSET :offset",
+            kinds,
+        ),
+        "count": _kinds_filter(
+            "SELECT count(*) FROM search_documents "
+            "WHERE search_vector @@ to_tsquery('simple', search_unaccent(:match)){kinds}",
+            kinds,
+        ),
+    }
+
+
+def _sqlite_matches(words: list[tuple[str, list[str] | None]]) -> tuple[str, str]:
+    """FTS5 queries of the documents with all the words in their title, and of the other ones"""
+    everywhere = " AND ".join(
+        "(" + " OR ".join(f'"{correction}"' for correction in corrections) + ")" if corrections else f'"{term}"*'
+        for term, corrections in words
+    )
+    in_titles = f"{{title}} : ({everywhere})"
+    return in_titles, f"({everywhere}) NOT ({in_titles})"
+
+
+def _postgres_matches(words: list[tuple[str, list[str] | None]]) -> tuple[str, str]:
+    """tsqueries of the documents with all the words in their title, weight A, and of the other ones"""
+
+    def query(weight: str) -> str:
+        return " & ".join(
+            "(" + " | ".join(f"{correction}:{weight}" for correction in corrections) + ")"
+            if corrections else f"{term}:*{weight}"
+            for term, corrections in words
+        )
+
+    in_titles = query("A")
+    return in_titles, f"({query('')}) & !({in_titles})"
+
+
+def _search_steps(terms: list[str], kinds: list[str] | None, limit: int, offset: int):
+    """
+    The queries of a search, shared by search and search_async: yields each statement with its parameters and
+    is sent back the rows it returned
+    :return: rows of the page, one more than `limit` when there is a next page, and how the words matched
+    """
+
+    postgres = _is_postgres()
+    statements = _postgres_statements(kinds) if postgres else _sqlite_statements(kinds)
+    filters = {"kinds": kinds} if kinds else {}
+
+    words = []
+    for term in terms:
+        corrections = None
+        # The words only hold letters and digits, they need no quoting in either query syntax
+        prefix = f"{term}:*" if postgres else f'"{term}"*'
+        if len(term) >= search_config.typo_min_length and not (yield statements["exists"], {"match": prefix}):
+            candidates = yield _TYPO_CANDIDATES, {
+                # A typo in the first character is not corrected, it would need a scan of all the words
+                "initial": term[0], "shortest": len(term) - 1, "longest": len(term) + 1,
+            }
+            corrections = sorted(
+                candidate for candidate, in candidates if _within_one_edit(term, candidate)
+            )[:search_config.typo_candidates] or None
+        words.append((term, corrections))
+    match = "typo" if any(corrections for _, corrections in words) else "words"
+
+    in_titles, elsewhere = _postgres_matches(words) if postgres else _sqlite_matches(words)
+    rows = yield statements["page"], {**filters, "match": in_titles, "limit": limit + 1, "offset": offset}
+    if len(rows) > limit:
+        return rows, match
+
+    if rows or not offset:
+        matched_in_titles = offset + len(rows)
+    else:
+        matched_in_titles = (yield statements["count"], {**filters, "match": in_titles})[0][0]
+    rows += yield statements["page"], {
+        **filters, "match": elsewhere, "limit": limit + 1 - len(rows), "offset": max(0, offset - matched_in_titles),
+    }
+    return rows, match
+
+
+def _page(rows: list, match: str, limit: int, offset: int) -> tuple[list, int | None]:
+    appMetrics.SEARCH_QUERIES.labels(match if rows else "none").inc()
+    return rows[:limit], offset + limit if len(rows) > limit else None
+
+
+def search(query: str, kinds: list[str] = None, limit: int = None, offset: int = 0) -> tuple[list, int | None]:
+    """
+    Ranked page of the documents matching the query
+    :param query: words typed by the user
+    :param kinds: only documents of these kinds, all of them by default
+    :param limit: page size, `search__default_page_size` by default and at most `search__max_page_size`
+    :param offset: of the page, the next offset returned with the previous one
+    :return: rows with kind, document_id, title and score, best first, and the offset of the next page or None
+    """
+
+    terms = normalize_terms(query)
+    if not terms:
+        return [], None
+    limit, offset = min(limit or search_config.default_page_size, search_config.max_page_size), max(offset, 0)
+    steps = _search_steps(terms, kinds, limit, offset)
+    with db.connection.get_session() as session:
+        try:
+            statement, parameters = next(steps)
+            while True:
+                statement, parameters = steps.send(list(session.execute(statement, parameters)))
+        except StopIteration as finished:
+            rows, match = finished.value
+    return _page(rows, match, limit, offset)
+
+
+async def search_async(query: str, kinds: list[str] = None, limit: int = None,
+                       offset: int = 0) -> tuple[list, int | None]:
+    terms = normalize_terms(query)
+    if not terms:
+        return [], None
+    limit, offset = min(limit or search_config.default_page_size, search_config.max_page_size), max(offset, 0)
+    steps = _search_steps(terms, kinds, limit, offset)
+    async with db.connection.get_async_session() as session:
+        try:
+            statement, parameters = next(steps)
+            while True:
+                statement, parameters = steps.send(list(await session.execute(statement, parameters)))
+        except StopIteration as finished:
+            rows, match = finished.value
+    return _page(rows, match, limit, offset)
@@ -1,12 +1,13 @@
 """Seeders operations"""
 import operations.users
 import operations.roles
+import operations.search
 import configuration
 
 
 def seed_default_user():
-    if len(operations.users.get_users()) == 0:
-        default_user = configuration.DefaultUser()
+    if not operations.users.has_users():
+        default_user = configuration.get_settings(configuration.DefaultUser)
         new_user = operations.users.create_user(
             first_name=default_user.first_name,
             last_name=default_user.last_name,
@@ -14,4 +15,9 @@ def seed_default_user():
             phone_number=default_user.phone_number,
             password=default_user.password)
         admin_role = operations.roles.create_role("ADMIN", new_user.id)
-        operations.users.add_user_to_role(user_id=new_user.id, role_id=admin_role.id, added_by=new_user.id)
\ No newline at end of file
+        operations.users.add_user_to_role(user_id=new_user.id, role_id=admin_role.id, added_by=new_user.id)
+
+
+def seed_search_index():
+    """Index the recipe categories, unchanged ones are left as they are"""
+    operations.search.index_categories()
@@ -0,0 +1,372 @@
+"""Sign in throttling
+
+Failed sign ins are counted per IP and per username in a sliding window, kept as sorted sets of failure
+timestamps. After `free_attempts` failures of a username, or `ip_free_attempts` failures of an IP, the key has
+to wait a backoff that doubles with every further failure, reaching `username_max_failures` or
+`ip_max_failures` locks it out for `lockout_seconds`.
+
+An attempt is recorded as a failure of both keys before the password is looked at and removed again when it
+succeeds, so concurrent guesses see each other and a throttled attempt costs no bcrypt work.
+
+The counters live in a store with the subset of the Redis API used here: a SQLite file shared by the workers
+of the host, Redis itself, or a dict for tests.
+"""
+import os
+import pathlib
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from starlette.concurrency import run_in_threadpool
+
+import appLogging
+import appMetrics
+import configuration
+import exceptions.throttling
+
+throttling_config = configuration.get_config().login_throttling
+
+logging = appLogging.Logger.get_child_logger('throttling')
+
+FAILED = "failed"
+SUCCEEDED = "succeeded"
+CANCELLED = "cancelled"
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sorted_sets (
+    name TEXT NOT NULL, member TEXT NOT NULL, score REAL NOT NULL, PRIMARY KEY (name, member)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_sorted_sets_name_score ON sorted_sets (name, score);
+CREATE TABLE IF NOT EXISTS expirations (name TEXT PRIMARY KEY, expires_at REAL NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS strings (name TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL) WITHOUT ROWID;
+"""
+
+
+def _redis_slice(items: list, start: int, end: int) -> list:
+    """Redis ranges include their end and count negative indexes from the end"""
+    return items[start:end + 1 or None]
+
+
+class SqliteCounterStore:
+    """Redis commands used by the throttling, on a SQLite file every worker of the host opens"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread and process, sqlite3 connections are neither thread nor fork safe
+        if getattr(self._local, "pid", None) != os.getpid():
+            pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(_SQLITE_SCHEMA)
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    def _purge_expired(self, connection: sqlite3.Connection, name: str):
+        expired = connection.execute(
+            "SELECT 1 FROM expirations WHERE name = ? AND expires_at <= ?", (name, time.time())
+        ).fetchone()
+        if expired:
+            connection.execute("DELETE FROM sorted_sets WHERE name = ?", (name,))
+            connection.execute("DELETE FROM expirations WHERE name = ?", (name,))
+
+    def _collect_garbage(self, connection: sqlite3.Connection):
+        now = time.time()
+        connection.execute(
+            "DELETE FROM sorted_sets WHERE name IN (SELECT name FROM expirations WHERE expires_at <= ?)", (now,)
+        )
+        connection.execute("DELETE FROM expirations WHERE expires_at <= ?", (now,))
+        connection.execute("DELETE FROM strings WHERE expires_at <= ?", (now,))
+
+    def zadd(self, name: str, mapping: dict[str, float]) -> int:
+        connection = self._connection()
+        with connection:
+            self._purge_expired(connection, name)
+            connection.executemany(
+                "INSERT OR REPLACE INTO sorted_sets (name, member, score) VALUES (?, ?, ?)",
+                [(name, member, score) for member, score in mapping.items()],
+            )
+            # Keys of attackers that gave up are never read again, sweep them once in a while
+            if random.random() < 0.01:
+                self._collect_garbage(connection)
+        return len(mapping)
+
+    def zrem(self, name: str, *members: str) -> int:
+        connection = self._connection()
+        with connection:
+            return connection.execute(
+                f"DELETE FROM sorted_sets WHERE name = ? AND member IN ({', '.join('?' * len(members))})",
+                (name, *members),
+            ).rowcount
+
+    def zremrangebyscore(self, name: str, min_score: float, max_score: float) -> int:
+        connection = self._connection()
+        with connection:
+            return connection.execute(
+                "DELETE FROM sorted_sets WHERE name = ? AND score BETWEEN ? AND ?", (name, min_score, max_score)
+            ).rowcount
+
+    def zcard(self, name: str) -> int:
+        connection = self._connection()
+        with connection:
+            self._purge_expired(connection, name)
+            return connection.execute("SELECT COUNT(*) FROM sorted_sets WHERE name = ?", (name,)).fetchone()[0]
+
+    def zrange(self, name: str, start: int, end: int, withscores: bool = False) -> list:
+        connection = self._connection()
+        with connection:
+            self._purge_expired(connection, name)
+            rows = connection.execute(
+                "SELECT member, score FROM sorted_sets WHERE name = ? ORDER BY score, member", (name,)
+            ).fetchall()
+        rows = _redis_slice(rows, start, end)
+        return rows if withscores else [member for member, _ in rows]
+
+    def expire(self, name: str, seconds: int) -> bool:
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO expirations (name, expires_at) VALUES (?, ?)", (name, time.time() + seconds)
+            )
+        return True
+
+    def get(self, name: str) -> str | None:
+        row = self._connection().execute(
+            "SELECT value FROM strings WHERE name = ? AND (expires_at IS NULL OR expires_at > ?)", (name, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, name: str, value, ex: int = None) -> bool:
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO strings (name, value, expires_at) VALUES (?, ?, ?)",
+                (name, str(value), time.time() + ex if ex else None),
+            )
+        return True
+
+    def delete(self, *names: str) -> int:
+        connection = self._connection()
+        deleted = 0
+        with connection:
+            for table in ("sorted_sets", "expirations", "strings"):
+                deleted += connection.execute(
+                    f"DELETE FROM {table} WHERE name IN ({', '.join('?' * len(names))})", names
+                ).rowcount
+        return deleted
+
+
+class MemoryCounterStore:
+    """Redis commands used by the throttling, kept in this process"""
+
+    def __init__(self):
+        self._sorted_sets: dict[str, dict[str, float]] = {}
+        self._strings: dict[str, tuple[str, float | None]] = {}
+        self._expirations: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _sorted_set(self, name: str) -> dict[str, float]:
+        if self._expirations.get(name, float("inf")) <= time.time():
+            self._sorted_sets.pop(name, None)
+            self._expirations.pop(name, None)
+        return self._sorted_sets.setdefault(name, {})
+
+    def zadd(self, name: str, mapping: dict[str, float]) -> int:
+        with self._lock:
+            self._sorted_set(name).update(mapping)
+        return len(mapping)
+
+    def zrem(self, name: str, *members: str) -> int:
+        with self._lock:
+            sorted_set = self._sorted_set(name)
+            return sum(sorted_set.pop(member, None) is not None for member in members)
+
+    def zremrangebyscore(self, name: str, min_score: float, max_score: float) -> int:
+        with self._lock:
+            members = self._sorted_set(name)
+            removed = [member for member, score in members.items() if min_score <= score <= max_score]
+            for member in removed:
+                del members[member]
+        return len(removed)
+
+    def zcard(self, name: str) -> int:
+        with self._lock:
+            return len(self._sorted_set(name))
+
+    def zrange(self, name: str, start: int, end: int, withscores: bool = False) -> list:
+        with self._lock:
+            rows = sorted(self._sorted_set(name).items(), key=lambda item: (item[1], item[0]))
+        rows = _redis_slice(rows, start, end)
+        return rows if withscores else [member for member, _ in rows]
+
+    def expire(self, name: str, seconds: int) -> bool:
+        with self._lock:
+            self._expirations[name] = time.time() + seconds
+        return True
+
+    def get(self, name: str) -> str | None:
+        with self._lock:
+            value, expires_at = self._strings.get(name, (None, None))
+            if expires_at is not None and expires_at <= time.time():
+                del self._strings[name]
+                return None
+            return value
+
+    def set(self, name: str, value, ex: int = None) -> bool:
+        with self._lock:
+            self._strings[name] = (str(value), time.time() + ex if ex else None)
+        return True
+
+    def delete(self, *names: str) -> int:
+        deleted = 0
+        with self._lock:
+            for name in names:
+                deleted += sum(
+                    store.pop(name, None) is not None
+                    for store in (self._sorted_sets, self._strings, self._expirations)
+                )
+        return deleted
+
+
+def _redis_store(url: str):
+    try:
+        import redis
+    except ImportError as error:
+        raise RuntimeError("login_throttling__backend=redis needs the redis package") from error
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+class LoginThrottle:
+    """Sliding window counters of failed sign ins, by IP and by username"""
+
+    def __init__(self, store, throttling: configuration.LoginThrottlingConfig):
+        self.store = store
+        self.config = throttling
+
+    def _keys(self, ip: str, username: str) -> tuple[tuple[str, str, int, int], ...]:
+        """Label, key, free attempts and maximum failures of the IP and of the username"""
+        return (
+            ("ip", f"login:ip:{ip}", self.config.ip_free_attempts, self.config.ip_max_failures),
+            ("username", f"login:username:{username.strip().lower()}",
+             self.config.free_attempts, self.config.username_max_failures),
+        )
+
+    def _retry_after(self, key: str, attempt: str, now: float, free_attempts: int) -> float:
+        locked_until = self.store.get(f"{key}:lockout")
+        if locked_until is not None and float(locked_until) > now:
+            return float(locked_until) - now
+
+        self.store.zremrangebyscore(key, 0, now - self.config.window_seconds)
+        failures = [score for member, score in self.store.zrange(key, 0, -1, withscores=True) if member != attempt]
+        if len(failures) < free_attempts:
+            return 0
+        delay = min(self.config.max_backoff_seconds,
+                    self.config.base_backoff_seconds * 2 ** (len(failures) - free_attempts))
+        return max(0.0, float(failures[-1]) + delay - now)
+
+    def begin(self, ip: str, username: str) -> str | None:
+        """
+        Record the attempt as a failure of the IP and the username, then check whether either has to wait
+        :param ip:
+        :param username:
+        :return: the attempt, pass it to settle with the outcome of the password check
+        :raises exceptions.throttling.LoginThrottledException: the attempt is not recorded
+        """
+
+        if not self.config.enabled:
+            return None
+        now = time.time()
+        attempt = f"{now}:{uuid.uuid4().hex[:8]}"
+        keys = self._keys(ip, username)
+        for _, key, _, _ in keys:
+            self.store.zadd(key, {attempt: now})
+            self.store.expire(key, self.config.window_seconds)
+        for label, key, free_attempts, _ in keys:
+            if (retry_after := self._retry_after(key, attempt, now, free_attempts)) > 0:
+                for _, reserved_key, _, _ in keys:
+                    self.store.zrem(reserved_key, attempt)
+                appMetrics.LOGIN_THROTTLED.labels(label).inc()
+                raise exceptions.throttling.LoginThrottledException(retry_after)
+        return attempt
+
+    def record_failure(self, ip: str, username: str):
+        """Keep the failure recorded by begin, locking out the keys that reached their maximum"""
+        if not self.config.enabled:
+            return
+        now = time.time()
+        for _, key, _, max_failures in self._keys(ip, username):
+            if self.store.zcard(key) >= max_failures:
+                self.store.set(f"{key}:lockout", now + self.config.lockout_seconds, ex=self.config.lockout_seconds)
+                logging.warning(f"Sign in locked out for {self.config.lockout_seconds} seconds: {key}")
+
+    def cancel(self, ip: str, username: str, attempt: str | None):
+        """Remove the attempt, it ended before the password was checked"""
+        if not self.config.enabled:
+            return
+        for _, key, _, _ in self._keys(ip, username):
+            self.store.zrem(key, attempt)
+
+    def record_success(self, ip: str, username: str, attempt: str | None):
+        """Remove the attempt and forget the failures of the username, earlier failures of the IP are kept"""
+        if not self.config.enabled:
+            return
+        (_, ip_key, _, _), (_, username_key, _, _) = self._keys(ip, username)
+        self.store.zrem(ip_key, attempt)
+        self.store.delete(username_key, f"{username_key}:lockout")
+
+    def settle(self, ip: str, username: str, attempt: str | None, outcome: str):
+        """
+        Record how an attempt started by begin ended
+        :param ip:
+        :param username:
+        :param attempt:
+        :param outcome: FAILED, SUCCEEDED or CANCELLED when the password was not checked
+        :return:
+        """
+
+        if outcome == FAILED:
+            self.record_failure(ip, username)
+        elif outcome == SUCCEEDED:
+            self.record_success(ip, username, attempt)
+        else:
+            self.cancel(ip, username, attempt)
+
+
+_throttle: LoginThrottle | None = None
+_throttle_lock = threading.Lock()
+
+
+def get_login_throttle() -> LoginThrottle:
+    global _throttle
+    if _throttle is None:
+        with _throttle_lock:
+            if _throttle is None:
+                if throttling_config.backend == configuration.ThrottleBackendOptions.REDIS:
+                    store = _redis_store(throttling_config.redis_url)
+                elif throttling_config.backend == configuration.ThrottleBackendOptions.MEMORY:
+                    store = MemoryCounterStore()
+                else:
+                    store = SqliteCounterStore(throttling_config.sqlite_file)
+                _throttle = LoginThrottle(store, throttling_config)
+    return _throttle
+
+
+def begin_login(ip: str, username: str) -> str | None:
+    return get_login_throttle().begin(ip, username)
+
+
+async def begin_login_async(ip: str, username: str) -> str | None:
+    return await run_in_threadpool(begin_login, ip, username)
+
+
+def settle_login(ip: str, username: str, attempt: str | None, outcome: str):
+    get_login_throttle().settle(ip, username, attempt, outcome)
+
+
+async def settle_login_async(ip: str, username: str, attempt: str | None, outcome: str):
+    await run_in_threadpool(settle_login, ip, username, attempt, outcome)
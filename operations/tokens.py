@@ -0,0 +1,114 @@
+"""JWT token operations"""
+import datetime
+import pathlib
+
+from jose import jwk, jwt, JWTError
+
+import appCache
+import configuration
+
+jwt_config = configuration.get_settings(configuration.JwtToken)
+
+# Value of the `type` claim, a token of one kind is not accepted as the other
+ACCESS = "access"
+REFRESH = "refresh"
+
+
+def _load_key(path: str | None, algorithm: str):
+    if not path:
+        raise ValueError(f"Algorithm {algorithm} requires private_key_file and public_key_file")
+    return jwk.construct(pathlib.Path(path).read_text(), algorithm)
+
+
+if jwt_config.is_asymmetric:
+    _signing_key = _load_key(jwt_config.private_key_file, jwt_config.algorithm)
+    _verifying_key = _load_key(jwt_config.public_key_file, jwt_config.algorithm)
+else:
+    _signing_key = _verifying_key = jwk.construct(jwt_config.secret_key, jwt_config.algorithm)
+_refresh_key = jwk.construct(jwt_config.refresh_secret_key, jwt_config.refresh_algorithm)
+
+# Claims of verified access tokens until they expire. Memory tier only, bearer tokens are not written to disk
+_verified_tokens = appCache.get_cache("verified_tokens", disk=False)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC)
+
+
+def get_public_key() -> str | None:
+    """Return the PEM public key other services need to verify access tokens"""
+    if not jwt_config.is_asymmetric:
+        return None
+    return pathlib.Path(jwt_config.public_key_file).read_text()
+
+
+def create_access_token(subject: str, **claims) -> str:
+    payload = {
+        **claims,
+        "exp": _now() + datetime.timedelta(minutes=jwt_config.access_token_expire_minutes),
+        "sub": subject,
+        "type": ACCESS,
+    }
+    return jwt.encode(payload, key=_signing_key, algorithm=jwt_config.algorithm)
+
+
+def create_refresh_token(subject: str, **claims) -> str:
+    payload = {
+        **claims,
+        "exp": _now() + datetime.timedelta(minutes=jwt_config.refresh_token_expire_minutes),
+        "sub": subject,
+        "type": REFRESH,
+    }
+    return jwt.encode(payload, key=_refresh_key, algorithm=jwt_config.refresh_algorithm)
+
+
+def create_email_token(subject: str, purpose: str, expire_minutes: int) -> str:
+    """
+    Create the token sent in confirmation and password reset emails
+    :param subject:
+    :param purpose: set as the audience, so the token is not accepted as an access token or for another purpose
+    :param expire_minutes:
+    :return:
+    """
+    payload = {
+        "aud": purpose,
+        "exp": _now() + datetime.timedelta(minutes=expire_minutes),
+        "sub": subject,
+    }
+    return jwt.encode(payload, key=_signing_key, algorithm=jwt_config.algorithm)
+
+
+def decode_email_token(token: str, purpose: str) -> dict:
+    return jwt.decode(token, key=_verifying_key, algorithms=[jwt_config.algorithm], audience=purpose)
+
+
+def decode_access_token(token: str) -> dict:
+    """
+    Verify the access token and return its claims
+
+    Verified tokens are cached until they expire, so repeated requests with the same bearer token skip the
+    signature check.
+    :param token:
+    :return:
+    """
+
+    if (claims := _verified_tokens.get(token)) is not None:
+        return dict(claims)
+
+    claims = jwt.decode(token, key=_verifying_key, algorithms=[jwt_config.algorithm])
+    if "exp" not in claims:
+        raise JWTError("Token has no expiration")
+    # Tokens signed with the same key for another use, e.g. email tokens or refresh tokens sharing the key
+    if not claims.get("sub") or claims.get("type") != ACCESS or "aud" in claims:
+        raise JWTError("Not an access token")
+
+    _verified_tokens.set(token, claims, ttl_seconds=claims["exp"] - _now().timestamp())
+    return dict(claims)
+
+
+def decode_refresh_token(token: str) -> dict:
+    claims = jwt.decode(token, key=_refresh_key, algorithms=[jwt_config.refresh_algorithm])
+    # Refresh tokens issued before the type claim have none
+    if not claims.get("sub") or claims.get("type", REFRESH) != REFRESH:
+        raise JWTError("Not a refresh token")
+    return claims
@@ -1,25 +1,26 @@
-import bcrypt
 import datetime
-import logging
+import uuid
+import appCache
+import exceptions.tokens
 import exceptions.users
 import configuration
 import db.connection
 import db.models
+import operations.passwords
+import operations.refresh_tokens
+import operations.response_cache
+import operations.roles
+import operations.tokens
 
-from logging.handlers import RotatingFileHandler
-from jose import jwt, JWTError, ExpiredSignatureError
-from fastapi import HTTPException, Request
-from sqlalchemy import delete, or_, update
+from typing import AsyncIterator, Iterator
+from sqlalchemy import delete, exists, func, select, tuple_, update, Select
+from sqlalchemy.orm import joinedload
 
+user_cache_config = configuration.get_config().user_cache
 
-
-def _hash_password(password: str) -> str:
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
-
-
-def _check_password(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+# Users by id and the ids of users by their ('email', ...) and ('phone_number', ...) keys. Memory tier only,
+# the entries are ORM objects with their role loaded
+_user_cache = appCache.get_cache("users", ttl_seconds=user_cache_config.ttl_seconds, disk=False)
 
 
 def create_user(first_name: str, last_name: str, email: str, phone_number:int, password: str):
@@ -31,8 +32,8 @@ def create_user(first_name: str, last_name: str, email: str, phone_number:int, p
                 first_name=first_name,
                 last_name=last_name,
                 email=email,
-                phone_number=phone_number,
-                password=_hash_password(password)
+                phone_number=str(phone_number) if phone_number else None,
+                password=operations.passwords.hash_password(password)
             )
             session.add(new_user)
             session.commit()
@@ -40,83 +41,506 @@ def create_user(first_name: str, last_name: str, email: str, phone_number:int, p
             return new_user
 
 
-def get_user(*, user_id: str = None, phone_number: int = None, email: str = None) -> db.models.User | None:
+_REQUIRED_IMPORT_FIELDS = ("first_name", "last_name", "password")
+
+
+def _validate_import_row(row: dict) -> str | None:
+    if missing := [field for field in _REQUIRED_IMPORT_FIELDS if not row.get(field)]:
+        return f"Missing {', '.join(missing)}"
+    if not row.get("email") and not row.get("phone_number"):
+        return "Missing email or phone_number"
+    return None
+
+
+def _existing_user_keys(session, emails: set[str], phone_numbers: set[str]) -> tuple[set[str], set[str]]:
+    existing_emails, existing_phone_numbers = set(), set()
+    if emails:
+        existing_emails = set(session.scalars(select(db.models.User.email).where(db.models.User.email.in_(emails))))
+    if phone_numbers:
+        existing_phone_numbers = set(
+            session.scalars(
+                select(db.models.User.phone_number).where(db.models.User.phone_number.in_(phone_numbers))
+            )
+        )
+    return existing_emails, existing_phone_numbers
+
+
+def bulk_create_users(rows: list[dict], batch_size: int = 500) -> list[dict]:
+    """
+    Create many users with one multi-row INSERT per batch
+
+    Rows clashing with an existing email/phone number are reported as duplicates before any password is
+    hashed, the remaining passwords are hashed across all cores and races are resolved with ON CONFLICT.
+    :param rows: dicts with first_name, last_name, email, phone_number and password
+    :param batch_size:
+    :return: per row report in input order
+    """
+
+    report = []
+    for offset in range(0, len(rows), batch_size):
+        report.extend(_bulk_create_users_batch(rows[offset:offset + batch_size], offset))
+    return report
+
+
+def _bulk_create_users_batch(rows: list[dict], offset: int) -> list[dict]:
+    # Normalised copies, the rows of the caller are left as they were
+    rows = [dict(row) for row in rows]
+    report = [{"row": offset + index, "email": row.get("email")} for index, row in enumerate(rows)]
+    for entry, row in zip(report, rows):
+        if error := _validate_import_row(row):
+            entry.update(status="invalid", error=error)
+        elif row.get("phone_number"):
+            row["phone_number"] = str(row["phone_number"])
+
     with db.connection.get_session() as session:
-        query = session.query(db.models.User)
-        filters = []
+        existing_emails, existing_phone_numbers = _existing_user_keys(
+            session,
+            {row["email"] for entry, row in zip(report, rows) if "status" not in entry and row.get("email")},
+            {row["phone_number"] for entry, row in zip(report, rows) if "status" not in entry and row.get("phone_number")},
+        )
+
+        seen_emails, seen_phone_numbers = set(), set()
+        pending = []
+        for entry, row in zip(report, rows):
+            if "status" in entry:
+                continue
+            email, phone_number = row.get("email"), row.get("phone_number")
+            if (email and (email in existing_emails or email in seen_emails)) or \
+                    (phone_number and (phone_number in existing_phone_numbers or phone_number in seen_phone_numbers)):
+                entry.update(status="duplicate")
+                continue
+            if email:
+                seen_emails.add(email)
+            if phone_number:
+                seen_phone_numbers.add(phone_number)
+            pending.append((entry, row))
+
+        if not pending:
+            return report
+
+        hashed_passwords = operations.passwords.hash_passwords([row["password"] for _, row in pending])
+        values = []
+        for (entry, row), hashed_password in zip(pending, hashed_passwords):
+            entry["id"] = str(uuid.uuid4())
+            values.append({
+                "id": entry["id"],
+                "first_name": row["first_name"],
+                "last_name": row["last_name"],
+                "email": row.get("email") or None,
+                "phone_number": row.get("phone_number") or None,
+                "password": hashed_password,
+                "is_email_confirmed": False,
+                "is_phone_confirmed": False,
+            })
+
+        stmt = (
+            db.connection.get_insert(db.models.User)
+            .values(values)
+            .on_conflict_do_nothing()
+            .returning(db.models.User.id)
+        )
+        created = set(session.scalars(stmt))
+        session.commit()
+
+    for entry, _ in pending:
+        if entry["id"] in created:
+            entry["status"] = "created"
+        else:
+            entry.update(status="duplicate")
+            del entry["id"]
+    return report
+
+
+async def create_user_async(first_name: str, last_name: str, email: str, phone_number: int, password: str):
+    if await get_user_async(email=email, phone_number=phone_number):
+        raise exceptions.users.UserAlreadyExists()
+
+    hashed_password = await operations.passwords.hash_password_async(password)
+    async with db.connection.get_async_session() as session:
+        new_user = db.models.User(
+            first_name=first_name,
+            last_name=last_name,
+            email=email,
+            phone_number=str(phone_number) if phone_number else None,
+            password=hashed_password
+        )
+        session.add(new_user)
+        await session.commit()
+        await session.refresh(new_user)
+        return new_user
+
+
+def _user_lookup_statement(column, value) -> Select:
+    # One round-trip for the user, its UserRole and the Role instead of the selectin cascade
+    return (
+        select(db.models.User)
+        .where(column == value)
+        .options(joinedload(db.models.User.role).joinedload(db.models.UserRole.role))
+        .limit(1)
+    )
+
+
+def _lookup_user(column, value) -> db.models.User | None:
+    with db.connection.get_session() as session:
+        return session.scalars(_user_lookup_statement(column, value)).first()
+
+
+async def _lookup_user_async(column, value) -> db.models.User | None:
+    async with db.connection.get_async_session() as session:
+        return (await session.scalars(_user_lookup_statement(column, value))).first()
+
+
+def get_user_by_id(user_id: str) -> db.models.User | None:
+    return _lookup_user(db.models.User.id, user_id)
 
-        if user_id:
-            filters.append(db.models.User.id == user_id)
-        if phone_number:
-            filters.append(db.models.User.phone_number == phone_number)
-        if email:
-            filters.append(db.models.User.email == email)
 
-        if filters:
-            query = query.filter(or_(*filters))
+def get_user_by_email(email: str) -> db.models.User | None:
+    return _lookup_user(db.models.User.email, email)
 
-        user = query.first()
 
+def get_user_by_phone_number(phone_number: int | str) -> db.models.User | None:
+    return _lookup_user(db.models.User.phone_number, str(phone_number))
+
+
+async def get_user_by_id_async(user_id: str) -> db.models.User | None:
+    return await _lookup_user_async(db.models.User.id, user_id)
+
+
+async def get_user_by_email_async(email: str) -> db.models.User | None:
+    return await _lookup_user_async(db.models.User.email, email)
+
+
+async def get_user_by_phone_number_async(phone_number: int | str) -> db.models.User | None:
+    return await _lookup_user_async(db.models.User.phone_number, str(phone_number))
+
+
+def get_user(*, user_id: str = None, phone_number: int = None, email: str = None) -> db.models.User | None:
+    """
+    Return the first user matching any of the given keys, each key is looked up through its own index
+    :param user_id:
+    :param phone_number:
+    :param email:
+    :return:
+    """
+
+    if user_id and (user := get_user_by_id(user_id)):
+        return user
+    if email and (user := get_user_by_email(email)):
+        return user
+    if phone_number and (user := get_user_by_phone_number(phone_number)):
+        return user
+    return None
+
+
+async def get_user_async(*, user_id: str = None, phone_number: int = None, email: str = None) -> db.models.User | None:
+    if user_id and (user := await get_user_by_id_async(user_id)):
+        return user
+    if email and (user := await get_user_by_email_async(email)):
+        return user
+    if phone_number and (user := await get_user_by_phone_number_async(phone_number)):
+        return user
+    return None
+
+
+def _cache_keys(user: db.models.User) -> list[tuple[str, str]]:
+    keys = []
+    if user.email:
+        keys.append(('email', user.email))
+    if user.phone_number:
+        keys.append(('phone_number', str(user.phone_number)))
+    return keys
+
+
+def _cache_user(user: db.models.User):
+    _user_cache.set(user.id, user)
+    for key in _cache_keys(user):
+        _user_cache.set(key, user.id)
+
+
+def _get_cached_user(user_id: str = None, key: tuple[str, str] = None) -> db.models.User | None:
+    if user_id is None and key is not None:
+        user_id = _user_cache.get(key)
+    if user_id is None or (user := _user_cache.get(user_id)) is None:
+        return None
+    # A key entry can outlive the user entry it points to, the user cached since may have another email
+    if key is not None and key not in _cache_keys(user):
+        return None
     return user
 
 
+async def get_cached_user_async(
+    user_id: str = None, *, email: str = None, phone_number: int = None
+) -> db.models.User | None:
+    """
+    Return the user from the `users` namespace of appCache, loading it with a single joined query on a miss
+
+    Writes in this module invalidate the entry of the current worker, other workers see the change once
+    their entry expires. Use the uncached lookups where a stale password or role is not acceptable.
+    :param user_id:
+    :param email:
+    :param phone_number:
+    :return:
+    """
+
+    key = None
+    if not user_id:
+        if email:
+            key = ('email', email)
+        elif phone_number:
+            key = ('phone_number', str(phone_number))
+
+    if user := _get_cached_user(user_id, key):
+        return user
+
+    if user := await get_user_async(user_id=user_id, email=email, phone_number=phone_number):
+        _cache_user(user)
+    return user
+
+
+def invalidate_cached_user(user_id: str):
+    if (user := _user_cache.get(user_id)) is not None:
+        for key in _cache_keys(user):
+            _user_cache.delete(key)
+    _user_cache.delete(user_id)
+    operations.response_cache.invalidate(("user", user_id))
+
+
+_PROFILE_COLUMNS = tuple(
+    column.key for column in db.models.User.__table__.columns if column.key not in ("id", "password")
+)
+
+
+def user_etag(user: db.models.User, catalog: operations.roles.RoleCatalog = None) -> str:
+    """
+    ETag of the user profile, changes with the user row, its role assignment and the role catalog
+
+    `updated_on` has a one second resolution on SQLite, the profile columns are hashed along with it so two
+    updates within the same second still change the ETag.
+    :param user:
+    :param catalog: defaults to the catalog of this worker, async callers pass the one of get_role_catalog_async
+    :return:
+    """
+
+    if catalog is None:
+        catalog = operations.roles.get_role_catalog()
+    role = (user.role.role_id, user.role.added_on) if user.role else None
+    return operations.response_cache.make_etag(
+        "user", user.id, *(getattr(user, column) for column in _PROFILE_COLUMNS), role, catalog.version,
+    )
+
+
+async def user_etag_async(user: db.models.User) -> str:
+    return user_etag(user, await operations.roles.get_role_catalog_async())
+
+
+def _create_access_token(user: db.models.User, catalog: operations.roles.RoleCatalog = None) -> str:
+    claims = {}
+    if user.role:
+        catalog = catalog or operations.roles.get_role_catalog()
+        claims["role"] = catalog.name_of(user.role.role_id) or user.role.role.name
+    return operations.tokens.create_access_token(str(user.id), **claims)
+
+
+async def _create_access_token_async(user: db.models.User) -> str:
+    catalog = await operations.roles.get_role_catalog_async() if user.role else None
+    return _create_access_token(user, catalog)
+
+
+def _create_tokens(user: db.models.User) -> tuple[str, str]:
+    return _create_access_token(user), operations.refresh_tokens.issue_refresh_token(str(user.id))
+
+
+async def _create_tokens_async(user: db.models.User) -> tuple[str, str]:
+    return (
+        await _create_access_token_async(user),
+        await operations.refresh_tokens.issue_refresh_token_async(str(user.id)),
+    )
+
+
 def sign_in(email: str, password: str | None = None):
-    if user := get_user(email=email):
-        if password and not _check_password(password, user.password):
-            raise exceptions.users.WrongCredentialsException()
-        access_payload = {"exp": datetime.datetime.now(datetime.UTC) + datetime.timedelta(minutes=60), "sub": str(user.id)}
-        if user.role:
-            access_payload["role"] = user.role.role.name
-        jwt_config = configuration.JWT()
-        access_token = jwt.encode(access_payload, key=jwt_config.key, algorithm=jwt_config.algorithm)
-
-        refresh_payload = {
-            "exp": datetime.datetime.now(datetime.UTC) + datetime.timedelta(days=7),  # 7 days
-            "sub": str(user.id),
-        }
-        refresh_token = jwt.encode(refresh_payload, key=jwt_config.key, algorithm=jwt_config.algorithm)
-
-        return access_token, refresh_token
+    if user := get_user_by_email(email):
+        if password:
+            if not operations.passwords.check_password(password, user.password):
+                raise exceptions.users.WrongCredentialsException()
+            if operations.passwords.needs_rehash(user.password):
+                _store_password_hash(user.id, operations.passwords.hash_password(password))
+        return _create_tokens(user)
 
     else:
         raise exceptions.users.UserDoesNotExistException()
 
 
-def get_new_access_token(request: Request):
-    jwt_config = configuration.JWT()
-    refresh_token = request.cookies.get("refresh_token")
-    if not refresh_token:
-        raise HTTPException(status_code=401, detail="Refresh token missing")
+async def sign_in_async(email: str, password: str | None = None):
+    if user := await get_user_by_email_async(email):
+        if password:
+            if not await operations.passwords.check_password_async(password, user.password):
+                raise exceptions.users.WrongCredentialsException()
+            if operations.passwords.needs_rehash(user.password):
+                await _store_password_hash_async(user.id, await operations.passwords.hash_password_async(password))
+        return await _create_tokens_async(user)
+
+    else:
+        raise exceptions.users.UserDoesNotExistException()
 
-    try:
-        payload = jwt.decode(refresh_token, key=jwt_config.key, algorithms=[jwt_config.algorithm])
 
-        access_payload = {
-            "exp": datetime.datetime.now(datetime.UTC) + datetime.timedelta(minutes=60),  # 1 hour
-            "sub": payload["sub"],
-        }
-        access_token = jwt.encode(access_payload, key=jwt_config.key, algorithm=jwt_config.algorithm)
+def refresh_tokens(refresh_token: str) -> tuple[str, str]:
+    """
+    Rotate the refresh token and issue an access token with the claims of sign_in
+    :param refresh_token:
+    :return: access token and the refresh token replacing the given one
+    """
 
-        return access_token
+    user_id, new_refresh_token = operations.refresh_tokens.rotate_refresh_token(refresh_token)
+    if not (user := get_user_by_id(user_id)):
+        raise exceptions.tokens.InvalidRefreshTokenException("User does not exist")
+    return _create_access_token(user), new_refresh_token
 
-    except ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Refresh token expired")
 
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid refresh token")
+async def refresh_tokens_async(refresh_token: str) -> tuple[str, str]:
+    user_id, new_refresh_token = await operations.refresh_tokens.rotate_refresh_token_async(refresh_token)
+    # The role comes from the cached user and the role catalog, no query when the user is cached
+    if not (user := await get_cached_user_async(user_id)):
+        raise exceptions.tokens.InvalidRefreshTokenException("User does not exist")
+    return await _create_access_token_async(user), new_refresh_token
+
 
 def get_users():
     with db.connection.get_session() as session:
         return session.query(db.models.User).all()
 
 
+def has_users() -> bool:
+    """Cheap EXISTS probe, does not load any rows"""
+    with db.connection.get_session() as session:
+        return session.scalar(select(exists().select_from(db.models.User)))
+
+
+def count_users() -> int:
+    with db.connection.get_session() as session:
+        return session.scalar(select(func.count()).select_from(db.models.User))
+
+
+_USER_LISTING_COLUMNS = (
+    db.models.User.id,
+    db.models.User.first_name,
+    db.models.User.last_name,
+    db.models.User.email,
+    db.models.User.phone_number,
+    db.models.User.is_email_confirmed,
+    db.models.User.is_phone_confirmed,
+    db.models.User.updated_on,
+    db.models.Role.name.label("role"),
+)
+
+
+def _user_listing_statement() -> Select:
+    # Flat rows with the role name joined in, so listing never touches the ORM relationship loaders
+    return (
+        select(*_USER_LISTING_COLUMNS)
+        .outerjoin(db.models.UserRole, db.models.UserRole.user_id == db.models.User.id)
+        .outerjoin(db.models.Role, db.models.Role.id == db.models.UserRole.role_id)
+        .order_by(db.models.User.updated_on, db.models.User.id)
+    )
+
+
+def list_users_page(
+    after: tuple[datetime.datetime, str] | None = None, limit: int = 100
+) -> tuple[list[dict], tuple[datetime.datetime, str] | None]:
+    """
+    Return one keyset page of users ordered by (updated_on, id)
+    :param after: (updated_on, id) of the last user of the previous page
+    :param limit:
+    :return: users of the page and the key to pass as `after` for the next page, None on the last page
+    """
+
+    stmt = _user_listing_statement().limit(limit)
+    if after:
+        stmt = stmt.where(tuple_(db.models.User.updated_on, db.models.User.id) > tuple_(*after))
+
+    with db.connection.get_session() as session:
+        users = [dict(row._mapping) for row in session.execute(stmt)]
+
+    next_after = (users[-1]["updated_on"], users[-1]["id"]) if len(users) == limit else None
+    return users, next_after
+
+
+def iter_users(batch_size: int = 1000) -> Iterator[dict]:
+    """
+    Stream every user in batches of `batch_size` rows, memory stays flat regardless of the table size
+    :param batch_size:
+    :return:
+    """
+
+    stmt = _user_listing_statement().execution_options(yield_per=batch_size)
+    with db.connection.get_session() as session:
+        for row in session.execute(stmt):
+            yield dict(row._mapping)
+
+
+async def iter_users_async(batch_size: int = 1000) -> AsyncIterator[dict]:
+    stmt = _user_listing_statement().execution_options(yield_per=batch_size)
+    async with db.connection.get_async_session() as session:
+        async for row in await session.stream(stmt):
+            yield dict(row._mapping)
+
+
+async def get_users_async():
+    async with db.connection.get_async_session() as session:
+        return (await session.scalars(select(db.models.User))).all()
+
+
 def add_user_to_role(user_id: str, role_id: str, added_by: str):
     with db.connection.get_session() as session:
         user_to_role = db.models.UserRole(user_id=user_id, role_id=role_id, added_by=added_by)
         session.add(user_to_role)
         session.commit()
         session.refresh(user_to_role)
-        return user_to_role
+    invalidate_cached_user(user_id)
+    return user_to_role
+
+
+async def add_user_to_role_async(user_id: str, role_id: str, added_by: str):
+    async with db.connection.get_async_session() as session:
+        user_to_role = db.models.UserRole(user_id=user_id, role_id=role_id, added_by=added_by)
+        session.add(user_to_role)
+        await session.commit()
+        await session.refresh(user_to_role)
+    invalidate_cached_user(user_id)
+    return user_to_role
+
+
+def bulk_add_users_to_role(
+    user_ids: list[str], role_id: str, added_by: str | None, batch_size: int = 500
+) -> list[dict]:
+    """
+    Assign the role to many users with one multi-row INSERT per batch, users that already have it are reported
+    as skipped
+    :param user_ids:
+    :param role_id:
+    :param added_by:
+    :param batch_size:
+    :return: per user report
+    """
+
+    added = set()
+    with db.connection.get_session() as session:
+        for offset in range(0, len(user_ids), batch_size):
+            values = [
+                {"user_id": user_id, "role_id": role_id, "added_by": added_by}
+                for user_id in user_ids[offset:offset + batch_size]
+            ]
+            stmt = (
+                db.connection.get_insert(db.models.UserRole)
+                .values(values)
+                .on_conflict_do_nothing()
+                .returning(db.models.UserRole.user_id)
+            )
+            added.update(session.scalars(stmt))
+            session.commit()
+
+    for user_id in added:
+        invalidate_cached_user(user_id)
+    return [{"user_id": user_id, "status": "added" if user_id in added else "skipped"} for user_id in user_ids]
 
 
 def remove_user_from_role(user_id: str, role_id: str):
@@ -124,24 +548,43 @@ def remove_user_from_role(user_id: str, role_id: str):
         stmt = delete(db.models.UserRole).where(db.models.UserRole.role_id == role_id, db.models.UserRole.user_id == user_id)
         session.execute(stmt)
         session.commit()
+    invalidate_cached_user(user_id)
+
+
+def _store_password_hash(user_id: str, hashed_password: str):
+    with db.connection.get_session() as session:
+        session.execute(update(db.models.User), [{"id": user_id, "password": hashed_password}])
+        session.commit()
+    invalidate_cached_user(user_id)
+
+
+async def _store_password_hash_async(user_id: str, hashed_password: str):
+    async with db.connection.get_async_session() as session:
+        await session.execute(update(db.models.User), [{"id": user_id, "password": hashed_password}])
+        await session.commit()
+    invalidate_cached_user(user_id)
 
 
 def update_user(user_id: str, field: str, value: str):
     if field == 'password':
-        value = _hash_password(password=value)
+        value = operations.passwords.hash_password(value)
 
     with db.connection.get_session() as session:
         session.execute(update(db.models.User), [{"id": user_id, field: value}])
         session.commit()
+    invalidate_cached_user(user_id)
+    if field == 'password':
+        # Sessions opened with the old password, possibly by whoever stole it, end with it
+        operations.refresh_tokens.revoke_user_refresh_tokens(user_id)
 
 
-logger = logging.getLogger("debug")
-log_file = configuration.ROOT_PATH / 'logs' / "debug.log"
-handler = RotatingFileHandler(log_file, maxBytes=10485760, backupCount=5)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                              datefmt='%Y-%m-%d %H:%M:%S')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
-
+async def update_user_async(user_id: str, field: str, value: str):
+    if field == 'password':
+        value = await operations.passwords.hash_password_async(value)
 
+    async with db.connection.get_async_session() as session:
+        await session.execute(update(db.models.User), [{"id": user_id, field: value}])
+        await session.commit()
+    invalidate_cached_user(user_id)
+    if field == 'password':
+        await operations.refresh_tokens.revoke_user_refresh_tokens_async(user_id)
@@ -0,0 +1,14 @@
+import datetime
+
+import pydantic
+
+
+class Image(pydantic.BaseModel):
+    id: str
+    content_type: str
+    size_bytes: int
+    width: int | None
+    height: int | None
+    status: str
+    urls: dict[str, str]
+    created_on: datetime.datetime
@@ -0,0 +1,15 @@
+import pydantic
+
+
+class SearchHit(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(from_attributes=True)
+
+    kind: str
+    document_id: str
+    title: str
+    score: float
+
+
+class SearchResults(pydantic.BaseModel):
+    hits: list[SearchHit]
+    next_offset: int | None
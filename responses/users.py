@@ -6,31 +6,37 @@ import pydantic
 
 
 class Role(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(from_attributes=True)
+
     name: str
     id: str
     created_on: datetime.datetime
-    created_by: str
+    created_by: str | None
 
 
 class UserRole(pydantic.BaseModel):
-    added_by: str
+    model_config = pydantic.ConfigDict(from_attributes=True)
+
+    added_by: str | None
     added_on: datetime.datetime
     role: Role
 
 
 class User(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(from_attributes=True)
+
     id: str
     first_name: str
     last_name: str
-    email: str
-    phone_number: int
-    role: UserRole
+    email: str | None
+    phone_number: str | None
+    role: UserRole | None
     is_email_confirmed: bool
     is_phone_confirmed: bool
-    updated_by: int | None
+    updated_by: str | None
     updated_on: datetime.datetime
 
 
 class Authentication(pydantic.BaseModel):
     access_token: str
-    token_type: str
\ No newline at end of file
+    token_type: str
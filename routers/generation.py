@@ -0,0 +1,48 @@
+from typing import Annotated
+
+import fastapi
+from fastapi.responses import StreamingResponse
+
+import appLogging
+import dependencies.users
+import exceptions.llm
+import operations.llm
+
+generation_router = fastapi.APIRouter()
+
+logging = appLogging.Logger.get_child_logger('generation')
+
+
+@generation_router.post('/recipe', response_class=StreamingResponse)
+async def generate_recipe(
+        prompt: Annotated[str, fastapi.Body(embed=True, min_length=3, max_length=2000)],
+        principal: dependencies.users.CurrentPrincipal,
+):
+    """
+    Generate a recipe, the text is streamed as the model writes it
+    :param prompt: what the recipe should be, e.g. "a vegetarian lasagne for four"
+    :param principal:
+    :return: text/plain, identical prompts are answered from the cache
+    """
+
+    chunks = operations.llm.stream(operations.llm.recipe_messages(prompt))
+    # The first chunk is awaited here, so a failure before anything was generated is an error status
+    try:
+        first_chunk = await anext(chunks, "")
+    except exceptions.llm.LlmUnavailableException as error:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(error), headers={"Retry-After": "5"}
+        )
+    except exceptions.llm.LlmRequestException as error:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_502_BAD_GATEWAY, detail=str(error))
+
+    async def body():
+        yield first_chunk
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except (exceptions.llm.LlmUnavailableException, exceptions.llm.LlmRequestException) as error:
+            # The status is sent already, the client sees a truncated answer
+            logging.warning(f"Recipe generation stopped for {principal.id}: {error}")
+
+    return StreamingResponse(body(), media_type="text/plain; charset=utf-8")
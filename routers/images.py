@@ -0,0 +1,69 @@
+import fastapi
+from fastapi.responses import JSONResponse
+
+import dependencies.users
+import exceptions.images
+import operations.images
+import responses.images
+from operations.images import images_config
+
+images_router = fastapi.APIRouter()
+
+
+def _image_response(image, status_code: int) -> JSONResponse:
+    content = responses.images.Image(
+        id=image.id,
+        content_type=image.content_type,
+        size_bytes=image.size_bytes,
+        width=image.width,
+        height=image.height,
+        status=image.status,
+        urls=operations.images.image_urls(image),
+        created_on=image.created_on,
+    )
+    return JSONResponse(content=content.model_dump(mode="json"), status_code=status_code)
+
+
+@images_router.post('', response_model=responses.images.Image, status_code=fastapi.status.HTTP_201_CREATED)
+async def upload_image(request: fastapi.Request, principal: dependencies.users.CurrentPrincipal):
+    """
+    Upload an image as the raw request body, e.g. `curl --data-binary @photo.jpg`
+
+    Answers 201 with the variants, 202 while they are generated by a Celery worker and 200 when the same
+    image was uploaded before.
+    """
+
+    try:
+        declared_size = int(request.headers.get("content-length", 0))
+    except ValueError:
+        declared_size = 0
+    if declared_size > images_config.max_upload_bytes:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Images are limited to {images_config.max_upload_bytes} bytes",
+        )
+
+    try:
+        image, created = await operations.images.store_upload(request.stream(), principal.id)
+    except exceptions.images.ImageTooLargeException as error:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(error))
+    except exceptions.images.UnsupportedImageTypeException as error:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(error))
+
+    if not created:
+        return _image_response(image, fastapi.status.HTTP_200_OK)
+    image = await operations.images.process_image_async(image)
+    if image.status == "pending":
+        return _image_response(image, fastapi.status.HTTP_202_ACCEPTED)
+    return _image_response(image, fastapi.status.HTTP_201_CREATED)
+
+
+@images_router.get(
+    '/{image_id}',
+    response_model=responses.images.Image,
+    dependencies=[fastapi.Depends(dependencies.users.get_current_principal)],
+)
+async def get_image(image_id: str):
+    if image := await operations.images.get_image_async(image_id):
+        return _image_response(image, fastapi.status.HTTP_200_OK)
+    raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="Image does not exist")
@@ -0,0 +1,34 @@
+import fastapi
+
+import dependencies.roles
+import dependencies.users
+import operations.response_cache
+import responses.users
+
+roles_router = fastapi.APIRouter(dependencies=[fastapi.Depends(dependencies.users.get_current_principal)])
+
+
+@roles_router.get('', response_model=list[responses.users.Role])
+async def list_roles(request: fastapi.Request, catalog: dependencies.roles.RoleCatalog):
+    return operations.response_cache.cached_response(
+        request,
+        ("roles",),
+        operations.response_cache.make_etag("roles", catalog.version),
+        lambda: b"[" + b",".join(
+            responses.users.Role.model_validate(role).model_dump_json().encode('utf-8')
+            for role in sorted(catalog.roles, key=lambda role: role.name)
+        ) + b"]",
+    )
+
+
+@roles_router.get('/{role_id}', response_model=responses.users.Role)
+async def get_role(request: fastapi.Request, role_id: str, catalog: dependencies.roles.RoleCatalog):
+    if not (role := catalog.get_by_id(role_id)):
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="Role does not exist")
+    return operations.response_cache.cached_response(
+        request,
+        ("role", role.id),
+        # Roles are never edited, a row keeps its ETag until it is deleted
+        operations.response_cache.make_etag("role", role.id, role.created_on),
+        lambda: responses.users.Role.model_validate(role).model_dump_json().encode('utf-8'),
+    )
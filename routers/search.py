@@ -0,0 +1,31 @@
+from typing import Annotated, Literal
+
+import fastapi
+
+import operations.search
+import responses.search
+from operations.search import search_config
+
+search_router = fastapi.APIRouter()
+
+
+@search_router.get('', response_model=responses.search.SearchResults)
+async def search(
+        q: Annotated[str, fastapi.Query(min_length=1, max_length=200)],
+        kind: Annotated[list[Literal["recipe", "ingredient", "category"]] | None, fastapi.Query()] = None,
+        limit: Annotated[int, fastapi.Query(ge=1, le=search_config.max_page_size)] = search_config.default_page_size,
+        offset: Annotated[int, fastapi.Query(ge=0)] = 0,
+):
+    """
+    Recipes, ingredients and categories matching all the words of `q`, best first
+    :param q: words, each one matches as a prefix and misspelt ones are corrected
+    :param kind: only these kinds, repeat the parameter for several
+    :param limit: page size
+    :param offset: `next_offset` of the previous page, it is null on the last page
+    :return:
+    """
+
+    hits, next_offset = await operations.search.search_async(q, kind, limit, offset)
+    return responses.search.SearchResults(
+        hits=[responses.search.SearchHit.model_validate(hit) for hit in hits], next_offset=next_offset
+    )
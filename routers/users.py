@@ -1,38 +1,77 @@
 import fastapi
+import json
+import math
 
 from typing import Annotated
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
+import dependencies.users
+import exceptions.passwords
+import exceptions.throttling
+import exceptions.tokens
 import exceptions.users
+import operations.response_cache
+import operations.throttling
 import operations.users
 import responses.users
-from operations.users import get_new_access_token
+from operations.passwords import hashing_config
+from operations.tokens import jwt_config
 
 users_router = fastapi.APIRouter()
 
 
+async def _user_response(request: fastapi.Request, user) -> fastapi.Response:
+    return operations.response_cache.cached_response(
+        request,
+        ("user", user.id),
+        await operations.users.user_etag_async(user),
+        lambda: responses.users.User.model_validate(user).model_dump_json().encode('utf-8'),
+    )
+
+
+def _token_response(access_token: str, refresh_token: str) -> JSONResponse:
+    response = JSONResponse(
+        content={
+            "access_token": access_token,
+            "token_type": "Bearer"
+        }
+    )
+    response.set_cookie(
+        key="refresh_token",
+        value=refresh_token,
+        httponly=True,
+        secure=True,
+        samesite="strict",
+        max_age=jwt_config.refresh_token_expire_minutes * 60
+    )
+    return response
+
+
 @users_router.post('/sign-in', response_model=responses.users.Authentication)
-def sign_in(request: Annotated[OAuth2PasswordRequestForm, fastapi.Depends()]):
+async def sign_in(request: Annotated[OAuth2PasswordRequestForm, fastapi.Depends()], connection: fastapi.Request):
+    ip = connection.client.host if connection.client else "unknown"
     try:
-        access_token, refresh_token = operations.users.sign_in(request.username, request.password)
-
-        response = JSONResponse(
-            content={
-                "access_token": access_token,
-                "token_type": "Bearer"
-            }
-        )
-        response.set_cookie(
-            key="refresh_token",
-            value=refresh_token,
-            httponly=True,
-            secure=True,
-            samesite="strict",
-            max_age=7 * 24 * 60 * 60
+        attempt = await operations.throttling.begin_login_async(ip, request.username)
+    except exceptions.throttling.LoginThrottledException as error:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many failed sign in attempts, try again later",
+            headers={"Retry-After": str(math.ceil(error.retry_after))},
         )
 
-        return response
+    try:
+        outcome = operations.throttling.CANCELLED
+        try:
+            access_token, refresh_token = await operations.users.sign_in_async(request.username, request.password)
+            outcome = operations.throttling.SUCCEEDED
+        except (exceptions.users.UserDoesNotExistException, exceptions.users.WrongCredentialsException):
+            outcome = operations.throttling.FAILED
+            raise
+        finally:
+            await operations.throttling.settle_login_async(ip, request.username, attempt, outcome)
+
+        return _token_response(access_token, refresh_token)
 
     except exceptions.users.UserDoesNotExistException:
         raise fastapi.HTTPException(
@@ -44,8 +83,46 @@ def sign_in(request: Annotated[OAuth2PasswordRequestForm, fastapi.Depends()]):
             status_code=fastapi.status.HTTP_403_FORBIDDEN,
             detail="Incorrect username or password",
         )
+    except exceptions.passwords.PasswordHashingOverloadedException:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many sign in attempts, try again later",
+            headers={"Retry-After": str(hashing_config.retry_after)},
+        )
 
 @users_router.post("/refresh-token", response_model=responses.users.Authentication)
-def refresh(request: fastapi.Request):
-    new_access_token = get_new_access_token(request)
-    return {'access_token': new_access_token, "token_type": "Bearer"}
\ No newline at end of file
+async def refresh(request: fastapi.Request):
+    refresh_token = request.cookies.get("refresh_token")
+    if not refresh_token:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_401_UNAUTHORIZED, detail="Refresh token missing")
+    try:
+        access_token, new_refresh_token = await operations.users.refresh_tokens_async(refresh_token)
+    except exceptions.tokens.InvalidRefreshTokenException as error:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_401_UNAUTHORIZED, detail=str(error))
+    return _token_response(access_token, new_refresh_token)
+
+
+async def _users_as_ndjson():
+    async for user in operations.users.iter_users_async():
+        yield json.dumps(user, default=str) + "\n"
+
+
+@users_router.get('', dependencies=[fastapi.Depends(dependencies.users.require_role("admin"))])
+async def list_users():
+    return StreamingResponse(_users_as_ndjson(), media_type="application/x-ndjson")
+
+
+@users_router.get('/me', response_model=responses.users.User)
+async def get_me(request: fastapi.Request, user: dependencies.users.CurrentUser):
+    return await _user_response(request, user)
+
+
+@users_router.get(
+    '/{user_id}',
+    response_model=responses.users.User,
+    dependencies=[fastapi.Depends(dependencies.users.require_role("admin"))],
+)
+async def get_user(request: fastapi.Request, user_id: str):
+    if user := await operations.users.get_cached_user_async(user_id):
+        return await _user_response(request, user)
+    raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail="User does not exist")
@@ -0,0 +1,93 @@
+"""Local stand-in for the Brevo transactional email API
+
+    python -m stubs.brevo --port 8025 --fail-rate 0.1 --rate-limit 5
+
+Point `email_api_url` at http://127.0.0.1:8025/v3. It accepts `POST /v3/smtp/email` like Brevo, answers
+repeated Idempotency-Key headers with the first response, rejects recipients without an @ with a 400 and can
+fail a share of the calls with a 500 or rate limit them with a 429. Accepted calls are listed by
+`GET /stub/emails` and cleared by `DELETE /stub/emails`.
+"""
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import fastapi
+import uvicorn
+from fastapi.responses import JSONResponse
+
+
+def create_app(fail_rate: float = 0.0, rate_limit: int = None) -> fastapi.FastAPI:
+    """
+    :param fail_rate: share of calls answered with a 500
+    :param rate_limit: calls accepted per second, the others get a 429
+    :return:
+    """
+
+    app = fastapi.FastAPI(docs_url=None, redoc_url=None)
+    lock = threading.Lock()
+    calls: list[dict] = []
+    responses: dict[str, dict] = {}
+    window = {"second": 0, "calls": 0}
+
+    @app.post('/v3/smtp/email')
+    async def send_email(request: fastapi.Request):
+        if not request.headers.get("api-key"):
+            return JSONResponse({"code": "unauthorized", "message": "Key not found"}, status_code=401)
+        idempotency_key = request.headers.get("Idempotency-Key")
+        with lock:
+            if idempotency_key in responses:
+                return JSONResponse(responses[idempotency_key], status_code=201)
+            if rate_limit:
+                second = int(time.time())
+                if window["second"] != second:
+                    window.update(second=second, calls=0)
+                window["calls"] += 1
+                if window["calls"] > rate_limit:
+                    return JSONResponse(
+                        {"code": "too_many_requests", "message": "Rate limit exceeded"},
+                        status_code=429, headers={"Retry-After": "1"},
+                    )
+        if random.random() < fail_rate:
+            return JSONResponse({"code": "internal_error", "message": "Stub failure"}, status_code=500)
+
+        payload = await request.json()
+        versions = payload.get("messageVersions") or [{"to": payload.get("to", [])}]
+        for version in versions:
+            if not version.get("to") or any("@" not in recipient.get("email", "") for recipient in version["to"]):
+                return JSONResponse({"code": "invalid_parameter", "message": "email is not valid"}, status_code=400)
+
+        body = {"messageIds": [f"<{uuid.uuid4()}@stub.brevo>" for _ in versions]}
+        with lock:
+            calls.append({"idempotency_key": idempotency_key, "payload": payload, "message_ids": body["messageIds"]})
+            if idempotency_key:
+                responses[idempotency_key] = body
+        return JSONResponse(body, status_code=201)
+
+    @app.get('/stub/emails')
+    async def list_calls():
+        with lock:
+            return list(calls)
+
+    @app.delete('/stub/emails', status_code=204)
+    async def clear_calls():
+        with lock:
+            calls.clear()
+            responses.clear()
+
+    return app
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int)
+    args = parser.parse_args(argv)
+    uvicorn.run(create_app(args.fail_rate, args.rate_limit), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Local stand-in for the OpenAi chat completions API
+
+    python -m stubs.openai --port 8026 --chunk-delay 0.05 --fail-rate 0.1 --rate-limit 5
+
+Point `chatgpt_api_url` at http://127.0.0.1:8026/v1. It accepts `POST /v1/chat/completions` like OpenAi,
+streamed as server-sent events when `stream` is true, and answers with a made up recipe for the last user
+message, a word per chunk every `--chunk-delay` seconds. Calls without a bearer token get a 401, a share of
+the calls can fail with a 500 or be rate limited with a 429. Accepted calls are listed by
+`GET /stub/completions` and cleared by `DELETE /stub/completions`.
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+
+import fastapi
+import uvicorn
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def _answer(messages: list[dict]) -> str:
+    request = next((message["content"] for message in reversed(messages) if message.get("role") == "user"), "")
+    return (
+        f"Stub recipe: {request}\n\nIngredients:\n- 2 cups of stub flour\n- 1 stub egg\n\n"
+        "Steps:\n1. Mix everything.\n2. Bake for 20 minutes."
+    )
+
+
+def _error(status_code: int, message: str, kind: str, headers: dict = None) -> JSONResponse:
+    return JSONResponse(
+        {"error": {"message": message, "type": kind, "code": None}}, status_code=status_code, headers=headers
+    )
+
+
+def create_app(chunk_delay: float = 0.0, fail_rate: float = 0.0, rate_limit: int = None) -> fastapi.FastAPI:
+    """
+    :param chunk_delay: seconds between the chunks of an answer
+    :param fail_rate: share of calls answered with a 500
+    :param rate_limit: calls accepted per second, the others get a 429
+    :return:
+    """
+
+    app = fastapi.FastAPI(docs_url=None, redoc_url=None)
+    lock = threading.Lock()
+    calls: list[dict] = []
+    window = {"second": 0, "calls": 0}
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: fastapi.Request):
+        if not request.headers.get("authorization", "").removeprefix("Bearer ").strip():
+            return _error(401, "You didn't provide an API key.", "invalid_request_error")
+        if rate_limit:
+            with lock:
+                second = int(time.time())
+                if window["second"] != second:
+                    window.update(second=second, calls=0)
+                window["calls"] += 1
+                if window["calls"] > rate_limit:
+                    return _error(429, "Rate limit reached", "requests", {"Retry-After": "1"})
+        if random.random() < fail_rate:
+            return _error(500, "Stub failure", "server_error")
+
+        payload = await request.json()
+        if not payload.get("messages"):
+            return _error(400, "'messages' is a required property", "invalid_request_error")
+        answer = _answer(payload["messages"])
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        with lock:
+            calls.append({"id": completion_id, "payload": payload})
+
+        if not payload.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload.get("model"),
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}
+                ],
+            }
+
+        async def events():
+            for index, word in enumerate(answer.split(" ")):
+                if chunk_delay:
+                    await asyncio.sleep(chunk_delay)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": payload.get("model"),
+                    "choices": [{"index": 0, "delta": {"content": word if index == 0 else f" {word}"}}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get('/stub/completions')
+    async def list_calls():
+        with lock:
+            return list(calls)
+
+    @app.delete('/stub/completions', status_code=204)
+    async def clear_calls():
+        with lock:
+            calls.clear()
+
+    return app
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8026)
+    parser.add_argument('--chunk-delay', type=float, default=0.0)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int)
+    args = parser.parse_args(argv)
+    uvicorn.run(
+        create_app(args.chunk_delay, args.fail_rate, args.rate_limit), host=args.host, port=args.port,
+        log_level='warning',
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+"""Email Celery tasks"""
+import configuration
+import operations.emails
+
+celery = configuration.get_celery()
+
+
+@celery.task(ignore_result=True)
+def dispatch_emails() -> dict:
+    """Send the due emails of the outbox, scheduled by celery beat"""
+    return operations.emails.dispatch_pending_emails()
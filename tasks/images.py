@@ -0,0 +1,17 @@
+"""Image Celery tasks"""
+import configuration
+import operations.images
+
+celery = configuration.get_celery()
+
+
+@celery.task(ignore_result=True)
+def process_image(image_id: str) -> str:
+    """Generate the variants of an image the upload worker had no room for"""
+    return operations.images.process_image(image_id)
+
+
+@celery.task(ignore_result=True)
+def process_pending_images() -> int:
+    """Generate the variants of images left pending, scheduled by celery beat"""
+    return operations.images.process_pending_images()
@@ -0,0 +1,11 @@
+"""Search Celery tasks"""
+import configuration
+import operations.search
+
+celery = configuration.get_celery()
+
+
+@celery.task(ignore_result=True)
+def optimize_search_index():
+    """Merge the index segments left by incremental writes, scheduled by celery beat"""
+    operations.search.optimize_index()
@@ -0,0 +1,11 @@
+"""Token Celery tasks"""
+import configuration
+import operations.refresh_tokens
+
+celery = configuration.get_celery()
+
+
+@celery.task(ignore_result=True)
+def delete_expired_refresh_tokens() -> int:
+    """Delete the records of expired refresh tokens, scheduled by celery beat"""
+    return operations.refresh_tokens.delete_expired_refresh_tokens()
@@ -0,0 +1,37 @@
+"""Test settings, applied before the app modules read their configuration
+
+Every test runs against the in-memory SQLite database of the process, shared by the sync and async engines,
+with fast password hashing and the caches and metrics under a temporary directory. Tests writing media point
+configuration.IMAGES_PATH at their own tmp_path.
+"""
+import os
+import pathlib
+import tempfile
+
+_scratch = pathlib.Path(tempfile.mkdtemp(prefix="kitchen-helper-tests-"))
+
+os.environ.update({
+    "CONTEXT": "test",
+    "DATABASE": "sqlite",
+    "SQLITE__FILE_NAME": "",
+    "TRACING__EXPORTER": "none",
+    "PASSWORD_HASHING__BCRYPT_ROUNDS": "4",
+    "LOGIN_THROTTLING__BACKEND": "memory",
+    "RABBITMQ__BROKER": "memory",
+    "CACHE__DISK_FILE": str(_scratch.joinpath("cache.db")),
+    "PROMETHEUS_MULTIPROC_DIR": str(_scratch.joinpath("metrics")),
+    "CHATGPT_API_KEY": "test",
+})
+_scratch.joinpath("metrics").mkdir()
+
+import pytest  # noqa: E402
+
+import db.connection  # noqa: E402
+import db.models  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    db.models.DbBaseModel.metadata.create_all(db.connection.get_engine())
+    yield
+    db.connection.dispose_engines()
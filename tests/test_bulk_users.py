@@ -0,0 +1,33 @@
+import sqlalchemy
+
+import db.connection
+import db.models
+import operations.roles
+import operations.users
+
+
+def test_bulk_import_in_batches_leaves_rows_untouched():
+    rows = [
+        {"first_name": "Bulk", "last_name": str(index), "email": f"bulk{index}@import.test",
+         "phone_number": 3598800000 + index, "password": "Password1@"}
+        for index in range(5)
+    ]
+    originals = [dict(row) for row in rows]
+
+    report = operations.users.bulk_create_users(rows, batch_size=2)
+
+    assert rows == originals
+    assert [entry["status"] for entry in report] == ["created"] * 5
+
+    role = operations.roles.create_role("bulk-importers", None)
+    user_ids = [entry["id"] for entry in report]
+    operations.users.bulk_add_users_to_role(user_ids[:1], role.id, None)
+    added = operations.users.bulk_add_users_to_role(user_ids, role.id, None, batch_size=2)
+
+    assert [entry["status"] for entry in added] == ["skipped"] + ["added"] * 4
+    with db.connection.get_session() as session:
+        assert session.scalar(
+            sqlalchemy.select(sqlalchemy.func.count())
+            .select_from(db.models.UserRole)
+            .where(db.models.UserRole.role_id == role.id)
+        ) == 5
@@ -0,0 +1,101 @@
+import asyncio
+import pickle
+import subprocess
+import sys
+import types
+
+import pytest
+
+import appCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time of appCache, moved forward by the test"""
+    now = [1_000_000.0]
+    monkeypatch.setattr(appCache, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def _cache(tmp_path, ttl_seconds: float = 60, memory: appCache.MemoryTier = None) -> appCache.Cache:
+    return appCache.Cache(
+        "test", ttl_seconds, True, memory or appCache.MemoryTier(100, 1024 * 1024),
+        appCache.DiskTier(str(tmp_path.joinpath("cache.db")), 1024 * 1024, 0),
+    )
+
+
+def test_concurrent_misses_load_once(tmp_path):
+    cache = _cache(tmp_path)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"name": "soup"}
+
+    async def load():
+        return await asyncio.gather(*(cache.get_or_set_async("recipe", loader) for _ in range(10)))
+
+    assert asyncio.run(load()) == [{"name": "soup"}] * 10
+    assert len(calls) == 1
+
+
+def test_entries_expire_in_both_tiers(tmp_path, clock):
+    cache = _cache(tmp_path, ttl_seconds=60)
+    cache.set("recipe", "soup")
+    cache.set("short", "salad", ttl_seconds=5)
+
+    clock[0] += 10
+    assert (cache.get("recipe"), cache.get("short")) == ("soup", None)
+    clock[0] += 60
+    assert cache.get("recipe") is None
+    assert cache._disk.get("test:recipe") is appCache._MISSING
+
+
+def test_memory_tier_drops_the_least_recently_used(clock):
+    memory = appCache.MemoryTier(max_entries=2, max_bytes=1024)
+    memory.set("a", "a", clock[0] + 60)
+    memory.set("b", "b", clock[0] + 60)
+    memory.get("a")
+    memory.set("c", "c", clock[0] + 60)
+
+    assert [memory.get(key) for key in "abc"] == ["a", appCache._MISSING, "c"]
+
+    memory.set("large", b"x" * 1000, clock[0] + 60)
+    assert memory.get("a") is appCache._MISSING
+    assert memory.get("large") == b"x" * 1000
+
+
+def test_disk_tier_evicts_every_hundred_writes(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(appCache.random, "random", lambda: 1.0)
+    value = b"x" * 100
+    entry_size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    disk = appCache.DiskTier(str(tmp_path.joinpath("cache.db")), 50 * entry_size, 0)
+
+    def stored() -> list[str]:
+        return [key for key, in disk._connection().execute("SELECT key FROM entries ORDER BY accessed_at")]
+
+    for index in range(99):
+        clock[0] += 1
+        disk.set(f"key{index:03}", value, clock[0] + 3600)
+    assert len(stored()) == 99
+
+    clock[0] += 1
+    disk.set("key099", value, clock[0] + 3600)
+    # Down to 90% of the bound, dropping the least recently used
+    assert stored() == [f"key{index:03}" for index in range(55, 100)]
+
+
+def test_workers_share_the_disk_tier(tmp_path):
+    path = str(tmp_path.joinpath("cache.db"))
+    subprocess.run([sys.executable, "-c", (
+        "import sys, appCache\n"
+        "cache = appCache.Cache('test', 60, True, appCache.MemoryTier(10, 10 ** 6), "
+        "appCache.DiskTier(sys.argv[1], 10 ** 6, 0))\n"
+        "cache.set('recipe', {'name': 'soup'})"
+    ), path], check=True)
+
+    cache = _cache(tmp_path)
+
+    assert cache.get("recipe") == {"name": "soup"}
+    assert cache._memory.get("test:recipe") == {"name": "soup"}
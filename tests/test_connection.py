@@ -0,0 +1,21 @@
+import asyncio
+
+import sqlalchemy
+
+import db.connection
+import db.models
+import operations.users
+
+
+def test_sync_writes_are_seen_by_async_sessions():
+    user = operations.users.create_user("Shared", "Memory", "shared@memory.test", None, "Password1@")
+
+    async def read_email():
+        async with db.connection.get_async_session() as session:
+            email = await session.scalar(
+                sqlalchemy.select(db.models.User.email).where(db.models.User.id == user.id)
+            )
+        await db.connection.dispose_async_engines()
+        return email
+
+    assert asyncio.run(read_email()) == "shared@memory.test"
@@ -0,0 +1,119 @@
+import datetime
+import types
+import uuid
+
+import pytest
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+import configuration
+import db.connection
+import db.models
+import operations.emails
+import stubs.brevo
+
+
+class CountingBucket(operations.emails.TokenBucket):
+    def __init__(self):
+        super().__init__(rate=1000, capacity=1000)
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        super().acquire()
+
+
+def _user(email: str = None):
+    user_id = str(uuid.uuid4())
+    return types.SimpleNamespace(id=user_id, email=email or f"{user_id}@mail.test", first_name="Mail", last_name="Test")
+
+
+def _outbox() -> dict[str, db.models.EmailOutbox]:
+    with db.connection.get_session() as session:
+        return {email.recipient_email: email for email in session.scalars(sqlalchemy.select(db.models.EmailOutbox))}
+
+
+@pytest.fixture
+def brevo(monkeypatch):
+    """Send through a Brevo stub, with an empty outbox and a token bucket that counts the calls it paced"""
+
+    with db.connection.get_session() as session:
+        session.execute(sqlalchemy.delete(db.models.EmailOutbox))
+        session.commit()
+    settings = configuration.get_settings(configuration.BrevoSettings)
+    monkeypatch.setattr(settings, "email_api_key", "test-key")
+    monkeypatch.setattr(settings, "email_api_url", "http://brevo.test/v3")
+    monkeypatch.setattr(operations.emails, "_rate_limiter", CountingBucket())
+
+    def start(**options) -> TestClient:
+        client = TestClient(stubs.brevo.create_app(**options))
+        monkeypatch.setattr(operations.emails, "_client", client)
+        return client
+
+    return start
+
+
+def test_emails_are_sent_in_one_call_per_kind_and_batch(brevo, monkeypatch):
+    stub = brevo()
+    monkeypatch.setattr(operations.emails.dispatch_config, "batch_size", 2)
+    for _ in range(3):
+        operations.emails.queue_confirmation_email(_user())
+    operations.emails.queue_password_reset_email(_user())
+
+    counts = operations.emails.dispatch_pending_emails()
+
+    calls = stub.get("/stub/emails").json()
+    assert counts == {"sent": 4, "retried": 0, "failed": 0}
+    # Two claims of two emails, one of them mixing both kinds
+    assert sorted(len(call["payload"]["messageVersions"]) for call in calls) == [1, 1, 2]
+    assert operations.emails._rate_limiter.acquired == len(calls) == 3
+    assert all(call["idempotency_key"] for call in calls)
+    assert {email.status for email in _outbox().values()} == {"sent"}
+
+
+def test_rate_limited_call_holds_off_the_rest_of_the_run(brevo, monkeypatch):
+    stub = brevo(rate_limit=1)
+    monkeypatch.setattr(stubs.brevo.time, "time", lambda: 1_000_000.0)
+    monkeypatch.setattr(operations.emails.dispatch_config, "batch_size", 1)
+    for _ in range(3):
+        operations.emails.queue_confirmation_email(_user())
+    started = operations.emails._now()
+
+    counts = operations.emails.dispatch_pending_emails()
+
+    assert counts == {"sent": 1, "retried": 1, "failed": 0}
+    assert len(stub.get("/stub/emails").json()) == 1
+    by_status = {}
+    for email in _outbox().values():
+        by_status.setdefault(email.status, []).append(email)
+    limited, untouched = sorted(by_status["pending"], key=lambda email: email.attempts, reverse=True)
+    assert "429" in limited.last_error
+    assert limited.next_attempt_on >= started + datetime.timedelta(seconds=1)
+    assert (untouched.attempts, untouched.last_error) == (0, None)
+
+
+def test_rejected_batch_is_split_to_fail_only_the_bad_recipient(brevo):
+    stub = brevo()
+    operations.emails.queue_confirmation_email(_user())
+    operations.emails.queue_confirmation_email(_user("not-an-address"))
+    operations.emails.queue_confirmation_email(_user())
+
+    counts = operations.emails.dispatch_pending_emails()
+
+    assert counts == {"sent": 2, "retried": 0, "failed": 1}
+    assert all(len(call["payload"]["messageVersions"]) == 1 for call in stub.get("/stub/emails").json())
+    outbox = _outbox()
+    assert outbox.pop("not-an-address").status == "failed"
+    assert {email.status for email in outbox.values()} == {"sent"}
+
+
+def test_duplicate_queue_calls_add_one_email(brevo):
+    user = _user()
+
+    assert operations.emails.queue_confirmation_email(user) is not None
+    assert operations.emails.queue_confirmation_email(user) is None
+    assert operations.emails.queue_password_reset_email(user, "reset-1") is not None
+    assert operations.emails.queue_password_reset_email(user, "reset-1") is None
+    with db.connection.get_session() as session:
+        kinds = session.scalars(sqlalchemy.select(db.models.EmailOutbox.kind).order_by(db.models.EmailOutbox.kind))
+        assert list(kinds) == [operations.emails.CONFIRMATION, operations.emails.PASSWORD_RESET]
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import configuration
+import db.connection
+import operations.images
+
+# PNG signature followed by bytes Pillow cannot decode
+_BROKEN_PNG = b"\x89PNG\r\n\x1a\n" + b"not an image"
+
+
+@pytest.fixture(autouse=True)
+def media(tmp_path, monkeypatch):
+    monkeypatch.setattr(configuration, "IMAGES_PATH", tmp_path.joinpath("images"))
+    monkeypatch.setattr(configuration, "CACHE_PATH", tmp_path.joinpath("cache"))
+    return tmp_path
+
+
+def _upload(body: bytes):
+    async def chunks():
+        yield body
+
+    async def store():
+        try:
+            return await operations.images.store_upload(chunks(), None)
+        finally:
+            await db.connection.dispose_async_engines()
+
+    return asyncio.run(store())
+
+
+def test_failed_image_is_requeued_when_uploaded_again():
+    body = _BROKEN_PNG + b"requeued"
+    image, created = _upload(body)
+    assert created
+    assert operations.images.process_image(image.id) == "failed"
+
+    image, created = _upload(body)
+
+    assert created and image.status == "pending"
+    assert operations.images.image_directory(image.content_hash).joinpath("original.png").read_bytes() == body
+
+
+def test_original_is_removed_when_the_image_cannot_be_recorded(monkeypatch, media):
+    def failing_insert(model):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(db.connection, "get_insert", failing_insert)
+
+    with pytest.raises(RuntimeError):
+        _upload(_BROKEN_PNG + b"orphan")
+
+    assert not list(media.joinpath("images").rglob("original.*"))
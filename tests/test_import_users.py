@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+import import_users
+import operations.roles
+import operations.users
+
+
+def _write_rows(path, *emails):
+    path.write_text("".join(
+        json.dumps({"first_name": "Import", "last_name": "Cli", "email": email, "password": "Password1@"}) + "\n"
+        for email in emails
+    ))
+    return path
+
+
+def test_report_carries_the_role_assignment(tmp_path, capsys):
+    admin = operations.users.create_user("Import", "Admin", "admin@import-cli.test", None, "Password1@")
+    role = operations.roles.create_role("IMPORT-CLI", admin.id)
+    path = _write_rows(tmp_path.joinpath("users.jsonl"), "one@import-cli.test", "two@import-cli.test")
+
+    assert import_users.main([str(path), "--role", role.name, "--added-by", admin.id]) == 0
+
+    report = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(entry["status"], entry["role_status"]) for entry in report] == [("created", "added")] * 2
+
+
+def test_role_needs_added_by(tmp_path):
+    path = _write_rows(tmp_path.joinpath("users.jsonl"), "three@import-cli.test")
+
+    with pytest.raises(SystemExit) as error:
+        import_users.main([str(path), "--role", "IMPORT-CLI"])
+    assert error.value.code == 2
@@ -0,0 +1,106 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+from fastapi.responses import JSONResponse, StreamingResponse
+
+import configuration
+import exceptions.llm
+import operations.llm
+import stubs.openai
+
+
+@pytest.fixture
+def model(monkeypatch):
+    """The stub OpenAi API in place of the real one, the ASGI app is what the client sends requests to"""
+    served = {"app": stubs.openai.create_app()}
+
+    async def app(scope, receive, send):
+        await served["app"](scope, receive, send)
+
+    monkeypatch.setattr(configuration.get_settings(configuration.OpenAi), "chatgpt_api_url", "http://stub/v1")
+    monkeypatch.setattr(operations.llm, "_retry_delay", lambda attempt, response=None: 0)
+    monkeypatch.setattr(operations.llm, "_get_client", lambda: httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://stub"
+    ))
+    return served
+
+
+def _messages() -> list[dict]:
+    # A prompt of its own per test, answers are cached across tests
+    return operations.llm.recipe_messages(f"soup {uuid.uuid4().hex}")
+
+
+def _calls(model) -> int:
+    async def count():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=model["app"]), base_url="http://stub") as client:
+            return len((await client.get("/stub/completions")).json())
+
+    return asyncio.run(count())
+
+
+def _failing(times: int, app, status_code: int = 500):
+    remaining = [times]
+
+    async def failing(scope, receive, send):
+        if remaining[0] > 0:
+            remaining[0] -= 1
+            return await JSONResponse({"error": {"message": "down"}}, status_code=status_code)(scope, receive, send)
+        await app(scope, receive, send)
+
+    return failing
+
+
+def _streaming(*events: str):
+    async def stream(scope, receive, send):
+        async def body():
+            for event in events:
+                yield event
+
+        await StreamingResponse(body(), media_type="text/event-stream")(scope, receive, send)
+
+    return stream
+
+
+def test_concurrent_requests_for_a_prompt_share_one_call_and_the_cache(model):
+    messages = _messages()
+
+    async def ask():
+        return await asyncio.gather(*(operations.llm.complete(messages) for _ in range(5)))
+
+    answers = asyncio.run(ask())
+    assert len(set(answers)) == 1 and answers[0].startswith("Stub recipe: soup")
+    assert _calls(model) == 1
+
+    assert asyncio.run(operations.llm.complete(messages)) == answers[0]
+    assert _calls(model) == 1
+
+
+def test_failed_calls_are_retried(model):
+    model["app"] = _failing(operations.llm.llm_config.max_retries, model["app"])
+
+    assert asyncio.run(operations.llm.complete(_messages())).startswith("Stub recipe")
+
+
+def test_rejected_request_is_not_retried(model):
+    model["app"] = _failing(1, model["app"], status_code=400)
+
+    with pytest.raises(exceptions.llm.LlmRequestException):
+        asyncio.run(operations.llm.complete(_messages()))
+
+
+@pytest.mark.parametrize("events", [
+    ('data: {"choices": [{"delta": {"content": "Half a recipe"}}]}\n\n',),
+    ('data: {"choices": [{"delta": {"content": "Half"}}]}\n\n', "data: {not json\n\n"),
+])
+def test_broken_stream_is_unavailable_and_not_cached(model, events):
+    stub = model["app"]
+    model["app"] = _streaming(*events)
+    messages = _messages()
+
+    with pytest.raises(exceptions.llm.LlmUnavailableException):
+        asyncio.run(operations.llm.complete(messages))
+
+    model["app"] = stub
+    assert asyncio.run(operations.llm.complete(messages)).startswith("Stub recipe")
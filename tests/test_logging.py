@@ -0,0 +1,53 @@
+import json
+import logging
+import queue
+
+import pytest
+from opentelemetry import trace
+
+import appLogging
+import appMetrics
+
+
+def test_full_ring_buffer_overwrites_its_oldest_record_and_counts_it():
+    buffer = appLogging.RingBufferQueue(2)
+    dropped_before = appMetrics.LOG_RECORDS_DROPPED._value.get()
+
+    for record in ("first", "second", "third"):
+        buffer.put_nowait(record)
+
+    assert buffer.dropped == 1
+    assert appMetrics.LOG_RECORDS_DROPPED._value.get() == dropped_before + 1
+    assert [buffer.get(), buffer.get()] == ["second", "third"]
+    with pytest.raises(queue.Empty):
+        buffer.get(block=False)
+
+
+def test_json_lines_carry_the_request_and_trace_ids():
+    handler = appLogging.BufferedHandler(appLogging.RingBufferQueue(4))
+    record = logging.LogRecord("api", logging.INFO, __file__, 1, "signed in %s", ("alice",), None)
+    span = trace.NonRecordingSpan(trace.SpanContext(trace_id=0xabc, span_id=0x1, is_remote=False))
+
+    token = appLogging.request_id_var.set("request-1")
+    try:
+        with trace.use_span(span):
+            prepared = handler.prepare(record)
+    finally:
+        appLogging.request_id_var.reset(token)
+    entry = json.loads(appLogging.JsonFormatter().format(prepared))
+
+    assert entry["message"] == "signed in alice"
+    assert entry["request_id"] == "request-1"
+    assert entry["trace_id"] == format(0xabc, "032x")
+
+
+def test_child_logger_attaches_to_a_parent_registered_after_its_first_record(monkeypatch):
+    monkeypatch.setattr(appLogging.Logger, "logger", None)
+    child = appLogging.Logger.get_child_logger("late-child")
+    child.debug("before any parent")
+
+    parent = logging.getLogger("late-parent")
+    monkeypatch.setattr(appLogging.Logger, "logger", parent)
+    child.debug("after the parent")
+
+    assert child._resolve() is parent.getChild("late-child")
@@ -0,0 +1,48 @@
+import asyncio
+
+import httpx
+
+import appMedia
+import configuration
+
+
+def _get(directory, path: str) -> httpx.Response:
+    # httpx decodes the path once like uvicorn, the Starlette test client decodes it twice
+    app = appMedia.MediaFiles(directory, configuration.get_config().media)
+
+    async def get():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://media") as client:
+            return await client.get(path)
+
+    return asyncio.run(get())
+
+
+def test_file_name_with_percent_is_served(tmp_path):
+    tmp_path.joinpath("100%25 rye.txt").write_bytes(b"bread")
+
+    response = _get(tmp_path, "/100%2525%20rye.txt")
+
+    assert response.status_code == 200
+    assert response.content == b"bread"
+
+
+def test_missing_file_and_dot_files_are_not_found(tmp_path):
+    tmp_path.joinpath(".original.png.part").write_bytes(b"partial")
+
+    assert _get(tmp_path, "/missing.txt").status_code == 404
+    assert _get(tmp_path, "/.original.png.part").status_code == 404
+
+
+def test_only_content_addressed_originals_are_immutable(tmp_path):
+    image = tmp_path.joinpath("images", "ab", "ab" + "0" * 62)
+    image.mkdir(parents=True)
+    image.joinpath("original.png").write_bytes(b"original")
+    image.joinpath("thumbnail.webp").write_bytes(b"thumbnail")
+    relative = f"/images/ab/{image.name}"
+
+    original = _get(tmp_path, f"{relative}/original.png")
+    thumbnail = _get(tmp_path, f"{relative}/thumbnail.webp")
+
+    assert original.headers["cache-control"].endswith("immutable")
+    assert original.headers["etag"] == f'"{image.name}"'
+    assert thumbnail.headers["cache-control"] == "public, no-cache"
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+import operations.messages
+
+
+def test_broker_interface_is_abstract():
+    with pytest.raises(TypeError):
+        operations.messages.MessageBroker()
+    with pytest.raises(TypeError):
+        operations.messages.Consumer("queue", None, 10)
+
+
+def test_handled_messages_of_a_lost_channel_are_not_settled_on_the_new_one():
+    async def scenario():
+        broker = operations.messages.InMemoryBroker()
+        handling = asyncio.Event()
+        release = asyncio.Event()
+
+        async def handler(message):
+            handling.set()
+            await release.wait()
+
+        await broker.publish("restarted", "first")
+        consumer = await broker.consume("restarted", handler, prefetch_count=4)
+        await handling.wait()
+        consumer._restart_deliveries()
+        release.set()
+        await asyncio.sleep(0)
+        unacked = consumer._unacked
+        await broker.close()
+        return unacked
+
+    assert asyncio.run(scenario()) == 0
@@ -0,0 +1,52 @@
+import asyncio
+import subprocess
+import sys
+import uuid
+
+from fastapi.testclient import TestClient
+from prometheus_client.parser import text_string_to_metric_families
+
+import api
+import db.connection
+import operations.tokens
+
+
+def _samples(client: TestClient) -> dict:
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(response.text)
+        for sample in family.samples
+    }
+
+
+def test_exposition_labels_routes_by_template_counts_queries_and_aggregates_workers():
+    client = TestClient(api.app)
+    route = (("route", "/api/users/{user_id}"),)
+    latency = ("http_request_duration_seconds_count", (("method", "GET"), *route, ("status", "404")))
+    token = operations.tokens.create_access_token("admin-id", role="admin")
+    # Another worker writing its samples to the shared multiprocess directory
+    subprocess.run(
+        [sys.executable, "-c", "import appMetrics; appMetrics.LOGIN_THROTTLED.labels('other-worker').inc()"],
+        check=True,
+    )
+    before = _samples(client)
+
+    try:
+        response = client.get(f"/api/users/{uuid.uuid4()}", headers={"Authorization": f"Bearer {token}"})
+    finally:
+        asyncio.run(db.connection.dispose_async_engines())
+    after = _samples(client)
+
+    def delta(key):
+        return after.get(key, 0) - before.get(key, 0)
+
+    assert response.status_code == 404
+    assert delta(latency) == 1
+    assert not any(value.startswith("/api/users/") and "{" not in value
+                   for _, labels in after for name, value in labels if name == "route")
+    # The lookup of the unknown user is one query, counted by the engine hooks
+    assert delta(("http_request_db_queries_count", route)) == 1
+    assert delta(("http_request_db_queries_sum", route)) == 1
+    assert after[("login_throttled_total", (("key", "other-worker"),))] == 1
@@ -0,0 +1,20 @@
+import pytest
+
+import db.explain
+
+
+def test_filtered_statements_use_an_index(capsys):
+    failures = db.explain.check()
+
+    assert failures == 0, capsys.readouterr().out
+
+
+@pytest.mark.parametrize("line, table", [
+    ("SCAN users", "users"),
+    ("SCAN TABLE users", "users"),
+    ("SEARCH users USING INDEX ix_users_email (email=?)", None),
+    ("SCAN users USING COVERING INDEX ix_users_updated_on_id", None),
+])
+def test_full_scans_are_recognised_in_every_sqlite_wording(line, table):
+    match = db.explain._SQLITE_FULL_SCAN.match(line)
+    assert (match.group(1) if match else None) == table
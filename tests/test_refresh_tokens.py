@@ -0,0 +1,14 @@
+import pytest
+
+import exceptions.tokens
+import operations.users
+
+
+def test_password_change_revokes_refresh_tokens():
+    user = operations.users.create_user("Refresh", "Revoked", "refresh@revoked.test", None, "Password1@")
+    _, refresh_token = operations.users.sign_in(user.email, "Password1@")
+
+    operations.users.update_user(user.id, "password", "Password2@")
+
+    with pytest.raises(exceptions.tokens.InvalidRefreshTokenException):
+        operations.users.refresh_tokens(refresh_token)
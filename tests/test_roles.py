@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete, update
+
+import db.connection
+import db.models
+import operations.roles
+
+
+def test_async_catalog_does_not_load_through_the_blocking_session(monkeypatch):
+    role = operations.roles.create_role("catalog-async", None)
+    monkeypatch.setattr(operations.roles, "_catalog", None)
+    monkeypatch.setattr(operations.roles, "refresh_role_catalog", lambda: pytest.fail("blocking refresh"))
+
+    async def load():
+        try:
+            return await operations.roles.get_role_catalog_async()
+        finally:
+            await db.connection.dispose_async_engines()
+
+    assert asyncio.run(load()).name_of(role.id) == "catalog-async"
+
+
+def test_renaming_or_replacing_a_role_changes_the_catalog_version():
+    role = operations.roles.create_role("catalog-rename", None)
+    version = operations.roles.refresh_role_catalog().version
+
+    with db.connection.get_session() as session:
+        session.execute(update(db.models.Role).where(db.models.Role.id == role.id).values(name="catalog-renamed"))
+        session.commit()
+    renamed = operations.roles.refresh_role_catalog()
+    assert renamed.version != version
+    assert renamed.name_of(role.id) == "catalog-renamed"
+
+    with db.connection.get_session() as session:
+        session.execute(delete(db.models.Role).where(db.models.Role.id == role.id))
+        session.add(db.models.Role(name="catalog-replacement", created_by=None))
+        session.commit()
+    assert operations.roles.refresh_role_catalog().version != renamed.version
@@ -0,0 +1,53 @@
+import pytest
+
+import operations.search
+
+
+@pytest.fixture(scope="module", autouse=True)
+def documents():
+    titles = {
+        "mayonnaise": "Домашна майонеза",
+        "tree": "Торта ёлка",
+        "cafe": "Café au lait",
+        "creme": "Crème brûlée",
+        "soup-1": "Tomato soup",
+        "soup-2": "Tomato soup",
+        "soup-3": "Tomato soup",
+    }
+    for document_id, title in titles.items():
+        operations.search.index_document(operations.search.RECIPE, f"search-{document_id}", title)
+    yield
+    for document_id in titles:
+        operations.search.remove_document(operations.search.RECIPE, f"search-{document_id}")
+
+
+def _found(query: str) -> list[str]:
+    rows, _ = operations.search.search(query, [operations.search.RECIPE])
+    return [row.document_id for row in rows]
+
+
+@pytest.mark.parametrize("query, document_id", [
+    ("майонеза", "search-mayonnaise"),
+    ("МАЙОН", "search-mayonnaise"),
+    ("ёлка", "search-tree"),
+    ("café", "search-cafe"),
+    ("cafe", "search-cafe"),
+    ("creme brulee", "search-creme"),
+    ("CRÈME", "search-creme"),
+])
+def test_non_ascii_words_match(query, document_id):
+    assert _found(query) == [document_id]
+
+
+def test_diacritics_of_other_scripts_are_kept():
+    # unicode61 only folds Latin letters, е is not ё
+    assert _found("елка") == []
+
+
+def test_equally_ranked_documents_are_paged_in_a_stable_order():
+    pages, offset = [], 0
+    while offset is not None:
+        rows, offset = operations.search.search("tomato soup", [operations.search.RECIPE], limit=1, offset=offset)
+        pages += [row.document_id for row in rows]
+
+    assert pages == ["search-soup-1", "search-soup-2", "search-soup-3"]
@@ -0,0 +1,61 @@
+import pytest
+
+import configuration
+import exceptions.throttling
+import operations.throttling
+
+
+def _throttle(**settings) -> operations.throttling.LoginThrottle:
+    config = configuration.LoginThrottlingConfig(**{"free_attempts": 2, "ip_free_attempts": 3, **settings})
+    return operations.throttling.LoginThrottle(operations.throttling.MemoryCounterStore(), config)
+
+
+def test_concurrent_attempts_are_reserved_before_the_password_is_checked():
+    throttle = _throttle()
+    throttle.begin("10.0.0.1", "cook")
+    throttle.begin("10.0.0.1", "cook")
+
+    # Neither attempt has finished, the third one already has to wait
+    with pytest.raises(exceptions.throttling.LoginThrottledException):
+        throttle.begin("10.0.0.1", "cook")
+
+
+@pytest.mark.parametrize("outcome", [operations.throttling.SUCCEEDED, operations.throttling.CANCELLED])
+def test_settled_attempt_is_not_counted(outcome):
+    throttle = _throttle()
+    for _ in range(5):
+        throttle.settle("10.0.0.1", "cook", throttle.begin("10.0.0.1", "cook"), outcome)
+
+    assert throttle.store.zcard("login:ip:10.0.0.1") == 0
+    assert throttle.store.zcard("login:username:cook") == 0
+    assert throttle.begin("10.0.0.1", "cook") is not None
+
+
+def test_failed_attempt_is_counted():
+    throttle = _throttle()
+    throttle.settle("10.0.0.1", "cook", throttle.begin("10.0.0.1", "cook"), operations.throttling.FAILED)
+
+    assert throttle.store.zcard("login:ip:10.0.0.1") == 1
+    assert throttle.store.zcard("login:username:cook") == 1
+
+
+def test_ip_backs_off_across_usernames():
+    throttle = _throttle()
+    for username in ("cook", "baker", "chef"):
+        throttle.begin("10.0.0.2", username)
+        throttle.record_failure("10.0.0.2", username)
+
+    with pytest.raises(exceptions.throttling.LoginThrottledException):
+        throttle.begin("10.0.0.2", "waiter")
+    throttle.begin("10.0.0.3", "waiter")
+
+
+def test_reaching_the_maximum_locks_out():
+    throttle = _throttle(free_attempts=100, username_max_failures=2, lockout_seconds=60)
+    for ip in ("10.0.0.4", "10.0.0.5"):
+        throttle.begin(ip, "cook")
+        throttle.record_failure(ip, "cook")
+
+    with pytest.raises(exceptions.throttling.LoginThrottledException) as error:
+        throttle.begin("10.0.0.6", "cook")
+    assert error.value.retry_after > 50
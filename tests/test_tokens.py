@@ -0,0 +1,35 @@
+import asyncio
+
+import fastapi
+import pytest
+
+import dependencies.users
+import operations.tokens
+
+
+def _principal(token: str):
+    return asyncio.run(dependencies.users.get_current_principal(token))
+
+
+def test_access_token_resolves_principal():
+    principal = _principal(operations.tokens.create_access_token("user-id", role="admin"))
+    assert (principal.id, principal.role) == ("user-id", "admin")
+
+
+@pytest.mark.parametrize("token", [
+    operations.tokens.create_email_token("user-id", "verify_email", 10),
+    operations.tokens.create_refresh_token("user-id"),
+    operations.tokens.jwt.encode({"exp": 2 ** 32}, key=operations.tokens._signing_key,
+                                 algorithm=operations.tokens.jwt_config.algorithm),
+    operations.tokens.jwt.encode({"exp": 2 ** 32, "sub": "user-id"}, key=operations.tokens._signing_key,
+                                 algorithm=operations.tokens.jwt_config.algorithm),
+])
+def test_other_tokens_are_unauthorized(token):
+    with pytest.raises(fastapi.HTTPException) as error:
+        _principal(token)
+    assert error.value.status_code == 401
+
+
+def test_access_token_is_not_a_refresh_token():
+    with pytest.raises(operations.tokens.JWTError):
+        operations.tokens.decode_refresh_token(operations.tokens.create_access_token("user-id"))
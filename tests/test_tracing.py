@@ -0,0 +1,70 @@
+import pytest
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import StatusCode
+
+import appTracing
+import configuration
+
+MS = 1_000_000
+
+
+def _trace(tracer, name: str, duration_ms: int, error: bool = False):
+    root = tracer.start_span(name, start_time=0)
+    child = tracer.start_span(f"{name} query", context=trace.set_span_in_context(root), start_time=MS)
+    if error:
+        child.set_status(StatusCode.ERROR)
+    child.end(end_time=2 * MS)
+    root.end(end_time=duration_ms * MS)
+
+
+@pytest.fixture
+def memory_exporter():
+    appTracing.memory_exporter.clear()
+    yield appTracing.memory_exporter
+    appTracing.memory_exporter.clear()
+
+
+def test_tail_sampling_keeps_failed_and_slow_traces_only(memory_exporter):
+    provider = appTracing.setup_tracing(configuration.TracingConfig(
+        sampling=configuration.TraceSamplingOptions.TAIL,
+        exporter=configuration.TraceExporterOptions.MEMORY,
+        ratio=0.0,
+        slow_request_ms=100,
+    ))
+    tracer = provider.get_tracer(__name__)
+
+    _trace(tracer, "fast", 10)
+    _trace(tracer, "failed", 10, error=True)
+    _trace(tracer, "slow", 250)
+    provider.shutdown()
+
+    assert sorted(span.name for span in memory_exporter.get_finished_spans()) == \
+        ["failed", "failed query", "slow", "slow query"]
+    summary = appTracing.latency_summary()
+    assert summary.keys() == {"failed", "failed query", "slow", "slow query"}
+    assert summary["slow"]["count"] == 1
+    assert summary["slow"]["p99"] == summary["slow"]["max"] == 250
+    assert summary["slow query"]["mean"] == 1
+
+
+def test_tail_sampling_evicts_the_least_recently_active_trace():
+    exporter = InMemorySpanExporter()
+    processor = appTracing.TailSamplingSpanProcessor(SimpleSpanProcessor(exporter), 0, 0.0, 2)
+    provider = TracerProvider()
+    provider.add_span_processor(processor)
+    tracer = provider.get_tracer(__name__)
+
+    first, second, third = (tracer.start_span(name) for name in ("first", "second", "third"))
+    for root in (first, second, first, third):
+        tracer.start_span("step", context=trace.set_span_in_context(root)).end()
+    for root in (first, second, third):
+        root.end()
+
+    # second was evicted when third arrived, first stayed because it was active after second
+    spans_per_trace = {}
+    for span in exporter.get_finished_spans():
+        spans_per_trace[span.context.trace_id] = spans_per_trace.get(span.context.trace_id, 0) + 1
+    assert [spans_per_trace[root.context.trace_id] for root in (first, second, third)] == [3, 1, 2]
@@ -0,0 +1,51 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+import db.connection
+import operations.response_cache
+import operations.roles
+import operations.tokens
+import operations.users
+
+
+@pytest.fixture
+def client():
+    yield TestClient(api.app, headers={
+        "Authorization": f"Bearer {operations.tokens.create_access_token('admin-id', role='admin')}"
+    })
+    asyncio.run(db.connection.dispose_async_engines())
+
+
+@pytest.fixture
+def user():
+    return operations.users.create_user("Etag", "Test", f"{uuid.uuid4()}@users.test", None, "Password1@")
+
+
+def test_user_response_is_not_modified_until_the_user_or_the_roles_change(client, user):
+    path = f"/api/users/{user.id}"
+    etag = client.get(path).headers["ETag"]
+
+    not_modified = client.get(path, headers={"If-None-Match": etag})
+    assert (not_modified.status_code, not_modified.content) == (304, b"")
+
+    operations.users.update_user(user.id, "first_name", "Renamed")
+    renamed = client.get(path, headers={"If-None-Match": etag})
+    assert renamed.status_code == 200
+    assert renamed.json()["first_name"] == "Renamed"
+    assert renamed.headers["ETag"] != etag
+
+    operations.roles.create_role("etag-role", None)
+    assert client.get(path, headers={"If-None-Match": renamed.headers["ETag"]}).status_code == 200
+
+
+def test_invalidating_a_user_drops_its_cached_response(client, user):
+    client.get(f"/api/users/{user.id}")
+    assert operations.response_cache._responses.get(("user", user.id)) is not None
+
+    operations.users.invalidate_cached_user(user.id)
+
+    assert operations.response_cache._responses.get(("user", user.id)) is None